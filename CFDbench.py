@@ -0,0 +1,598 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8
+"""
+Speed tests for CFDscraper. README rule: "Speed test everything."
+
+Usage:
+python CFDbench.py save --pages ./pages world_FX_CFD.cfg DE_bnd_CFD.cfg
+    Opens each config's page in its browser and saves page_source to
+    ./pages/<dataname>.html so the other benchmarks can run offline.
+python CFDbench.py extractors --pages ./pages world_FX_CFD.cfg ...
+    Times every table extractor on each config's saved page and checks
+    that they agree with html5lib.
+python CFDbench.py warmstart world_FX_CFD.cfg ...
+    Times loading the last row of every table against each config's
+    database: reflect and select per table (the old way) against
+    get_last_rows().
+python CFDbench.py compare
+    Times change detection with 10, 100 and 1000 made up instruments:
+    the old linear scan against compare_lists(). No config needed.
+python CFDbench.py rows --pages ./pages world_FX_CFD.cfg ...
+    Fills and compares each config's saved table cycle after cycle, the
+    old way (fresh nested lists, str() of every row for logger.debug)
+    against reused Rows. Reports time, peak memory and gen 0 garbage
+    collections per cycle.
+python CFDbench.py dates
+    Times the page's time cells through dateutil's parse() (the old
+    custom_date_parser) against the sliced parser with a DayAnchor, for
+    GMT and a non-GMT web_tz. Checks they give the same datetimes.
+python CFDbench.py record --captures ./captures --snapshots 100 ...
+    Opens each config's page and records a page_source snapshot every
+    refresh_rate seconds to ./captures/<dataname>.ndjson.gz. (Setting
+    record_path in a config does the same while scraping.)
+python CFDbench.py replay --captures ./captures --db sqlite:///bench.db ...
+    Plays each config's capture through extract_table, fill_from_table,
+    compare_lists and write2db and reports latency per stage and
+    throughput. --db memory counts rows instead of writing them. The
+    config's db_layout picks wide tables or the ticks table.
+python CFDbench.py startup --repeat 10 world_FX_CFD.cfg ...
+    Times a cold "import CFDscraper" in fresh interpreters and lists the
+    heavy modules it loaded, then times loading each config and starting
+    its feed up to the browser launch (and once more, as a restart)
+    against a scratch SQLite database.
+python CFDbench.py pageload --repeat 5 world_FX_CFD.cfg ...
+    Loads each config's page repeat times in its browser, first with no
+    request filtering and then with the config's block_hosts, block_urls
+    and block_types. Reports page load times, page_source size and how
+    many requests the filter blocked.
+python CFDbench.py serve --pages ./pages --port 8000
+    Serves each saved page at http://localhost:8000/<dataname> with ETag
+    support, as a stand-in for the real site. Point a config's url_string
+    at it (browser_choice = "http" or any browser) to test offline.
+"""
+
+import sys
+import os
+import argparse
+import copy
+import datetime
+import hashlib
+import gc
+import subprocess
+import tempfile
+import tracemalloc
+from time import time, sleep
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from sqlalchemy import create_engine, MetaData, Table
+from dateutil.parser import parse
+from dateutil.tz import gettz, tzutc
+
+import CFDscraper
+
+
+def page_path(page_dir, cfg):
+    return os.path.join(page_dir, cfg.dataname + '.html')
+
+
+def load_page(page_dir, cfg):
+    with open(page_path(page_dir, cfg), 'rb') as page_file:
+        return page_file.read().decode('utf-8')
+
+
+def time_it(func, args, repeat):
+    """
+    Calls func(*args) repeat times. Returns (best, mean) in milliseconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time()
+        func(*args)
+        times.append((time() - start) * 1000)
+    return min(times), sum(times) / len(times)
+
+
+def save_pages(configs, page_dir):
+    if not os.path.isdir(page_dir):
+        os.makedirs(page_dir)
+    for cfg in configs:
+        browser = CFDscraper.Browser(cfg)
+        try:
+            html_source = browser.source()
+        finally:
+            browser.quit()
+        with open(page_path(page_dir, cfg), 'wb') as page_file:
+            page_file.write(html_source.encode('utf-8'))
+        print("Saved " + page_path(page_dir, cfg))
+
+
+def bench_extractors(configs, page_dir, repeat):
+    print("%-20s %-10s %10s %10s %6s %s" %
+          ("config", "extractor", "best ms", "mean ms", "rows", "agrees"))
+    for cfg in configs:
+        html_source = load_page(page_dir, cfg)
+        reference = CFDscraper.extract_table_html5lib(html_source,
+                                                      cfg.attribute)
+        for name, func in sorted(CFDscraper.table_extractors.items()):
+            if name == 'lxml' and not CFDscraper.import_lxml():
+                continue
+            result = func(html_source, cfg.attribute)
+            best, mean = time_it(func, (html_source, cfg.attribute), repeat)
+            rows = len(result[1]) if result else 0
+            print("%-20s %-10s %10.2f %10.2f %6d %s" %
+                  (cfg.dataname, name, best, mean, rows,
+                   result == reference))
+
+
+def per_table_warm_start(cfg, conn):
+    """
+    The old startup path: reflect each table, then select its last row.
+    """
+    metadata = MetaData()
+    for entry in cfg.bootstrap_list:
+        sql_table = Table(entry[0], metadata, autoload=True,
+                          autoload_with=conn)
+        CFDscraper.get_last_row_dict(sql_table, conn)
+
+
+def bench_warm_start(configs, repeat):
+    print("%-20s %6s %14s %14s %8s" %
+          ("config", "tables", "per table ms", "batched ms", "saved ms"))
+    for cfg in configs:
+        engine, metadata, conn = CFDscraper.db_setup(cfg)
+        tables = CFDscraper.setup_tables(cfg.bootstrap_list, metadata,
+                                         cfg.time_col)
+        old_best, _ = time_it(per_table_warm_start, (cfg, conn), repeat)
+        new_best, _ = time_it(CFDscraper.get_last_rows,
+                              (cfg.bootstrap_list, tables, conn), repeat)
+        print("%-20s %6d %14.2f %14.2f %8.2f" %
+              (cfg.dataname, len(tables), old_best, new_best,
+               old_best - new_best))
+
+
+def compare_lists_linear(old_list, new_list):
+    """
+    compare_lists as it was: a scan of old_list for every new entry.
+    """
+    return [entry for entry in new_list if entry not in old_list]
+
+
+def fake_rows(count, changed_every):
+    """
+    count instruments as a list_of_rows of Row. Every changed_every'th
+    one gets a new value compared to changed_every=0.
+    """
+    now = datetime.datetime(2014, 1, 2, 12, 0, 0)
+    rows = []
+    for n in range(count):
+        value = 100.0 + n
+        if changed_every and n % changed_every == 0:
+            value += 0.5
+        rows.append(CFDscraper.Row('instrument_%d' % n,
+                                   ('UTCTime', 'Value'), [now, value]))
+    return rows
+
+
+def bench_compare(repeat, sizes=(10, 100, 1000)):
+    print("%-12s %10s %14s %12s" %
+          ("instruments", "changed", "linear ms", "keyed ms"))
+    for count in sizes:
+        old_list = fake_rows(count, 0)
+        new_list = fake_rows(count, 10)
+        linear, _ = time_it(compare_lists_linear, (old_list, new_list),
+                            repeat)
+        states = [CFDscraper.keyed_state(old_list) for _ in range(repeat)]
+        times = []
+        for state in states:  # Fresh state each time since it is updated.
+            start = time()
+            changed = CFDscraper.compare_lists(state, new_list)
+            times.append((time() - start) * 1000)
+        print("%-12d %10d %14.3f %12.3f" %
+              (count, len(changed), linear, min(times)))
+
+
+def date_parser_dateutil(date_string, web_tz='GMT'):
+    """
+    custom_date_parser as it was, plus the move to UTC it couldn't do.
+    """
+    if len(date_string) == 7:
+        date_string = '0' + date_string
+    if web_tz in ('GMT', 'UTC'):
+        current_utc = datetime.datetime.utcnow()
+        if current_utc.hour == 0 and int(date_string[0:2]) == 23:
+            current_utc = current_utc - datetime.timedelta(days=1)
+        return parse(date_string, default=current_utc)
+    zone = gettz(web_tz)
+    current = datetime.datetime.now(zone)
+    if current.hour == 0 and int(date_string[0:2]) == 23:
+        current = current - datetime.timedelta(days=1)
+    stamp = parse(date_string, default=current.replace(tzinfo=None))
+    return stamp.replace(tzinfo=zone).astimezone(tzutc()).replace(
+        tzinfo=None)
+
+
+def fake_times(count):
+    return ['%d:%02d:%02d' % (n % 24, n % 60, (n * 7) % 60)
+            for n in range(count)]
+
+
+def bench_dates(repeat, count=1000, zones=('GMT', 'America/New_York')):
+    date_strings = fake_times(count)
+    print("%-18s %8s %14s %12s %8s" %
+          ("web_tz", "cells", "dateutil ms", "sliced ms", "same"))
+    for web_tz in zones:
+        def old_way():
+            return [date_parser_dateutil(date_string, web_tz)
+                    for date_string in date_strings]
+
+        def new_way():
+            anchor = CFDscraper.day_anchor(web_tz)  # Once per cycle.
+            return [CFDscraper.custom_date_parser(date_string, None,
+                                                  anchor=anchor)
+                    for date_string in date_strings]
+
+        old_best, _ = time_it(old_way, (), repeat)
+        new_best, _ = time_it(new_way, (), repeat)
+        print("%-18s %8d %14.3f %12.3f %8s" %
+              (web_tz, count, old_best, new_best, old_way() == new_way()))
+
+
+def fill_lists(plan, body, anchor):
+    """
+    fill_table as it was for every table: a fresh [table, [[col, value],
+    ...]] per table per cycle and an eager str() for logger.debug.
+    """
+    list_of_rows = []
+    for table_name, first, last, columns in plan.tables:
+        col_list = []
+        for n in range(first, last):
+            row, col = plan.addresses[n]
+            table_value = body[row][col]
+            if plan.cells[n][4]:
+                table_value = CFDscraper.custom_date_parser(
+                    table_value, None, anchor=anchor)
+            else:
+                table_value = float(table_value.replace(',', ''))
+            col_list.append([plan.cells[n][1], table_value])
+        row = [table_name, col_list]
+        CFDscraper.logger.debug("Load web: %s", str(row))
+        list_of_rows.append(row)
+    return list_of_rows
+
+
+def compare_lists_nested(last_state, new_list):
+    """
+    compare_lists as it was on nested lists: a tuple per changed row.
+    """
+    differences = []
+    for entry in new_list:
+        values = tuple(col[1] for col in entry[1])
+        if last_state.get(entry[0]) != values:
+            last_state[entry[0]] = values
+            differences.append(entry)
+    return differences
+
+
+def cycle_costs(cycle, cycles):
+    """
+    Runs cycle() cycles times. Returns (ms per cycle, peak KB of a
+    cycle, gen 0 collections per 1000 cycles).
+    """
+    cycle()  # Warm up.
+    tracemalloc.start()
+    cycle()
+    peak = tracemalloc.get_traced_memory()[1] / 1024.0
+    tracemalloc.stop()
+    collections = gc.get_stats()[0]['collections']
+    start = time()
+    for _ in range(cycles):
+        cycle()
+    elapsed = (time() - start) * 1000 / cycles
+    collections = gc.get_stats()[0]['collections'] - collections
+    return elapsed, peak, collections * 1000.0 / cycles
+
+
+def bench_rows(configs, page_dir, cycles=2000):
+    print("%-20s %-7s %10s %10s %12s" %
+          ("config", "rows", "ms/cycle", "peak KB", "gen0/1000"))
+    for cfg in configs:
+        header, body = CFDscraper.extract_table(load_page(page_dir, cfg),
+                                                cfg.attribute)
+        plan = CFDscraper.CellPlan(cfg.bootstrap_list, cfg.time_col,
+                                   cfg.row_title_column)
+        if not plan.resolve(header, body):
+            print("%s: saved page doesn't match the config." % cfg.dataname)
+            continue
+        old_state = {}
+        new_state = {}
+
+        def old_way():
+            anchor = CFDscraper.day_anchor(cfg.web_tz)
+            compare_lists_nested(old_state, fill_lists(plan, body, anchor))
+
+        def new_way():
+            anchor = CFDscraper.day_anchor(cfg.web_tz)
+            CFDscraper.compare_lists(new_state, [
+                CFDscraper.fill_table(plan, table, body, None, anchor)
+                for table in plan.tables])
+
+        for name, cycle in (('lists', old_way), ('Row', new_way)):
+            print("%-20s %-7s %10.3f %10.1f %12.1f" %
+                  ((cfg.dataname, name) + cycle_costs(cycle, cycles)))
+
+
+def capture_path(capture_dir, cfg):
+    return os.path.join(capture_dir, cfg.dataname + '.ndjson.gz')
+
+
+def percentile(times, fraction):
+    ordered = sorted(times)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def record_captures(configs, capture_dir, snapshots):
+    if not os.path.isdir(capture_dir):
+        os.makedirs(capture_dir)
+    for cfg in configs:
+        browser = CFDscraper.RecordingBrowser(CFDscraper.Browser(cfg),
+                                              capture_path(capture_dir, cfg))
+        try:
+            for n in range(snapshots):
+                browser.source()
+                sys.stdout.write("\r%s: %d/%d" % (cfg.dataname, n + 1,
+                                                   snapshots))
+                sys.stdout.flush()
+                sleep(cfg.refresh_rate)
+        finally:
+            browser.quit()
+        print("")
+
+
+class MemorySink(object):
+    """
+    Stands in for the database: counts the rows write2db would write.
+    """
+    def __init__(self):
+        self.rows = 0
+
+    def write(self, changed_list):
+        written = sum(1 for row in changed_list
+                      if row.values[0] is not None)
+        self.rows += written
+        return written
+
+
+def replay_pipeline(cfg, path, db_url):
+    """
+    Runs one capture through the pipeline. Returns (stage times in ms,
+    snapshots, rows written, seconds for the lot).
+    """
+    browser = CFDscraper.ReplayBrowser(path)
+    plan = CFDscraper.CellPlan(cfg.bootstrap_list, cfg.time_col,
+                               cfg.row_title_column)
+    if db_url == 'memory':
+        write = MemorySink().write
+    else:
+        engine = create_engine(db_url)
+        metadata = MetaData(bind=engine)
+        tables = CFDscraper.setup_tables(cfg.bootstrap_list, metadata,
+                                         cfg.time_col, cfg.db_layout)
+        conn = engine.connect()
+
+        def write(changed_list):
+            return CFDscraper.write2db(changed_list, tables, conn)
+
+    stages = dict((name, []) for name in REPLAY_STAGES)
+    last_state = {}
+    snapshots = rows = 0
+    start = time()
+    while True:
+        t0 = time()
+        try:
+            html_source = browser.source()
+        except EOFError:
+            break
+        t1 = time()
+        extracted = CFDscraper.extract_table(html_source, cfg.attribute,
+                                             cfg.table_extractor)
+        if extracted is None:
+            continue
+        t2 = time()
+        new_list = CFDscraper.fill_from_table(extracted[0], extracted[1],
+                                              browser, cfg, plan)
+        t3 = time()
+        changed_list = CFDscraper.compare_lists(last_state, new_list)
+        t4 = time()
+        rows += write(changed_list)
+        t5 = time()
+        for name, began, ended in zip(REPLAY_STAGES, (t0, t1, t2, t3, t4),
+                                      (t1, t2, t3, t4, t5)):
+            stages[name].append((ended - began) * 1000)
+        snapshots += 1
+    return stages, snapshots, rows, time() - start
+
+
+REPLAY_STAGES = ('source', 'extract', 'fill', 'compare', 'write')
+
+
+def bench_replay(configs, capture_dir, db_url):
+    for cfg in configs:
+        stages, snapshots, rows, elapsed = replay_pipeline(
+            cfg, capture_path(capture_dir, cfg), db_url)
+        if not snapshots:
+            print("%s: no snapshots." % cfg.dataname)
+            continue
+        print("%s: %d snapshots, %d rows in %.2fs "
+              "(%.1f snapshots/s, %.1f rows/s)" %
+              (cfg.dataname, snapshots, rows, elapsed,
+               snapshots / elapsed, rows / elapsed))
+        print("  %-8s %10s %10s %10s %10s" %
+              ("stage", "mean ms", "p50 ms", "p95 ms", "max ms"))
+        for name in REPLAY_STAGES:
+            times = stages[name]
+            print("  %-8s %10.3f %10.3f %10.3f %10.3f" %
+                  (name, sum(times) / len(times), percentile(times, 0.5),
+                   percentile(times, 0.95), max(times)))
+
+
+HEAVY_MODULES = ('selenium', 'bs4', 'html5lib', 'lxml', 'pandas', 'asyncio',
+                 'aiohttp', 'pyarrow', 'sqlalchemy', 'dateutil')
+IMPORT_TIMER = ("import sys, time\n"
+                "start = time.perf_counter()\n"
+                "import CFDscraper\n"
+                "print(time.perf_counter() - start)\n"
+                "print(' '.join(name for name in sys.argv[1:]\n"
+                "               if name in sys.modules))\n")
+
+
+def bench_startup(configs, repeat):
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for n in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_TIMER] + list(HEAVY_MODULES),
+            cwd=here, universal_newlines=True).split('\n')
+        times.append(float(output[0]) * 1000)
+    print("import CFDscraper: best %.1f ms, p50 %.1f ms" %
+          (min(times), percentile(times, 0.5)))
+    print("  heavy modules loaded: " + (output[1] or "none"))
+
+    scratch = tempfile.mkdtemp()
+    print("%-20s %10s %10s %10s %10s" %
+          ("config", "load ms", "feed ms", "start ms", "restart ms"))
+    for cfg in configs:
+        start = time()
+        cfg = CFDscraper.import_config(cfg.filename)
+        loaded = time()
+        cfg.db_dialect = 'sqlite'
+        cfg.db_user = cfg.db_pass = cfg.db_host = ''
+        cfg.db_name = os.path.join(scratch, cfg.dataname + '.db')
+        cfg.spool_path = os.path.join(scratch, cfg.dataname + '_spool.db')
+        feed = CFDscraper.Feed(cfg)
+        built = time()
+        feed.start(None)
+        started = time()
+        CFDscraper.Feed(cfg).start(None)
+        print("%-20s %10.1f %10.1f %10.1f %10.1f" %
+              (cfg.dataname, (loaded - start) * 1000, (built - loaded) * 1000,
+               (started - built) * 1000, (time() - started) * 1000))
+
+
+def bench_page_load(configs, repeat):
+    print("%-30s %10s %10s %10s %8s %8s" %
+          ("config", "mean ms", "p95 ms", "source kB", "blocked", "passed"))
+    for cfg in configs:
+        if not (cfg.block_hosts or cfg.block_urls or cfg.block_types):
+            print("%s blocks nothing." % cfg.dataname)
+            continue
+        for label in ('open', 'filtered'):
+            run_cfg = copy.copy(cfg)
+            run_cfg.dataname = cfg.dataname + '/' + label
+            if label == 'open':
+                run_cfg.block_hosts = run_cfg.block_urls = []
+                run_cfg.block_types = []
+            browser = CFDscraper.Browser(run_cfg)  # Loads the page once.
+            try:
+                for n in range(repeat - 1):
+                    browser.load_url(browser.driver, run_cfg.url_string)
+                size = len(browser.source())
+            finally:
+                browser.quit()
+            feed = CFDscraper.metrics.snapshot()['feeds'][run_cfg.dataname]
+            load = feed['stages']['page_load']
+            print("%-30s %10.0f %10.0f %10.1f %8d %8d" %
+                  (run_cfg.dataname, load['mean_ms'], load['p95_ms'],
+                   size / 1024.0, feed['counters'].get('requests_blocked', 0),
+                   feed['counters'].get('requests_passed', 0)))
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    """
+    Serves page_dir/<name>.html at /<name>. The file is read on every
+    request so a page can be swapped while serving. Answers If-None-Match
+    with 304 like a real server would.
+    """
+    page_dir = './pages'
+
+    def do_GET(self):
+        name = os.path.basename(self.path.split('?')[0]) or 'index'
+        try:
+            with open(os.path.join(self.page_dir, name + '.html'),
+                      'rb') as page_file:
+                body = page_file.read()
+        except IOError:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_pages(page_dir, port):
+    PageHandler.page_dir = page_dir
+    server = HTTPServer(('localhost', port), PageHandler)
+    print("Serving %s on http://localhost:%d/" % (page_dir, port))
+    server.serve_forever()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks CFDscraper.")
+    parser.add_argument('command',
+                        choices=['save', 'extractors', 'warmstart',
+                                 'compare', 'rows', 'dates', 'serve',
+                                 'record', 'replay', 'startup', 'pageload'])
+    parser.add_argument('configs', nargs='*', help="config files.")
+    parser.add_argument('--pages', default='./pages',
+                        help="directory of saved pages.")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--captures', default='./captures',
+                        help="directory of capture files.")
+    parser.add_argument('--snapshots', type=int, default=100)
+    parser.add_argument('--db', default='memory',
+                        help="database url for replay, or memory.")
+    return parser.parse_intermixed_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    configs = [CFDscraper.import_config(filename)
+               for filename in args.configs]
+    if args.command == 'save':
+        save_pages(configs, args.pages)
+    elif args.command == 'extractors':
+        bench_extractors(configs, args.pages, args.repeat)
+    elif args.command == 'warmstart':
+        bench_warm_start(configs, args.repeat)
+    elif args.command == 'compare':
+        bench_compare(args.repeat)
+    elif args.command == 'rows':
+        bench_rows(configs, args.pages)
+    elif args.command == 'dates':
+        bench_dates(args.repeat)
+    elif args.command == 'serve':
+        serve_pages(args.pages, args.port)
+    elif args.command == 'record':
+        record_captures(configs, args.captures, args.snapshots)
+    elif args.command == 'replay':
+        bench_replay(configs, args.captures, args.db)
+    elif args.command == 'startup':
+        bench_startup(configs, args.repeat)
+    elif args.command == 'pageload':
+        bench_page_load(configs, args.repeat)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
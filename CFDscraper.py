@@ -3,8 +3,10 @@
 """
 A module to scrape financial data from web tables and write to MySQL.
 
-Usage: python CFDscraper.py ./config1.cfg
-First and only arg is optional path to a config file.
+Usage: python CFDscraper.py ./config1.cfg [./config2.cfg ...]
+Args are optional paths to config files. Given more than one, every config
+is run from a single process that shares one database connection pool and
+at most --max-browsers browser processes. (Each feed gets its own window.)
 
 One of the items is a list of lists with table info in it that seems like
 a headache to parse with configparser so this module simply exec()s a text
@@ -95,6 +97,7 @@ Check for function on linux and windows.
 If the database is not available, write rows to an object that can be "emptied"
 later.
 Include hours of operation in the config file and don't scrape at these times.
+(Done: market_hours. The browser is closed outside them.)
 Make a way to scrape a page with just one data point.
 Turn the database writer into a class in order to do away with pesky globals.
 Move classes into a seperate file.
@@ -103,15 +106,36 @@ Move classes into a seperate file.
 import sys
 from time import sleep, time
 import datetime
+import argparse
+import heapq
+import json
+import gzip
+import re
+import fnmatch
+from select import select as select_sockets  # select is SQLAlchemy's.
+import sqlite3
+import socket
+import threading
+from collections import deque
+import http.client
+from urllib.parse import urlsplit
+from http.server import (BaseHTTPRequestHandler, HTTPServer,
+                         ThreadingHTTPServer)
 ##### For scraping ######
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchWindowException
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
-from bs4 import BeautifulSoup
+# The heavy ones wait until a feed needs them, so a process only pays for
+# the browser and extractor its configs use. (selenium, bs4 and friends
+# were ~0.3 s of every start.)
+webdriver = None  # selenium, imported by import_selenium().
+DesiredCapabilities = None
+lxml = None  # Fast table extractor, imported by import_lxml().
+aiohttp = None  # Imported by HttpFetcher, only if there is an http feed.
+asyncio = None  # Likewise.
+pyarrow = None  # Imported by the archive, only if archive_path is set.
 from sqlalchemy import (create_engine, MetaData, Table, Column,
-                        Integer, DateTime, Float)
-from dateutil.parser import parse
-import pandas as pd
+                        Integer, DateTime, Float, select, literal, union_all,
+                        BigInteger, SmallInteger, String, func, and_)
+from sqlalchemy.exc import IntegrityError
+from dateutil.tz import gettz, tzutc
 ##### Logging ############s
 import logging
 import logging.handlers
@@ -120,15 +144,10 @@ import uuid  # For creating unique name for screenshots.
 from functools import wraps
 import errno
 import os
-import signal
+import ctypes
+import signal  # Only for SIGKILL. Timeouts go through the watchdog.
 
 
-###### Some globals #########################################################
-# Put these into a class at some point.
-
-total_rows_scraped = 0  # Don't change this. It's just a counter.
-last_write_time = time()  # Also a counter.
-
 ##############################################################################
 ###### Default Configuration Data ############################################
 ###### Copy this section to a config file and load it with a CL argument #####
@@ -136,7 +155,10 @@ dataname = 'bondCFD'
 logpath = dataname + '_scrape.log'
 
 chromepath = '/Users/jmorris/Code/chromedriver'
-browser_choice = "phantomjs"  # Choose chrome, firefox, or phantomjs
+# Choose chrome, firefox, phantomjs or http. http fetches the page without
+# a browser; only for pages where the table is in the served HTML, and
+# only with extraction_mode 'source'.
+browser_choice = "phantomjs"
 phantom_log_path = dataname + '_phantomjs.log'
 # Database info:
 db_host = 'dataserve.local'
@@ -144,11 +166,29 @@ db_user = 'j'
 db_pass = ''
 db_name = 'mydb'
 db_dialect = 'mysql+pymysql'
+# wide: a table per bootstrap_list entry with a DATETIME and a column each.
+# ticks: one narrow table for every instrument, (instrument id, epoch ms,
+#        field id, value), keyed (clustered on MySQL) by instrument and time.
+#        Move existing wide tables over with --migrate-ticks.
+db_layout = 'wide'
+# Spool rows to a local SQLite file and write them to the database from a
+# background thread, so a slow or missing database never stops the scraping.
+db_spool = False
+spool_path = ''  # Empty means dataname + '_spool.db'.
+spool_batch = 500  # Max rows per database write when draining.
 # Page info:
-page_source_timeout = 5  # In seconds. Must be an integer.
+page_source_timeout = 5  # In seconds.
+page_load_timeout = 60  # In seconds, for each try at loading the page.
+db_write_timeout = 30  # In seconds.
+# A call still hung this many seconds after its timeout gets its driver
+# process killed (or its database connection dropped).
+watchdog_grace = 5
 browser_lifetime = 1680  # In seconds. 14400 is four hours.
+prewarm_lead = 60  # Start loading the replacement this long before lifetime.
 base_url = 'http://www.investing.com'
 url_string = base_url + '/rates-bonds/government-bond-spreads'
+# Time zone of the times on the page: GMT, UTC or any tz name such as
+# 'America/New_York'. They go to the database as UTC.
 web_tz = 'GMT'
 
 # Table info:
@@ -156,6 +196,65 @@ attribute = {'id': 'bonds'}
 time_col = "UTCTime"
 row_title_column = 'Country'  # Need this to know index column.
 refresh_rate = 10.5  # Minimum number of seconds between scrapes.
+# Poll faster while the table is busy and slower while it is quiet,
+# between refresh_floor and refresh_ceiling seconds. refresh_rate is where
+# it starts. Off means always refresh_rate.
+adaptive_refresh = False
+refresh_floor = 2.0
+refresh_ceiling = 60.0
+# Hours of operation, in market_tz. The browser is closed outside them.
+# A list of (weekdays, open, close) with 0 as Monday and times as 'HH:MM'.
+# A close at or before the open is on the next day. Empty is always open.
+# FX, Sunday 22:00 to Friday 22:00 London time:
+# market_hours = [((6, 0, 1, 2, 3), '22:00', '22:00')]
+# market_tz = 'Europe/London'
+market_hours = []
+market_tz = 'UTC'
+table_extractor = 'lxml'  # lxml or html5lib. lxml falls back to html5lib.
+# source: pull all of page_source and parse it here.
+# script: read just the table inside the browser and get back JSON.
+# stream: a MutationObserver in the page buffers every changed row and the
+#         buffer is drained every stream_interval seconds.
+extraction_mode = 'source'
+# Save every page_source snapshot to this gzipped capture file so the
+# pipeline can be replayed offline. (CFDbench.py replay) Empty is off.
+record_path = ''
+# Also keep every changed row in Parquet (or Arrow IPC) files under this
+# directory, one folder per table and UTC day, for history queries that
+# shouldn't touch the database. Needs pyarrow. Empty is off.
+archive_path = ''
+archive_format = 'parquet'  # parquet or arrow.
+archive_compression = 'zstd'  # zstd, lz4 or none; parquet: snappy, gzip too.
+archive_flush_rows = 10000  # Write a table's segment at this many rows,
+archive_flush_seconds = 300  # or once its oldest buffered row is this old.
+# Rows per table kept while the archive can't be written. Past this the
+# oldest are dropped and counted as archive_dropped.
+archive_max_rows = 100000
+stream_interval = 1.0  # Seconds between drains in stream mode.
+stream_resync = 60  # Seconds between full table reads in stream mode.
+# Browsers per feed. More than one runs them side by side on the same page,
+# serves from whichever is freshest and replaces any that go stale.
+browser_redundancy = 1
+stale_after = 120  # Seconds a table may sit still while another moves.
+# Most memory (RSS, in MB) the browser processes serving this feed may use
+# before the heaviest one is recycled. 0 is no limit. See also
+# --max-browser-rss for all of them together.
+browser_rss_budget = 0
+# Requests the browser shouldn't make. They are sent through a small
+# filtering proxy in this process that counts what it blocks.
+# block_hosts also blocks subdomains ('doubleclick.net' takes
+# 'ad.doubleclick.net' with it). block_urls are shell patterns on the whole
+# URL, like '*/ads/*'. block_types are any of image, font, media and
+# stylesheet. Only hosts can be seen in https traffic. The URL and type
+# rules apply to plain http, and image also turns images off in the
+# browser itself. Empty lists leave the browser alone.
+# block_hosts = ['doubleclick.net', 'googlesyndication.com',
+#                'google-analytics.com', 'googletagmanager.com',
+#                'googletagservices.com', 'scorecardresearch.com',
+#                'quantserve.com', 'facebook.net', 'twitter.com']
+block_hosts = []
+block_urls = []
+block_types = []
 
 # Table form:
 # bootstrap = (db_table_name,
@@ -181,42 +280,341 @@ bootstrap_list.sort()
 ###############################################################################
 ###############################################################################
 
+# Every name a config file may set. Anything a config leaves out falls back
+# to the defaults above.
+CONFIG_KEYS = ('dataname', 'logpath', 'chromepath', 'browser_choice',
+               'phantom_log_path', 'db_host', 'db_user', 'db_pass', 'db_name',
+               'db_dialect', 'db_layout', 'db_spool', 'spool_path',
+               'spool_batch',
+               'page_source_timeout', 'page_load_timeout', 'db_write_timeout',
+               'watchdog_grace', 'browser_lifetime', 'prewarm_lead',
+               'base_url', 'url_string', 'web_tz', 'attribute', 'time_col',
+               'row_title_column', 'refresh_rate', 'adaptive_refresh',
+               'refresh_floor', 'refresh_ceiling', 'market_hours',
+               'market_tz', 'table_extractor',
+               'extraction_mode', 'stream_interval', 'stream_resync',
+               'browser_redundancy', 'stale_after', 'browser_rss_budget',
+               'block_hosts', 'block_urls', 'block_types', 'record_path',
+               'archive_path', 'archive_format', 'archive_compression',
+               'archive_flush_rows', 'archive_flush_seconds',
+               'archive_max_rows', 'bootstrap_list')
+
+default_config_path = './CFDscraper.cfg'
+max_browsers = 2  # Browser processes shared by all feeds in one process.
+metrics_port = 0  # Serve metrics as JSON on localhost. 0 is off.
+metrics_path = ''  # Dump metrics as JSON to this file. Empty is off.
+metrics_interval = 10  # Seconds between dumps.
+quotes_port = 0  # Serve the latest row of every table on localhost. 0 is off.
+ticks_socket = ''  # Unix socket to stream changed rows to. Empty is off.
+max_browser_rss = 0  # MB all browser processes may use together. 0 is off.
+supervise_interval = 10  # Seconds between looks at them. 0 is off.
+orphan_grace = 120  # Seconds a child that isn't a known driver may live.
+# Seconds before a feed that failed is tried again. Doubles with each
+# failure in a row, up to an hour.
+feed_retry = 30
+
 
-def import_config():
+CONFIG_CHOICES = {'browser_choice': ('chrome', 'firefox', 'phantomjs', 'http'),
+                  'db_layout': ('wide', 'ticks'),
+                  'table_extractor': ('lxml', 'html5lib'),
+                  'extraction_mode': ('source', 'script', 'stream'),
+                  'archive_format': ('parquet', 'arrow')}
+ARCHIVE_COMPRESSIONS = {'parquet': ('zstd', 'lz4', 'snappy', 'gzip', 'brotli',
+                                    'none'),
+                        'arrow': ('zstd', 'lz4', 'none')}
+CONFIG_POSITIVE = ('refresh_rate', 'refresh_floor', 'refresh_ceiling',
+                   'page_source_timeout', 'page_load_timeout',
+                   'db_write_timeout', 'browser_lifetime', 'spool_batch',
+                   'stream_interval', 'stream_resync', 'browser_redundancy',
+                   'archive_flush_rows', 'archive_flush_seconds',
+                   'archive_max_rows')
+CONFIG_NOT_NEGATIVE = ('watchdog_grace', 'prewarm_lead', 'stale_after',
+                       'browser_rss_budget')
+
+
+class Config(object):
     """
+    Holds one config file's settings as attributes. Each feed gets its own
+    so that any number of configs can share a process.
+
+    A config is checked when it is made. Every problem is reported at
+    once in a ValueError, at startup rather than during the first scrape.
+    The parts that only depend on the settings are compiled here, once:
+    plan (bootstrap_list as a CellPlan) and calendar (market_hours).
+    Whoever changes settings afterwards should call check() again.
     """
-    if len(sys.argv) > 1:
-        filename = sys.argv[1]
-        print("loading config file:" + sys.argv[1])
-    else:
-        filename = './CFDscraper.cfg'
-    exec(compile(open(filename, "rb").read(), filename, 'exec'),
-         globals(),
-         globals())  # Force import to global namespace.
+    def __init__(self, namespace, filename=None):
+        for key in CONFIG_KEYS:
+            setattr(self, key, namespace[key])
+        self.filename = filename
+        self.plan = None
+        self.calendar = None
+        problems = self.check()
+        if problems:
+            raise ValueError("Bad config %s:\n  %s" %
+                             (filename or self.dataname,
+                              "\n  ".join(problems)))
+
+    def __repr__(self):
+        return "Config(%r)" % self.dataname
+
+    def check(self):
+        """
+        Compiles plan and calendar and returns a list of what is wrong.
+        """
+        problems = []
+        for key, choices in CONFIG_CHOICES.items():
+            value = getattr(self, key)
+            if key == 'browser_choice':  # Browser doesn't mind the case.
+                value = str(value).lower()
+            if value not in choices:
+                problems.append("%s must be one of %s, not %r." %
+                                (key, ", ".join(choices), getattr(self, key)))
+        for key in CONFIG_POSITIVE + CONFIG_NOT_NEGATIVE:
+            value = getattr(self, key)
+            if (not isinstance(value, (int, float)) or value < 0 or
+                    (value == 0 and key in CONFIG_POSITIVE)):
+                problems.append("%s must be a number above 0%s, not %r." %
+                                (key, " or 0" if key in CONFIG_NOT_NEGATIVE
+                                 else "", value))
+        if (str(self.browser_choice).lower() == 'http' and
+                self.extraction_mode in ('script', 'stream')):
+            problems.append("extraction_mode %r runs in a browser. Use "
+                            "'source' with browser_choice 'http'." %
+                            self.extraction_mode)
+        if (self.adaptive_refresh and not problems and
+                self.refresh_floor > self.refresh_ceiling):
+            problems.append("refresh_floor is above refresh_ceiling.")
+        compressions = ARCHIVE_COMPRESSIONS.get(self.archive_format, ())
+        if compressions and self.archive_compression not in compressions:
+            problems.append("archive_compression for %s must be one of %s, "
+                            "not %r." % (self.archive_format,
+                                         ", ".join(compressions),
+                                         self.archive_compression))
+        unknown = set(self.block_types) - set(RESOURCE_TYPES)
+        if unknown:
+            problems.append("block_types can only have %s, not %s." %
+                            (", ".join(sorted(RESOURCE_TYPES)),
+                             ", ".join(sorted(unknown))))
+        if not isinstance(self.attribute, dict):
+            problems.append("attribute must be a dict like {'id': 'bonds'}.")
+        try:
+            day_anchor(self.web_tz)
+        except ValueError as error:
+            problems.append(str(error))
+        try:
+            self.calendar = MarketCalendar(self.market_hours, self.market_tz)
+        except Exception as error:
+            problems.append("market_hours or market_tz: %s" % error)
+        bootstrap_problems = self.check_bootstrap()
+        if not bootstrap_problems:
+            self.plan = CellPlan(self.bootstrap_list, self.time_col,
+                                 self.row_title_column)
+        return problems + bootstrap_problems
+
+    def check_bootstrap(self):
+        """
+        Makes sure bootstrap_list has the form the tables and CellPlan
+        rely on. See "Table form" above.
+        """
+        if not self.bootstrap_list:
+            return ["bootstrap_list is empty."]
+        problems = []
+        names = set()
+        for entry in self.bootstrap_list:
+            try:
+                name, columns = entry
+                cells = [(column, row_label, col_label)
+                         for column, row_label, col_label in columns]
+            except (TypeError, ValueError):
+                problems.append("%r is not (table, ((column, row, col), "
+                                "...))." % (entry,))
+                continue
+            if name in names:
+                problems.append("Table %s is in bootstrap_list twice." % name)
+            names.add(name)
+            if not cells or cells[0][0] != self.time_col:
+                problems.append("The first column of %s must be %s." %
+                                (name, self.time_col))
+            if len(set(cell[0] for cell in cells)) != len(cells):
+                problems.append("%s has a column name twice." % name)
+        return problems
 
-import_config()  # This needs to happen before the logger gets set up.
+
+def import_config(filename=default_config_path):
+    """
+    Execs a config file into a fresh namespace seeded with the defaults
+    above and returns it as a Config object. Nothing is written to
+    globals() anymore.
+    """
+    logger.info("Loading config file: " + filename)
+    namespace = dict((key, globals()[key]) for key in CONFIG_KEYS)
+    namespace['bootstrap_list'] = list(bootstrap_list)
+    exec(compile(open(filename, "rb").read(), filename, 'exec'), namespace)
+    return Config(namespace, filename)
 
 
 ######## Set up logging  ######################################################
 logger = logging.getLogger('CFDscraper')  # Or __name__
 logger.setLevel(logging.DEBUG)
-# Create file handler which logs even debug messages.
-file_hand = logging.handlers.RotatingFileHandler(logpath,
-                                                 maxBytes=10000,
-                                                 backupCount=2)
-file_hand.setLevel(logging.ERROR)  # Set logging level here.
-# Create console handler with a higher log level.
-console_hand = logging.StreamHandler()
-console_hand.setLevel(logging.ERROR)  # Set logging level here. Normally INFO
-# Create formatter and add it to the handlers.
-form_string = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-formatter = logging.Formatter(form_string)
-formatter2 = logging.Formatter('%(message)s')
-console_hand.setFormatter(formatter2)
-file_hand.setFormatter(formatter)
-# Add the handlers to logger.
-logger.addHandler(console_hand)
-logger.addHandler(file_hand)
+
+
+def setup_logging(logpath):
+    """
+    Attaches the file and console handlers. Called once the first config
+    is loaded since that is where logpath comes from.
+    """
+    # Create file handler which logs even debug messages.
+    file_hand = logging.handlers.RotatingFileHandler(logpath,
+                                                     maxBytes=10000,
+                                                     backupCount=2)
+    file_hand.setLevel(logging.ERROR)  # Set logging level here.
+    # Create console handler with a higher log level.
+    console_hand = logging.StreamHandler()
+    console_hand.setLevel(logging.ERROR)  # Set logging level here.
+    # Create formatter and add it to the handlers.
+    form_string = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    formatter = logging.Formatter(form_string)
+    formatter2 = logging.Formatter('%(message)s')
+    console_hand.setFormatter(formatter2)
+    file_hand.setFormatter(formatter)
+    # Add the handlers to logger.
+    logger.addHandler(console_hand)
+    logger.addHandler(file_hand)
+    # Don't make records for messages no handler will emit.
+    logger.setLevel(min(file_hand.level, console_hand.level))
+
+
+######## Metrics ##############################################################
+class Metrics(object):
+    """
+    Stage timings, counters and gauges for every feed in the process. Each
+    (feed, stage) keeps its last `window` timings; percentiles are only
+    worked out when a snapshot is asked for. The spool drainer and the
+    exporters run in threads, so everything goes through one lock.
+
+    feed is the feed whose cycle is running. Feed.cycle() sets it so the
+    browser and parsing code can count things without being told whose
+    they are.
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.feed = ''
+        self.timings = {}  # (feed, stage): [total count, deque of seconds]
+        self.counters = {}  # (feed, name): count
+        self.gauges = {}  # (feed, name): latest value
+        self.start_time = time()
+
+    def observe(self, stage, seconds, feed=None):
+        key = (self.feed if feed is None else feed, stage)
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = [0, deque(maxlen=self.window)]
+            timing[0] += 1
+            timing[1].append(seconds)
+
+    def count(self, name, n=1, feed=None):
+        key = (self.feed if feed is None else feed, name)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, value, feed=None):
+        key = (self.feed if feed is None else feed, name)
+        with self.lock:
+            self.gauges[key] = value
+
+    def snapshot(self):
+        """
+        Returns everything as a dict ready for json.dumps(). Times are ms.
+        """
+        with self.lock:
+            timings = [(key, count, sorted(recent))
+                       for key, (count, recent) in self.timings.items()]
+            counters = list(self.counters.items())
+            gauges = list(self.gauges.items())
+        feeds = {}
+        for (feed, stage), count, recent in timings:
+            size = len(recent)
+
+            def percentile(fraction):
+                return recent[min(int(size * fraction), size - 1)] * 1000
+
+            feeds.setdefault(feed, {'stages': {}, 'counters': {},
+                                    'gauges': {}})
+            feeds[feed]['stages'][stage] = {
+                'count': count,
+                'mean_ms': sum(recent) / size * 1000,
+                'p50_ms': percentile(0.50),
+                'p95_ms': percentile(0.95),
+                'p99_ms': percentile(0.99),
+                'max_ms': recent[-1] * 1000}
+        for (feed, name), count in counters:
+            feeds.setdefault(feed, {'stages': {}, 'counters': {},
+                                    'gauges': {}})
+            feeds[feed]['counters'][name] = count
+        for (feed, name), value in gauges:
+            feeds.setdefault(feed, {'stages': {}, 'counters': {},
+                                    'gauges': {}})
+            feeds[feed]['gauges'][name] = value
+        return {'time': time(), 'uptime': time() - self.start_time,
+                'feeds': feeds}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1, sort_keys=True)
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.to_json().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Don't scribble on the status line.
+
+
+def serve_metrics(port):
+    """
+    Serves metrics.snapshot() as JSON at http://127.0.0.1:port/ from a
+    background thread.
+    """
+    server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name="MetricsServer")
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on port %d.", port)
+    return server
+
+
+def dump_metrics(path, interval):
+    """
+    Writes metrics.snapshot() as JSON to path every interval seconds from
+    a background thread. Written to a temp file and renamed, so a reader
+    never sees half a file.
+    """
+    def dump_loop():
+        while True:
+            sleep(interval)
+            try:
+                with open(path + '.tmp', 'w') as dump:
+                    dump.write(metrics.to_json())
+                os.replace(path + '.tmp', path)
+            except:
+                logger.error("Can't write metrics to " + path, exc_info=1)
+
+    thread = threading.Thread(target=dump_loop, name="MetricsDump")
+    thread.daemon = True
+    thread.start()
+    return thread
 
 
 ###### Make timeout wrapper for pageloads and such ############################
@@ -224,26 +622,171 @@ class TimeoutError(Exception):
     pass
 
 
-def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
+class FeedError(Exception):
+    """
+    One feed can't go on: no table, no page, a time it can't read. main()
+    takes that feed's browser back and tries it again later. The other
+    feeds carry on.
+    """
+    pass
+
+
+class BrowserError(Exception):
+    """
+    A browser started in the background couldn't be opened.
+    """
+    pass
+
+
+class NoSuchWindowException(Exception):
+    """
+    Stands in for selenium's until import_selenium() replaces it, so the
+    except clauses that name it work before selenium is loaded.
+    """
+
+
+class DriverKilled(TimeoutError):
+    """
+    A call hung past its grace period and the watchdog killed whatever it
+    was waiting on. The driver (or connection) is gone.
+    """
+    pass
+
+
+def async_raise(thread_id, exception):
+    """
+    Raises exception (a class) in another thread the next time it runs
+    Python code. None takes back one that hasn't gone off yet.
+    """
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(thread_id),
+        None if exception is None else ctypes.py_object(exception))
+
+
+class Deadline(object):
+    __slots__ = ('thread_id', 'kill', 'message', 'stage', 'done')
+
+    def __init__(self, kill, message):
+        self.thread_id = threading.get_ident()
+        self.kill = kill
+        self.message = message
+        self.stage = 0  # 1 once interrupted, 2 once killed.
+        self.done = False
+
+
+class Watchdog(object):
+    """
+    Deadlines for blocking calls, from any thread. signal.alarm() only
+    worked in the main thread and only one at a time, which is what kept
+    everything else out of threads.
+
+    call() runs func in the calling thread and hands its deadline to one
+    monitor thread. At the deadline the monitor raises TimeoutError in the
+    calling thread. That only lands once the thread runs Python again,
+    which it won't while it sits in a socket read on a hung driver. So a
+    call still going grace seconds later gets kill() run for it (kill the
+    driver process, drop the connection), which breaks the socket, and
+    the call raises DriverKilled.
+    """
+    def __init__(self, grace=5):
+        self.grace = grace
+        self.cond = threading.Condition()
+        self.deadlines = []  # Heap of (time, sequence, Deadline).
+        self.sequence = 0
+        self.thread = None
+
+    def call(self, seconds, func, args=(), kwargs=None, kill=None,
+             grace=None, message=None):
+        deadline = Deadline(kill, message or "%s timed out." % func.__name__)
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name="Watchdog")
+                self.thread.daemon = True
+                self.thread.start()
+            self.push(time() + seconds, deadline)
+            if kill is not None:
+                self.push(time() + seconds + (self.grace if grace is None
+                                              else grace), deadline)
+            self.cond.notify()
+        try:
+            return func(*args, **(kwargs or {}))
+        except TimeoutError:
+            if deadline.stage == 2:
+                raise DriverKilled(deadline.message)
+            if deadline.stage == 1:  # Ours. It comes without a message.
+                raise TimeoutError(deadline.message)
+            raise
+        except Exception:
+            if deadline.stage == 2:  # Failed because we killed it.
+                raise DriverKilled(deadline.message)
+            raise
+        finally:
+            deadline.done = True
+            with self.cond:
+                if deadline.stage:
+                    async_raise(deadline.thread_id, None)
+
+    def push(self, when, deadline):
+        self.sequence += 1
+        heapq.heappush(self.deadlines, (when, self.sequence, deadline))
+
+    def run(self):
+        with self.cond:
+            while True:
+                if not self.deadlines:
+                    self.cond.wait()
+                    continue
+                when, sequence, deadline = self.deadlines[0]
+                wait = when - time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                heapq.heappop(self.deadlines)
+                if deadline.done:
+                    continue
+                if deadline.stage == 0:
+                    deadline.stage = 1
+                    logger.error("Watchdog: %s Interrupting.",
+                                 deadline.message)
+                    metrics.count('interrupts')
+                    async_raise(deadline.thread_id, TimeoutError)
+                else:
+                    deadline.stage = 2
+                    logger.error("Watchdog: %s Still hung. Killing.",
+                                 deadline.message)
+                    metrics.count('kills')
+                    killer = threading.Thread(target=self.kill,
+                                              args=(deadline,),
+                                              name="WatchdogKill")
+                    killer.daemon = True
+                    killer.start()
+
+    def kill(self, deadline):
+        try:
+            deadline.kill()
+        except:
+            logger.error("Watchdog kill failed.", exc_info=1)
+
+
+watchdog = Watchdog()
+
+
+def timeout(seconds=10, error_message=os.strerror(errno.ETIME), kill=None,
+            grace=None):
     """
     Timeout wrapper.
     From:
     http://stackoverflow.com/questions/2281850/
     timeout-function-if-it-takes-too-long-to-finish?lq=1
+    That one used signal.alarm(). This goes through the watchdog, so it
+    works in any thread. kill is called if the wrapped call is still hung
+    grace seconds after the timeout.
     """
     def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError(error_message)
-        #@wraps(func)
-
         def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
+            return watchdog.call(seconds, func, args, kwargs, kill=kill,
+                                 grace=grace, message=error_message)
 
         return wraps(func)(wrapper)
 
@@ -252,21 +795,24 @@ def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
 
 ###############################################################################
 ######## Open database and check that it can be reached #######################
-def db_setup():
+engines = {}  # connect string -> (engine, metadata, conn). Shared by feeds.
+
+
+def db_setup(cfg):
     """
-    Connects to the database using SQLalchemy-core. This is the only
-    function that is called outside of main().
+    Connects to the database using SQLalchemy-core. Feeds that point at the
+    same database get the same engine, and so the same connection pool.
     """
     # print("Enter password for " + db_user + "@" + db_host + ":")
+    connect_string = (cfg.db_dialect + '://' +
+                      cfg.db_user + ':' +
+                      cfg.db_pass + '@' +
+                      cfg.db_host + '/' +
+                      cfg.db_name)
+    if connect_string in engines:
+        return engines[connect_string]
 
     logger.info('Connecting to database.')
-
-    connect_string = (db_dialect + '://' +
-                      db_user + ':' +
-                      db_pass + '@' +
-                      db_host + '/' +
-                      db_name)
-
     try:
         engine = create_engine(connect_string,
                                echo=False,
@@ -278,42 +824,388 @@ def db_setup():
         logger.error('ERROR: Database not reachable. Exiting', exc_info=1)
         sys.exit()
 
+    engines[connect_string] = (engine, metadata, conn)
     return engine, metadata, conn
 
 
+########## Request filtering ##################################################
+# File extensions and Content-Types of each kind in block_types.
+RESOURCE_TYPES = {
+    'image': (('.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg', '.ico',
+               '.bmp'), ('image/',)),
+    'font': (('.woff', '.woff2', '.ttf', '.otf', '.eot'),
+             ('font/', 'application/font', 'application/x-font',
+              'application/vnd.ms-fontobject')),
+    'media': (('.mp4', '.webm', '.mp3', '.ogg', '.m4a', '.flv', '.swf'),
+              ('video/', 'audio/', 'application/x-shockwave-flash')),
+    'stylesheet': (('.css',), ('text/css',))}
+HOP_HEADERS = ('connection', 'keep-alive', 'proxy-connection',
+               'proxy-authorization', 'te', 'trailer', 'transfer-encoding',
+               'upgrade')
+
+
+class ResourcePolicy(object):
+    """
+    A config's block_hosts, block_urls and block_types, compiled.
+    """
+    def __init__(self, hosts=(), urls=(), types=()):
+        self.hosts = set(host.lower().strip('.') for host in hosts)
+        self.url_pattern = None
+        if urls:
+            self.url_pattern = re.compile('|'.join(fnmatch.translate(url)
+                                                   for url in urls))
+        self.extensions = tuple(extension for kind in types
+                                for extension in RESOURCE_TYPES[kind][0])
+        self.content_types = tuple(content_type for kind in types
+                                   for content_type in RESOURCE_TYPES[kind][1])
+        self.images = 'image' in types
+
+    def blocks_host(self, host):
+        host = host.lower().rstrip('.')
+        while host:
+            if host in self.hosts:
+                return True
+            host = host.partition('.')[2]
+        return False
+
+    def blocks(self, url):
+        parts = urlsplit(url)
+        return (self.blocks_host(parts.hostname or '') or
+                (self.url_pattern is not None and
+                 self.url_pattern.match(url) is not None) or
+                parts.path.lower().endswith(self.extensions))
+
+    def blocks_type(self, content_type):
+        return (content_type or '').lower().startswith(self.content_types)
+
+
+class FilterHandler(BaseHTTPRequestHandler):
+    """
+    Proxies one browser connection's requests, unless the policy blocks
+    them. https comes as CONNECT and is tunnelled untouched, so only its
+    host is known. Plain http is fetched here, so its URL and Content-Type
+    are checked. A blocked request gets an empty 403.
+    Connections are kept alive on both sides, bodies are passed on as
+    they arrive (streams and long polls work) and Upgrade requests
+    (ws://) are tunnelled once their host is allowed.
+    """
+    timeout = 60
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.upstreams = {}  # (host, port): kept-alive HTTPConnection
+
+    def finish(self):
+        for upstream in self.upstreams.values():
+            upstream.close()
+        BaseHTTPRequestHandler.finish(self)
+
+    def do_CONNECT(self):
+        host, _, port = self.path.rpartition(':')
+        if self.server.policy.blocks_host(host):
+            self.refuse()
+            return
+        try:
+            upstream = socket.create_connection((host, int(port)), 30)
+        except (OSError, ValueError):
+            self.send_error(502)
+            return
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        metrics.count('requests_passed', feed=self.server.feed)
+        self.tunnel(upstream)
+
+    def tunnel(self, upstream):
+        sockets = [self.connection, upstream]
+        sent = 0
+        try:
+            while True:
+                readable = select_sockets(sockets, [], [], self.timeout)[0]
+                if not readable:
+                    break
+                for source in readable:
+                    data = source.recv(65536)
+                    if not data:
+                        return
+                    target = upstream if source is self.connection else (
+                        self.connection)
+                    target.sendall(data)
+                    sent += len(data)
+        except OSError:
+            pass
+        finally:
+            upstream.close()
+            self.close_connection = True
+            metrics.count('proxy_bytes', sent, self.server.feed)
+
+    def upgrade(self, parts, path):
+        """
+        Sends an Upgrade request (a websocket) on as it came, then
+        tunnels both ways: the 101 and the frames go straight through.
+        """
+        try:
+            upstream = socket.create_connection(
+                (parts.hostname, parts.port or 80), 30)
+            head = ['%s %s %s' % (self.command, path, self.request_version)]
+            head += ['%s: %s' % item for item in self.headers.items()
+                     if item[0].lower() != 'proxy-connection']
+            upstream.sendall(('\r\n'.join(head) + '\r\n\r\n').encode(
+                'latin-1'))
+        except OSError:
+            self.send_error(502)
+            return
+        metrics.count('requests_passed', feed=self.server.feed)
+        self.tunnel(upstream)
+
+    def do_GET(self):
+        policy = self.server.policy
+        # Read even if refused: left unread, the body would be taken for
+        # the next request on this connection.
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        if policy.blocks(self.path):
+            self.refuse()
+            return
+        parts = urlsplit(self.path)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if 'upgrade' in self.headers.get('Connection', '').lower():
+            self.upgrade(parts, path)
+            return
+        headers = dict((name, value) for name, value in self.headers.items()
+                       if name.lower() not in HOP_HEADERS)
+        key = (parts.hostname, parts.port or 80)
+        try:
+            upstream, response = self.forward(key, path, body, headers)
+        except (OSError, http.client.HTTPException):
+            self.send_error(502)
+            return
+        if policy.blocks_type(response.getheader('Content-Type')):
+            upstream.close()
+            self.refuse()
+            return
+        no_body = self.command == 'HEAD' or response.status in (204, 304)
+        skip = HOP_HEADERS if no_body else HOP_HEADERS + ('content-length',)
+        self.send_response(response.status, response.reason)
+        for name, value in response.getheaders():
+            if name.lower() not in skip:
+                self.send_header(name, value)
+        # Without a length the body is chunked, or ends when we close.
+        chunked = False
+        if no_body:
+            pass
+        elif response.length is not None:
+            self.send_header('Content-Length', str(response.length))
+        elif self.request_version == 'HTTP/1.1':
+            self.send_header('Transfer-Encoding', 'chunked')
+            chunked = True
+        else:
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        sent = self.relay(response, chunked)
+        if sent is None or response.will_close:
+            upstream.close()
+        else:
+            self.upstreams[key] = upstream
+        metrics.count('requests_passed', feed=self.server.feed)
+        metrics.count('proxy_bytes', sent or 0, self.server.feed)
+
+    def forward(self, key, path, body, headers):
+        """
+        Sends the request on the kept-alive connection to its host, or a
+        new one if there is none or the server has since closed it.
+        """
+        upstream = self.upstreams.pop(key, None)
+        if upstream is not None:
+            try:
+                upstream.request(self.command, path, body, headers)
+                return upstream, upstream.getresponse()
+            except (OSError, http.client.HTTPException):
+                upstream.close()
+        upstream = http.client.HTTPConnection(key[0], key[1], self.timeout)
+        try:
+            upstream.request(self.command, path, body, headers)
+            return upstream, upstream.getresponse()
+        except:
+            upstream.close()
+            raise
+
+    def relay(self, response, chunked):
+        """
+        Passes response's body on as it arrives. Returns how many bytes,
+        or None if either side went away partway.
+        """
+        sent = 0
+        try:
+            while True:
+                data = response.read1(65536)
+                if not data:
+                    break
+                if chunked:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                else:
+                    self.wfile.write(data)
+                self.wfile.flush()
+                sent += len(data)
+            response.close()  # Read to the end, so upstream can be reused.
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except (OSError, http.client.HTTPException):
+            self.close_connection = True
+            return None
+        return sent
+
+    do_POST = do_HEAD = do_PUT = do_DELETE = do_OPTIONS = do_GET
+
+    def refuse(self):
+        """
+        An empty 403. The connection is closed after it if the request
+        had a chunked body, which isn't read.
+        """
+        metrics.count('requests_blocked', feed=self.server.feed)
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            self.close_connection = True
+        self.send_response(403)
+        self.send_header('Content-Length', '0')
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FilterProxy(ThreadingHTTPServer):
+    """
+    One feed's filtering proxy on a free port of 127.0.0.1. Its browsers
+    are pointed at it when they start. It counts requests_blocked,
+    requests_passed and proxy_bytes for the feed.
+    """
+    daemon_threads = True
+
+    def __init__(self, policy, feed):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), FilterHandler)
+        self.policy = policy
+        self.feed = feed
+        self.port = self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever,
+                                  name="FilterProxy")
+        thread.daemon = True
+        thread.start()
+        logger.info("Filtering %s's requests on port %d.", feed, self.port)
+
+
+filter_proxies = {}  # dataname: FilterProxy
+filter_lock = threading.Lock()
+
+
+def filter_proxy(cfg):
+    """
+    Returns cfg's FilterProxy, started the first time it is asked for, or
+    None if cfg blocks nothing. Feeds sharing a browser get the policy of
+    the feed that started it.
+    """
+    if not (cfg.block_hosts or cfg.block_urls or cfg.block_types):
+        return None
+    with filter_lock:  # Spare browsers start in other threads.
+        proxy = filter_proxies.get(cfg.dataname)
+        if proxy is None:
+            proxy = filter_proxies[cfg.dataname] = FilterProxy(
+                ResourcePolicy(cfg.block_hosts, cfg.block_urls,
+                               cfg.block_types), cfg.dataname)
+    return proxy
+
+
 ########## Webdrivers class ###################################################
+def import_selenium():
+    global webdriver, DesiredCapabilities, NoSuchWindowException
+    if webdriver is None:
+        from selenium import webdriver
+        from selenium.common.exceptions import NoSuchWindowException
+        from selenium.webdriver.common.desired_capabilities import (
+            DesiredCapabilities)
+    return webdriver
+
+
+USER_AGENT = ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_1) " +
+              "AppleWebKit/534.34 (KHTML, like Gecko) " +
+              "Chrome/31.0.1650.63 Safari/534.34")
+
+
 class Browser(object):
     """
     Wrapper class for webdriver.
 
     Usage:
-    browser = Browser()
-    browser = Browser("phantomjs")  # Default is chrome, also firefox.
+    browser = Browser(cfg)
+    browser = Browser(cfg, "phantomjs")  # Default is cfg.browser_choice.
     browser.refresh()
+    browser.renew()
     browser.quit()
     browser.age()
     browser.type()
     browser.source()
 
+    A browser started with background=True raises BrowserError where
+    one in the main loop raises FeedError.
+
     TODO:
-    Move popup close and url load to separate functions.
     Make internal methods "private".
     """
-    def __init__(self, browser_type="chrome"):
-        self.browser_type = browser_type.lower()
+    def __init__(self, cfg, browser_type=None, background=False):
+        self.cfg = cfg
+        self.browser_type = (browser_type or cfg.browser_choice).lower()
+        self.background = background
+        self.windows = []  # BrowserWindows sharing this driver.
+        self.spare_lock = threading.Lock()
+        self.spare_thread = None
+        self.spare_result = None
+        self.spare_failures = 0
+        self.spare_retry = 0  # No spare is started before this time.
+        self.over_budget = False  # Set by the supervisor.
+        self.timed_source = timeout(cfg.page_source_timeout,
+                                    "page_source timed out.", self.kill,
+                                    cfg.watchdog_grace)(self.source_inner)
+        self.timed_script = timeout(cfg.page_source_timeout,
+                                    "Script timed out.", self.kill,
+                                    cfg.watchdog_grace)(self.script_inner)
         self.driver = self.new_driver(self.browser_type)
         self.start_time = time()
 
+    def kill(self):
+        kill_driver(self.driver)
+
+    def give_up(self, driver=None):
+        if driver is not None:
+            quit_driver(driver)
+        if self.background:
+            raise BrowserError("Can't open %s browser." % self.browser_type)
+        raise FeedError("Can't open %s browser." % self.browser_type)
+
     def new_driver(self, browser_type):
-        if browser_type == "chrome":
-            driver = self.new_chrome_driver()
-        elif browser_type == "firefox":
-            driver = self.new_firefox_driver()
-        elif browser_type == "phantomjs":
-            driver = self.new_phantomjs_driver()
-        else:
-            logger.critical("Invalid browser choice. Exiting")
-            clean_up(self)
+        """
+        Each new_*_driver registers its driver with the supervisor as soon
+        as it exists, before the page load. Until then the supervisor
+        knows a driver is starting and leaves unknown children alone.
+        """
+        import_selenium()
+        supervisor.opening(1)
+        try:
+            if browser_type == "chrome":
+                driver = self.new_chrome_driver()
+            elif browser_type == "firefox":
+                driver = self.new_firefox_driver()
+            elif browser_type == "phantomjs":
+                driver = self.new_phantomjs_driver()
+            else:
+                logger.critical("Invalid browser choice. Exiting")
+                self.give_up()
+        finally:
+            supervisor.opening(-1)
         self.start_time = time()
         return driver
 
@@ -334,39 +1226,27 @@ class Browser(object):
             options.add_argument('--disable-core-animation-plugins')
             options.add_argument('--disable-plugins')
             options.add_argument('--views-corewm-window-animations-disabled')
-            # options.add_argument('--disable-images')
+            proxy = filter_proxy(self.cfg)
+            if proxy is not None:
+                options.add_argument('--proxy-server=127.0.0.1:%d' %
+                                     proxy.port)
+                if proxy.policy.images:
+                    options.add_experimental_option('prefs', {
+                        'profile.managed_default_content_settings.images':
+                        2})
             # options.add_argument('--disable-javascript') # bad idea
             # list of switches: print(options.arguments)
             logger.info("Loading Chrome webdriver.")
-            driver = webdriver.Chrome(executable_path=chromepath,
+            driver = webdriver.Chrome(executable_path=self.cfg.chromepath,
                                       chrome_options=options)
+            supervisor.register(self, driver)
             logger.info("Loading webpage.")
         except:
-            logger.error("Can't open webdriver.", exc_info=1)
+            logger.critical("ERROR: Can't open webdriver.", exc_info=1)
+            self.give_up()
 
-        attempts = 0
-        while attempts < 10:
-            try:
-                logger.info("Loading webpage: " + url_string)
-                driver.get(url_string)
-                break
-            except:
-                attempts += 1
-                logger.error("Page load failed. Retrying.")
-                sleep(2)
-                # The TBs generated here are of little use.
-                # All the good stuff is inside phantomjs.
-                # logger.critical("Can't load webpage.", exc_info=1)
-                # clean_up(self)
-        if attempts == 10:
-            logger.critical("Page load re-try limit exceeded.")
-            clean_up(self)
-        try:
-            # browser.find_element_by_class_name("popupAdCloseIcon").click()
-            driver.find_element_by_partial_link_text("Continue").click()
-        except:
-            logger.error("ERROR: Can't close the popup.")
-            pass
+        self.load_url(driver, self.cfg.url_string)
+        self.close_popup(driver)
         return driver
 
     def new_firefox_driver(self):
@@ -379,8 +1259,17 @@ class Browser(object):
         ## Firefox profile object
         try:
             firefox_profile = webdriver.FirefoxProfile()
-            # Disable images
-            # firefox_profile.set_preference('permissions.default.image', 2)
+            proxy = filter_proxy(self.cfg)
+            if proxy is not None:
+                firefox_profile.set_preference('network.proxy.type', 1)
+                for scheme in ('http', 'ssl'):
+                    firefox_profile.set_preference('network.proxy.' + scheme,
+                                                   '127.0.0.1')
+                    firefox_profile.set_preference(
+                        'network.proxy.%s_port' % scheme, proxy.port)
+                if proxy.policy.images:  # Disable images
+                    firefox_profile.set_preference('permissions.default.image',
+                                                   2)
             # Diasble flash
             firefox_profile.set_preference(
                 'dom.ipc.plugins.enabled.libflashplayer.so', 'false')
@@ -392,28 +1281,13 @@ class Browser(object):
             firefox_profile.set_preference('plugin.state.flash', 0)
             logger.info("Loading FireFox webdriver.")
             driver = webdriver.Firefox(firefox_profile)
+            supervisor.register(self, driver)
         except:
             logger.critical("ERROR: Can't open browser.", exc_info=1)
-            clean_up(self)
+            self.give_up()
 
-        attempts = 0
-        while attempts < 10:
-            try:
-                logger.info("Loading webpage: " + url_string)
-                driver.get(url_string)
-                break
-            except:
-                attempts += 1
-                logger.error("Page load failed. Retrying.")
-                sleep(2)
-                # logger.critical("Can't load webpage.", exc_info=1)
-                # clean_up(self)
-
-        try:
-            driver.find_element_by_partial_link_text("Continue").click()
-        except:
-            logger.error("ERROR: Can't close popup.")
-            pass
+        self.load_url(driver, self.cfg.url_string)
+        self.close_popup(driver)
         return driver
 
     def new_phantomjs_driver(self):
@@ -442,57 +1316,204 @@ class Browser(object):
         # (KHTML, like Gecko) PhantomJS/1.9.2 Safari/534.34"
         # https://github.com/ariya/phantomjs/issues/11156
         # Set the user agent string to something less robotronic:
-        user_agent = ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_1) " +
-                      "AppleWebKit/534.34 (KHTML, like Gecko) " +
-                      "Chrome/31.0.1650.63 Safari/534.34")
         dcap = dict(DesiredCapabilities.PHANTOMJS)
-        dcap["phantomjs.page.settings.userAgent"] = user_agent
+        dcap["phantomjs.page.settings.userAgent"] = USER_AGENT
         service_args = ['--debug=false',
                         '--ignore-ssl-errors=true'
                         ]  # Set phantomjs command line options here.
+        proxy = filter_proxy(self.cfg)
+        if proxy is not None:
+            service_args += ['--proxy=127.0.0.1:%d' % proxy.port,
+                             '--proxy-type=http']
+            if proxy.policy.images:
+                service_args.append('--load-images=false')
 
         try:
             logger.info("Loading PhantomJS webdriver.")
-            driver = webdriver.PhantomJS(executable_path="phantomjs",
-                                         desired_capabilities=dcap,
-                                         service_log_path=phantom_log_path,
-                                         service_args=service_args)
+            driver = webdriver.PhantomJS(
+                executable_path="phantomjs",
+                desired_capabilities=dcap,
+                service_log_path=self.cfg.phantom_log_path,
+                service_args=service_args)
+            supervisor.register(self, driver)
         except:
             logger.critical("ERROR: Can't open browser.", exc_info=1)
-            clean_up(self)
+            self.give_up()
 
         driver.set_window_size(1024, 768)
 
+        self.load_url(driver, self.cfg.url_string)
+        self.close_popup(driver)
+        return driver
+
+    def load_url(self, driver, url):
+        """
+        Loads url in the driver's current window, retrying up to ten times.
+        """
         attempts = 0
         while attempts < 10:
             try:
-                logger.info("Loading webpage: " + url_string)
-                driver.get(url_string)
+                logger.info("Loading webpage: " + url)
+                start = time()
+                watchdog.call(self.cfg.page_load_timeout, driver.get, (url,),
+                              kill=lambda: kill_driver(driver),
+                              grace=self.cfg.watchdog_grace,
+                              message="Page load timed out.")
+                metrics.observe('page_load', time() - start,
+                                self.cfg.dataname)
                 break
+            except DriverKilled:
+                logger.critical("Page load hung. Driver killed.")
+                self.give_up(driver)
             except:
                 attempts += 1
                 logger.error("Page load failed. Retrying.")
                 sleep(2)
+                # The TBs generated here are of little use.
+                # All the good stuff is inside phantomjs.
                 # logger.critical("Can't load webpage.", exc_info=1)
                 # clean_up(self)
+        if attempts == 10:
+            logger.critical("Page load re-try limit exceeded.")
+            self.give_up(driver)
 
+    def close_popup(self, driver):
+        """
+        Clicks through the "Continue" popup in the driver's current window.
+        """
         try:
+            # browser.find_element_by_class_name("popupAdCloseIcon").click()
             driver.find_element_by_partial_link_text("Continue").click()
         except:
-            logger.error("ERROR: Can't close popup.")
-            tempname = str(uuid.uuid4()) + '.png'
-            driver.save_screenshot(tempname)
-            logger.error("Screenshot: " + tempname)
+            logger.error("ERROR: Can't close the popup.")
+            metrics.count('popup_failures')
+            if self.browser_type == "phantomjs":
+                tempname = str(uuid.uuid4()) + '.png'
+                driver.save_screenshot(tempname)
+                logger.error("Screenshot: " + tempname)
 
-        return driver
+    def open_window(self, driver, url):
+        """
+        Opens a new window in driver, loads url in it and returns its
+        handle.
+        """
+        driver.execute_script("window.open('about:blank');")
+        handle = driver.window_handles[-1]
+        driver.switch_to_window(handle)
+        self.load_url(driver, url)
+        self.close_popup(driver)
+        return handle
 
-    def refresh(self):
-        """ """
+    def renew(self, force=False):
+        """
+        Replaces the driver without a gap in the data. Called every cycle.
+        prewarm_lead seconds before browser_lifetime is up (or right away
+        if force or over_budget), a spare driver is started in a background
+        thread. It
+        loads every window's page. Once each page shows the table, the
+        spare is swapped in and only then is the old driver quit, also in
+        the background. refresh() is still there for when the driver is
+        already broken and we can't wait. A spare that fails is tried
+        again after prewarm_lead seconds (at least 10), doubling each time.
+        """
+        with self.spare_lock:
+            result, self.spare_result = self.spare_result, None
+        if result is not None:
+            self.spare_thread = None
+            if result is False:
+                self.spare_failures += 1
+                delay = min(max(self.cfg.prewarm_lead, 10) *
+                            2 ** (self.spare_failures - 1),
+                            self.cfg.browser_lifetime)
+                self.spare_retry = time() + delay
+                logger.error("Spare browser failed. Will try again in %ds.",
+                             delay)
+            else:
+                self.spare_failures = 0
+                self.swap(*result)
+                return
+        if self.spare_thread is not None or time() < self.spare_retry:
+            return
+        lifetime = self.cfg.browser_lifetime - self.cfg.prewarm_lead
+        if force or self.over_budget or self.age() > lifetime:
+            logger.info("Starting spare browser.")
+            self.over_budget = False
+            self.spare_thread = threading.Thread(target=self.spare_worker,
+                                                 name="SpareBrowser")
+            self.spare_thread.daemon = True
+            self.spare_thread.start()
+
+    def spare_worker(self):
+        """
+        Builds the spare driver and checks that every page has its table.
+        Runs in its own thread so it can't touch the main loop's driver.
+        """
         try:
-            self.driver.quit()
-        except:
-            logger.error("ERROR: Browser process won't die.", exc_info=1)
+            spare = Browser(self.cfg, self.browser_type, background=True)
+            driver = spare.driver
+            pages = [(None, self.cfg, driver.current_window_handle)]
+            for window in list(self.windows):
+                if window.cfg is self.cfg:
+                    pages.append((window, window.cfg, pages[0][2]))
+                else:
+                    pages.append((window, window.cfg,
+                                  spare.open_window(driver,
+                                                    window.cfg.url_string)))
+            for window, cfg, handle in pages:
+                driver.switch_to_window(handle)
+                cells = spare.timed_script(TABLE_CELLS_JS,
+                                           table_selector(cfg.attribute))
+                if cells is None:
+                    raise BrowserError("Spare browser has no table for " +
+                                       cfg.dataname)
+            handles = dict((window, handle) for window, cfg, handle in pages
+                           if window is not None)
+            result = (spare, handles)
+        except Exception:
+            logger.error("Can't start spare browser.", exc_info=1)
+            try:
+                spare.quit()
+            except:
+                pass
+            result = False
+        with self.spare_lock:
+            self.spare_result = result
+
+    def swap(self, spare, handles):
+        """
+        Puts the spare's driver in service and quits the old one in the
+        background.
+        """
+        logger.info("Swapping in spare browser.")
+        metrics.count('refreshes')
+        old_driver = self.driver
+        self.driver = spare.driver
+        supervisor.register(self, self.driver)
+        self.start_time = time()
+        for window in self.windows:
+            if window in handles:
+                window.handle = handles[window]
+                window.start_time = self.start_time
+            else:  # Window opened after the spare was started.
+                window.open()
+        quitter = threading.Thread(target=quit_driver, args=(old_driver,),
+                                   name="QuitBrowser")
+        quitter.daemon = True
+        quitter.start()
+
+    def refresh(self):
+        """
+        Restarts the driver and reopens every window that shared it.
+        """
+        metrics.count('refreshes')
+        quit_driver(self.driver)  # Killed if it won't quit.
         self.driver = self.new_driver(self.browser_type)
+        for window in self.windows:
+            if window.cfg is self.cfg:
+                window.handle = self.driver.current_window_handle
+                window.start_time = self.start_time
+            else:
+                window.open()
 
     def type(self):
         return self.browser_type
@@ -503,45 +1524,1074 @@ class Browser(object):
 
     def quit(self):
         self.driver.quit()
+        supervisor.forget(self.driver)
         return
 
     def source(self):
         logger.debug("Browser.source() called.")
+        self.html_source = self.guarded(self.timed_source)
+        return self.html_source
+
+    def table_cells(self, attribute):
+        """
+        Reads the table inside the browser. Returns the JSON string from
+        TABLE_CELLS_JS, or None if the table isn't there.
+        """
+        logger.debug("Browser.table_cells() called.")
+        return self.guarded(self.timed_script, TABLE_CELLS_JS,
+                            table_selector(attribute))
+
+    def guarded(self, timed_func, *args):
+        """
+        Calls one of the timed driver calls. A missing window or a time out
+        gets a refresh and one more try.
+        """
         try:
-            self.html_source = self.source_inner()
+            return timed_func(*args)
 
         except NoSuchWindowException:
             logger.error("Window missing.")
             self.refresh()
             try:
-                self.html_source = self.source_inner()
+                return timed_func(*args)
             except:
                 logger.critical("2nd try on source load failed.", exc_info=1)
-                clean_up(self)
+                raise FeedError("Can't get the page.")
         except TimeoutError:
             logger.error("Time limit exceeded for webdriver.page_source.")
+            metrics.count('timeouts')
             logger.error("Refreshing webdriver.")
             self.refresh()
             try:
-                self.html_source = self.source_inner()
+                return timed_func(*args)
             except:
                 logger.critical("2nd try on source load failed.", exc_info=1)
-                clean_up(self)
-        return self.html_source
+                raise FeedError("Can't get the page.")
 
-    @timeout(page_source_timeout)
     def source_inner(self):
         """
         Wrapper for browser.page_source so that it can be timed out if hung.
+        Called through self.timed_source, which carries the config's
+        page_source_timeout.
         """
         return self.driver.page_source  # Must be unbound method.
 
-###############################################################################
+    def watch_table(self, attribute):
+        """
+        Installs the MutationObserver from OBSERVER_JS on the table.
+        Returns False if the table or MutationObserver is missing.
+        """
+        logger.info("Installing table observer.")
+        return self.guarded(self.timed_script, OBSERVER_JS,
+                            table_selector(attribute))
 
+    def drain_ticks(self):
+        """
+        Returns the JSON string of rows the observer saw change since the
+        last drain, or None if there is no observer on the page.
+        """
+        return self.guarded(self.timed_script, DRAIN_JS)
 
-def setup_tables(bootstrap_list, metadata):
-    """
-    Creates needed tables in the database using bootstrap_list as guide.
+    def script_inner(self, script, *args):
+        return self.driver.execute_script(script, *args)
+
+
+class BrowserWindow(object):
+    """
+    One feed's window inside a Browser that other feeds share. It has the
+    same interface as Browser so the scraping functions can't tell them
+    apart. Refreshing a window only reloads that window; the driver itself
+    is restarted by Browser.refresh().
+    """
+    def __init__(self, browser, cfg, handle=None):
+        self.browser = browser
+        self.cfg = cfg
+        self.browser_type = browser.browser_type
+        self.timed_source = timeout(cfg.page_source_timeout,
+                                    "page_source timed out.",
+                                    browser.kill,
+                                    cfg.watchdog_grace)(self.source_inner)
+        self.timed_script = timeout(cfg.page_source_timeout,
+                                    "Script timed out.", browser.kill,
+                                    cfg.watchdog_grace)(self.script_inner)
+        self.start_time = time()
+        if handle is None:
+            self.open()
+        else:
+            self.handle = handle
+        browser.windows.append(self)
+
+    def open(self):
+        """
+        Opens a new window in the shared driver and loads the feed's url.
+        """
+        self.handle = self.browser.open_window(self.browser.driver,
+                                               self.cfg.url_string)
+        self.start_time = time()
+
+    def refresh(self):
+        metrics.count('refreshes')
+        driver = self.browser.driver
+        try:
+            driver.switch_to_window(self.handle)
+            driver.close()
+        except:
+            logger.error("ERROR: Window won't close.", exc_info=1)
+        try:
+            self.open()
+        except:
+            logger.error("Can't reopen window. Restarting browser.",
+                         exc_info=1)
+            self.browser.refresh()
+
+    def renew(self, force=False):
+        """
+        The shared driver is renewed as a whole, windows and all.
+        """
+        self.browser.renew(force)
+
+    def type(self):
+        return self.browser_type
+
+    def age(self):
+        return time() - self.start_time
+
+    def quit(self):
+        if self in self.browser.windows:
+            self.browser.windows.remove(self)
+        driver = self.browser.driver
+        driver.switch_to_window(self.handle)
+        driver.close()
+
+    def source(self):
+        logger.debug("BrowserWindow.source() called.")
+        self.html_source = self.guarded(self.timed_source)
+        return self.html_source
+
+    def watch_table(self, attribute):
+        logger.info("Installing table observer.")
+        return self.guarded(self.timed_script, OBSERVER_JS,
+                            table_selector(attribute))
+
+    def drain_ticks(self):
+        return self.guarded(self.timed_script, DRAIN_JS)
+
+    def table_cells(self, attribute):
+        logger.debug("BrowserWindow.table_cells() called.")
+        return self.guarded(self.timed_script, TABLE_CELLS_JS,
+                            table_selector(attribute))
+
+    def guarded(self, timed_func, *args):
+        try:
+            return timed_func(*args)
+        except (NoSuchWindowException, TimeoutError) as error:
+            logger.error("Window missing or hung. Refreshing window.")
+            if isinstance(error, TimeoutError):
+                metrics.count('timeouts')
+            self.refresh()
+            try:
+                return timed_func(*args)
+            except:
+                logger.critical("2nd try on source load failed.", exc_info=1)
+                raise FeedError("Can't get the page.")
+
+    def source_inner(self):
+        """
+        Switches the shared driver to this window and grabs the source.
+        """
+        driver = self.browser.driver
+        driver.switch_to_window(self.handle)
+        return driver.page_source
+
+    def script_inner(self, script, *args):
+        driver = self.browser.driver
+        driver.switch_to_window(self.handle)
+        return driver.execute_script(script, *args)
+
+
+class BrowserGroup(object):
+    """
+    Several browsers on the same page for one feed. Has the Browser
+    interface. Issue #1: the investing.com page sometimes stops updating
+    with no error. One browser can't tell, but several can.
+
+    Every poll reads the table from each member. A member whose table
+    hasn't changed for stale_after seconds longer than the freshest
+    member's is stale. So is one that errors or loses the table. Stale
+    members are dropped at once and replaced from a background thread, so
+    a healthy member keeps serving while the new one loads. The freshest
+    member is served.
+
+    Members aren't restarted on a timer. If every member sits still for
+    browser_lifetime (a frozen page or a closed market), the oldest is
+    replaced, one at a time.
+
+    The serving member's page is parsed once: served_table keeps the
+    table its signature came from, and browser2table uses that. In stream
+    mode only the serving member is drained, so every stale_after
+    seconds drain_ticks() polls all of them first.
+    """
+    def __init__(self, cfg, size):
+        self.cfg = cfg
+        self.browser_type = cfg.browser_choice.lower()
+        self.members = []
+        self.signatures = {}
+        self.last_change = {}
+        try:
+            for _ in range(size):
+                self.adopt(Browser(cfg))
+        except:
+            self.quit()  # The ones that did open.
+            raise
+        self.serving = self.members[0]
+        self.ready = []  # Filled by replacement threads.
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.served = None  # Signature of what the serving member got.
+        self.served_table = None  # (page_source, attribute, table)
+        self.last_poll = time()
+        self.start_time = time()
+
+    def adopt(self, member):
+        self.members.append(member)
+        self.signatures[member] = None
+        self.last_change[member] = time()
+
+    def drop(self, member):
+        self.members.remove(member)
+        del self.signatures[member]
+        del self.last_change[member]
+
+    def replace(self, member, reason):
+        """
+        Takes member out of service and starts a replacement in the
+        background. The last member is never dropped.
+        """
+        if len(self.members) < 2:
+            logger.error("Only browser in group is %s. Refreshing.", reason)
+            member.refresh()
+            self.signatures[member] = None
+            self.last_change[member] = time()
+            return
+        logger.error("Browser is %s. Replacing in background.", reason)
+        metrics.count('replacements')
+        self.drop(member)
+        self.pending += 1
+        worker = threading.Thread(target=self.replace_worker, args=(member,),
+                                  name="BrowserReplace")
+        worker.daemon = True
+        worker.start()
+
+    def replace_worker(self, old):
+        if old is not None:
+            try:
+                old.quit()
+            except:
+                logger.error("ERROR: Browser process won't die.", exc_info=1)
+        try:
+            new = Browser(self.cfg, background=True)
+        except Exception:
+            logger.error("Replacement browser failed.", exc_info=1)
+            new = None
+        with self.lock:
+            self.ready.append(new)
+
+    def adopt_replacements(self):
+        with self.lock:
+            ready, self.ready = self.ready, []
+        for new in ready:
+            self.pending -= 1
+            if new is None:  # Failed. Try again.
+                self.pending += 1
+                worker = threading.Thread(target=self.replace_worker,
+                                          args=(None,),
+                                          name="BrowserReplace")
+                worker.daemon = True
+                worker.start()
+            else:
+                logger.info("Replacement browser in service.")
+                self.adopt(new)
+
+    def poll(self, fetch, signature):
+        """
+        Runs fetch(member) on every member, tracks when each one's
+        signature last changed and returns what the serving member got.
+        Its signature is left in served.
+        """
+        self.adopt_replacements()
+        now = self.last_poll = time()
+        results = {}
+        for member in list(self.members):
+            if (member.over_budget and self.pending == 0 and
+                    len(self.members) > 1):
+                member.over_budget = False
+                self.replace(member, "over its memory budget")
+                continue
+            try:
+                raw = fetch(member)
+                sig = signature(raw)
+            except Exception:
+                logger.error("Browser in group failed.", exc_info=1)
+                self.replace(member, "failing")
+                continue
+            if sig is None:
+                self.replace(member, "missing the table")
+                continue
+            if sig != self.signatures[member]:
+                self.signatures[member] = sig
+                self.last_change[member] = now
+            results[member] = raw, sig
+        if not results:
+            raise FeedError("No browser in group has the table.")
+
+        newest = max(self.last_change[member] for member in results)
+        for member in list(results):
+            lag = newest - self.last_change[member]
+            if lag > self.cfg.stale_after and len(results) > 1:
+                self.replace(member, "stale (%.0fs behind)" % lag)
+                del results[member]
+        if (now - newest > self.cfg.browser_lifetime and
+                self.pending == 0 and len(results) > 1):
+            oldest = min(results, key=lambda member: member.start_time)
+            self.replace(oldest, "still along with the rest")
+            del results[oldest]
+
+        if (self.serving not in results or
+                self.last_change[self.serving] < newest):
+            self.serving = max(results,
+                               key=lambda member: self.last_change[member])
+        raw, self.served = results[self.serving]
+        return raw
+
+    def source(self):
+        logger.debug("BrowserGroup.source() called.")
+        cfg = self.cfg
+        html_source = self.poll(
+            lambda member: member.timed_source(),
+            lambda html_source: extract_table(html_source, cfg.attribute,
+                                              cfg.table_extractor))
+        self.served_table = html_source, cfg.attribute, self.served
+        return html_source
+
+    def table_cells(self, attribute):
+        logger.debug("BrowserGroup.table_cells() called.")
+        selector = table_selector(attribute)
+        return self.poll(
+            lambda member: member.timed_script(TABLE_CELLS_JS, selector),
+            lambda cells: cells)
+
+    def watch_table(self, attribute):
+        return self.serving.watch_table(attribute)
+
+    def drain_ticks(self):
+        """
+        Polls every member when stale_after is up. If that puts another
+        member in service, None has TickStream read the whole table from
+        it and watch it instead.
+        """
+        if time() - self.last_poll > self.cfg.stale_after:
+            serving = self.serving
+            self.table_cells(self.cfg.attribute)
+            if self.serving is not serving:
+                logger.info("Serving another browser in group.")
+                return None
+        return self.serving.drain_ticks()
+
+    def refresh(self):
+        self.replace(self.serving, "slow")
+        self.serving = self.members[0]
+
+    def renew(self, force=False):
+        """
+        Members are replaced when they go stale, so only a slow poll
+        (force) replaces one here.
+        """
+        if force:
+            self.refresh()
+
+    def type(self):
+        return self.browser_type
+
+    def age(self):
+        """
+        Always 0. Members are replaced when they go stale, not on a timer.
+        """
+        return 0
+
+    def quit(self):
+        for member in self.members:
+            try:
+                member.quit()
+            except:
+                logger.critical("Browser process won't terminate.")
+        self.members = []
+
+
+class HttpFetcher(object):
+    """
+    Browserless page fetching for every http feed in the process. One
+    asyncio event loop runs in a background thread with one pooled
+    keep-alive aiohttp session. Each url is polled by its own task at its
+    feed's refresh_rate, so all the pages are fetched concurrently and
+    nobody waits on anybody. Requests are conditional (ETag and
+    Last-Modified), so an unchanged page costs a 304 and no body.
+
+    aiohttp is only imported when an http feed is configured.
+    """
+    def __init__(self, max_connections=20):
+        global aiohttp, asyncio
+        import asyncio
+        import aiohttp
+        self.loop = asyncio.new_event_loop()
+        self.pages = {}  # url -> dict of latest body, validators and stats.
+        self.tasks = {}
+        self.watchers = {}  # url -> how many browsers are watching it.
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="HttpFetcher")
+        self.thread.daemon = True
+        self.thread.start()
+        self.session = self.call(self.open_session(max_connections))
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call(self, coroutine, wait=None):
+        """
+        Runs coroutine on the fetcher's loop and waits for the result.
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        return future.result(wait)
+
+    async def open_session(self, max_connections):
+        connector = aiohttp.TCPConnector(limit=max_connections,
+                                         keepalive_timeout=60)
+        return aiohttp.ClientSession(connector=connector,
+                                     headers={'User-Agent': USER_AGENT})
+
+    def watch(self, url, interval, wait):
+        """
+        Starts polling url every interval seconds. A url watched by
+        several feeds is only fetched once, and keeps being fetched until
+        the last of them unwatches it.
+        """
+        with self.lock:
+            self.watchers[url] = self.watchers.get(url, 0) + 1
+            if url in self.tasks:
+                return
+            logger.info("Polling over http: " + url)
+            self.pages[url] = {'body': None, 'etag': None, 'modified': None,
+                               'fetched': 0, 'ready': threading.Event(),
+                               'fetches': 0, 'not_modified': 0}
+            self.tasks[url] = asyncio.run_coroutine_threadsafe(
+                self.poll(url, interval, wait), self.loop)
+
+    def unwatch(self, url, everyone=False):
+        with self.lock:
+            self.watchers[url] = self.watchers.get(url, 0) - 1
+            if self.watchers[url] > 0 and not everyone:
+                return
+            del self.watchers[url]
+            task = self.tasks.pop(url, None)
+        if task is not None:
+            task.cancel()
+
+    async def poll(self, url, interval, wait):
+        while True:
+            start = self.loop.time()
+            try:
+                await self.fetch(url, wait)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error("http fetch failed: " + url, exc_info=1)
+            elapsed = self.loop.time() - start
+            await asyncio.sleep(max(interval - elapsed, 0))
+
+    async def fetch(self, url, wait):
+        page = self.pages[url]
+        headers = {}
+        if page['etag']:
+            headers['If-None-Match'] = page['etag']
+        if page['modified']:
+            headers['If-Modified-Since'] = page['modified']
+        async with self.session.get(
+                url, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=wait)) as response:
+            page['fetches'] += 1
+            if response.status == 304 and page['body'] is not None:
+                page['not_modified'] += 1
+                page['fetched'] = time()
+                return
+            response.raise_for_status()
+            body = await response.text()
+            page['etag'] = response.headers.get('ETag')
+            page['modified'] = response.headers.get('Last-Modified')
+        page['body'] = body
+        page['fetched'] = time()
+        page['ready'].set()
+
+    def latest(self, url, wait):
+        """
+        Returns (body, time fetched) of the newest copy of url. Waits up to
+        wait seconds for the first fetch, then raises TimeoutError.
+        """
+        page = self.pages[url]
+        if not page['ready'].wait(wait):
+            raise TimeoutError("No http response from " + url)
+        return page['body'], page['fetched']
+
+    def close(self):
+        for url in list(self.tasks):
+            self.unwatch(url, everyone=True)
+        try:
+            self.call(self.session.close(), 5)
+        except:
+            logger.error("Can't close http session.", exc_info=1)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class HttpBrowser(object):
+    """
+    The Browser interface over HttpFetcher for browser_choice = "http".
+    source() hands back the newest fetched copy of the page. There is no
+    page script, so Config.check only allows source mode.
+    """
+    def __init__(self, fetcher, cfg):
+        self.fetcher = fetcher
+        self.cfg = cfg
+        self.browser_type = "http"
+        self.start_time = time()
+        fetcher.watch(cfg.url_string, cfg.refresh_rate,
+                      cfg.page_source_timeout)
+        self.watching = True
+
+    def source(self):
+        logger.debug("HttpBrowser.source() called.")
+        try:
+            body, fetched = self.fetcher.latest(self.cfg.url_string,
+                                                self.cfg.page_source_timeout)
+        except TimeoutError:
+            metrics.count('timeouts')
+            raise FeedError("Page never arrived over http.")
+        age = time() - fetched
+        if age > 3 * self.cfg.refresh_rate:
+            logger.error("http copy of page is %.0fs old.", age)
+        self.html_source = body
+        return body
+
+    def table_cells(self, attribute):
+        return None  # No browser to run the script in.
+
+    def watch_table(self, attribute):
+        return False
+
+    def drain_ticks(self):
+        return None
+
+    def refresh(self):
+        pass
+
+    def renew(self, force=False):
+        pass
+
+    def type(self):
+        return self.browser_type
+
+    def age(self):
+        return time() - self.start_time
+
+    def quit(self):
+        if self.watching:  # quit can come twice: clean_up, then close.
+            self.watching = False
+            self.fetcher.unwatch(self.cfg.url_string)
+
+
+class RecordingBrowser(object):
+    """
+    Wraps any browser and appends each page_source it returns to a capture
+    file: gzipped, one JSON object per line with the time and the source.
+    In script mode the table cells are recorded the same way, under
+    'cells'. Everything else goes straight to the wrapped browser.
+    """
+    def __init__(self, browser, path):
+        self.browser = browser
+        self.path = path
+        self.capture = gzip.open(path, 'at', encoding='utf-8')
+        logger.info("Recording page sources to " + path)
+
+    def __getattr__(self, name):
+        return getattr(self.browser, name)
+
+    def record(self, kind, value):
+        self.capture.write(json.dumps({'time': time(), kind: value}) + '\n')
+        self.capture.flush()
+
+    def source(self):
+        html_source = self.browser.source()
+        self.record('source', html_source)
+        return html_source
+
+    def table_cells(self, attribute):
+        cells = self.browser.table_cells(attribute)
+        if cells is not None:
+            self.record('cells', cells)
+        return cells
+
+    def close(self):
+        self.capture.close()
+
+    def quit(self):
+        self.close()
+        self.browser.quit()
+
+
+def read_records(path):
+    """
+    Yields (time, kind, value) from a capture file, kind being 'source'
+    or 'cells'. A record cut off by a crash ends the file quietly.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as capture:
+        try:
+            for line in capture:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                kind = 'cells' if 'cells' in record else 'source'
+                yield record['time'], kind, record[kind]
+        except (EOFError, IOError):
+            pass
+
+
+def read_captures(path):
+    """
+    Yields (time, page_source) from a capture file, skipping cells.
+    """
+    for record_time, kind, value in read_records(path):
+        if kind == 'source':
+            yield record_time, value
+
+
+class ReplayBrowser(object):
+    """
+    A browser stand-in that plays back a capture file. Each source() call
+    returns the next snapshot; past the end it raises EOFError. Set
+    realtime to sleep between snapshots as they were recorded.
+    table_cells() returns the next record if it is recorded cells, so a
+    script mode capture replays the way it was scraped.
+    """
+    def __init__(self, path, realtime=False):
+        self.path = path
+        self.realtime = realtime
+        self.captures = read_records(path)
+        self.pending = None  # Record looked at by table_cells, not used.
+        self.browser_type = "replay"
+        self.start_time = time()
+        self.last_record_time = None
+        self.snapshot_time = None
+
+    def next_record(self, kind):
+        """
+        Returns the next value of kind, or None if the next record is of
+        the other kind. Past the end it raises EOFError.
+        """
+        if self.pending is None:
+            self.pending = next(self.captures, None)
+            if self.pending is None:
+                raise EOFError("End of capture " + self.path)
+        record_time, record_kind, value = self.pending
+        if record_kind != kind:
+            return None
+        self.pending = None
+        if self.realtime and self.last_record_time is not None:
+            sleep(max(record_time - self.last_record_time, 0))
+        self.last_record_time = record_time
+        self.snapshot_time = record_time
+        return value
+
+    def source(self):
+        while True:
+            html_source = self.next_record('source')
+            if html_source is not None:
+                self.html_source = html_source
+                return html_source
+            self.pending = None  # Cells nobody asked for.
+
+    def table_cells(self, attribute):
+        return self.next_record('cells')
+
+    def watch_table(self, attribute):
+        return False
+
+    def drain_ticks(self):
+        return None
+
+    def refresh(self):
+        pass
+
+    def renew(self, force=False):
+        pass
+
+    def type(self):
+        return self.browser_type
+
+    def age(self):
+        return time() - self.start_time
+
+    def quit(self):
+        self.captures.close()
+
+
+class BrowserPool(object):
+    """
+    Hands out browser windows to feeds, opening at most max_browsers
+    driver processes. Feeds past that limit get a new window in whichever
+    browser of the right type has the fewest windows. This way memory grows
+    with the number of browsers rather than with the number of feeds.
+    Feeds with browser_redundancy above one get their own BrowserGroup,
+    which doesn't count against max_browsers. http feeds share one
+    HttpFetcher and no browser at all.
+    """
+    def __init__(self, max_browsers=max_browsers):
+        self.max_browsers = max_browsers
+        self.browsers = []
+        self.groups = []
+        self.http = None
+
+    def acquire(self, cfg):
+        if cfg.browser_choice.lower() == "http":
+            if self.http is None:
+                self.http = HttpFetcher()
+            return HttpBrowser(self.http, cfg)
+        if cfg.browser_redundancy > 1:
+            group = BrowserGroup(cfg, cfg.browser_redundancy)
+            self.groups.append(group)
+            return group
+        browser_type = cfg.browser_choice.lower()
+        candidates = [b for b in self.browsers
+                      if b.browser_type == browser_type]
+        if len(self.browsers) < self.max_browsers or not candidates:
+            if len(self.browsers) >= self.max_browsers:
+                logger.error("No %s browser in pool. Exceeding max_browsers.",
+                             browser_type)
+            browser = Browser(cfg, browser_type)
+            self.browsers.append(browser)
+            return BrowserWindow(browser, cfg,
+                                 handle=browser.driver.current_window_handle)
+        browser = min(candidates, key=lambda b: len(b.windows))
+        return BrowserWindow(browser, cfg)
+
+    def release(self, browser):
+        """
+        Gives back something acquire() handed out. A window that was the
+        last one in its driver takes the driver with it, so a closed
+        market doesn't keep a browser process around.
+        """
+        if browser in self.groups:
+            self.groups.remove(browser)
+        elif isinstance(browser, BrowserWindow):
+            shared = browser.browser
+            if shared.windows == [browser]:
+                self.browsers.remove(shared)
+                browser = shared
+        browser.quit()
+
+    def quit(self):
+        for browser in self.browsers + self.groups:
+            try:
+                browser.quit()
+            except:
+                logger.critical("Browser process won't terminate.")
+        self.browsers = []
+        self.groups = []
+        if self.http is not None:
+            self.http.close()
+            self.http = None
+
+
+############ Process supervision ##############################################
+PR_SET_CHILD_SUBREAPER = 36  # From linux/prctl.h.
+
+
+def read_proc_stat(pid):
+    """
+    Returns (state, parent pid, cpu ticks, rss pages, start ticks) from
+    /proc/<pid>/stat, or None if the process is gone.
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'rb') as stat:
+            data = stat.read()
+    except (IOError, OSError):
+        return None
+    # The command name is in parentheses and may hold anything, so count
+    # the fields from its end. fields[0] is field 3, state.
+    fields = data[data.rindex(b')') + 2:].split()
+    return (fields[0].decode(), int(fields[1]),
+            int(fields[11]) + int(fields[12]), int(fields[21]),
+            int(fields[19]))
+
+
+class ProcessSupervisor(object):
+    """
+    Issue #6: keeps an eye on every driver process the Browsers start and
+    on everything those start in turn (the browsers proper). Every
+    interval seconds it reads their RSS and CPU time from /proc and
+
+    - flags the heaviest browser over_budget when the browsers serving a
+      feed use more than its browser_rss_budget, or all of them together
+      more than max_rss MB. Flagged browsers recycle themselves the way
+      they do at browser_lifetime, spare first.
+    - kills what a dead or quit driver left behind. This process is made
+      the subreaper of its descendants, so those orphans come to it
+      instead of to init. Any child that isn't a known driver and is
+      older than orphan_grace is one.
+    - reaps zombie children.
+
+    The numbers go to metrics as gauges, per feed and in total. Linux
+    only. Elsewhere nothing is started.
+    """
+    cooldown = 300  # A browser younger than this isn't recycled again.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.drivers = {}  # Driver pid: the Browser using it.
+        self.starting = 0  # Drivers being created, not registered yet.
+        self.cpu = {}  # (pid, start ticks): (cpu ticks, time sampled)
+        self.max_rss = 0
+        self.orphan_grace = orphan_grace
+        self.thread = None
+
+    def register(self, browser, driver):
+        process = driver_process(driver)
+        if process is not None:
+            with self.lock:
+                self.drivers[process.pid] = browser
+
+    def opening(self, n):
+        with self.lock:
+            self.starting += n
+
+    def forget(self, driver):
+        process = driver_process(driver)
+        if process is not None:
+            with self.lock:
+                self.drivers.pop(process.pid, None)
+
+    def start(self, interval, max_rss=0, grace=orphan_grace):
+        if not os.path.isdir('/proc/self/task'):
+            logger.error("No /proc. Browser processes aren't supervised.")
+            return
+        self.max_rss = max_rss * 2 ** 20
+        self.orphan_grace = grace
+        self.pid = os.getpid()
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+                raise OSError(ctypes.get_errno(), "prctl failed")
+        except Exception:
+            logger.error("Can't become subreaper. Orphans of dead drivers "
+                         "go to init and can't be cleaned up.", exc_info=1)
+        self.thread = threading.Thread(target=self.run, args=(interval,),
+                                       name="ProcessSupervisor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, interval):
+        while True:
+            sleep(interval)
+            start = time()
+            try:
+                self.sample()
+            except:
+                logger.error("Supervisor sample failed.", exc_info=1)
+            metrics.observe('supervise', time() - start, '')
+
+    def processes(self):
+        table = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                stat = read_proc_stat(int(name))
+                if stat is not None:
+                    table[int(name)] = stat
+        return table
+
+    def sample(self):
+        table = self.processes()
+        children = {}
+        for pid, stat in table.items():
+            children.setdefault(stat[1], []).append(pid)
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        now = time()
+        with self.lock:
+            for pid in [pid for pid in self.drivers if pid not in table]:
+                del self.drivers[pid]  # Died. Its children are orphans.
+            drivers = dict(self.drivers)
+            starting = self.starting
+
+        usage = {}  # Browser: [rss bytes, cpu percent, processes]
+        cpu = {}
+        for pid, browser in drivers.items():
+            entry = usage.setdefault(browser, [0, 0.0, 0])
+            tree = [pid]
+            for member in tree:  # Grows as it goes.
+                tree.extend(children.get(member, ()))
+                state, parent, ticks, rss, started = table[member]
+                entry[0] += rss * self.page_size
+                entry[2] += 1
+                key = (member, started)
+                cpu[key] = (ticks, now)
+                if key in self.cpu:
+                    last_ticks, last_time = self.cpu[key]
+                    entry[1] += (100.0 * (ticks - last_ticks) /
+                                 self.clock_ticks / (now - last_time))
+        self.cpu = cpu
+
+        self.clean_up(children.get(self.pid, ()), table, drivers, children,
+                      uptime, starting)
+        self.enforce(usage)
+        self.export(usage)
+
+    def clean_up(self, mine, table, drivers, children, uptime,
+                 starting=0):
+        """
+        Reaps zombie children and kills orphans along with their own
+        children. While a driver is starting no child counts as an
+        orphan, since the new one isn't registered yet.
+        """
+        for pid in mine:
+            state, parent, ticks, rss, started = table[pid]
+            if state == 'Z':
+                try:
+                    os.waitpid(pid, os.WNOHANG)
+                    metrics.count('zombies_reaped', feed='')
+                except OSError:
+                    pass  # Someone else's wait() got it first.
+            elif (pid not in drivers and not starting and
+                  uptime - started / self.clock_ticks > self.orphan_grace):
+                logger.error("Killing orphaned browser process %d.", pid)
+                tree = [pid]
+                for member in tree:
+                    tree.extend(children.get(member, ()))
+                for member in reversed(tree):
+                    try:
+                        os.kill(member, signal.SIGKILL)
+                    except OSError:
+                        pass
+                metrics.count('orphans_killed', feed='')
+
+    def enforce(self, usage):
+        """
+        Flags the heaviest browser of each feed over its budget, and the
+        heaviest of all if they are over max_rss together.
+        """
+        feeds = {}  # Config: browsers serving it.
+        for browser in usage:
+            for cfg in browser_configs(browser):
+                feeds.setdefault(cfg, []).append(browser)
+        for cfg, browsers in feeds.items():
+            budget = cfg.browser_rss_budget * 2 ** 20
+            if budget and sum(usage[b][0] for b in browsers) > budget:
+                self.recycle(browsers, usage,
+                             "over the %s budget" % cfg.dataname)
+        if (self.max_rss and
+                sum(entry[0] for entry in usage.values()) > self.max_rss):
+            self.recycle(list(usage), usage, "over max_browser_rss")
+
+    def recycle(self, browsers, usage, reason):
+        """
+        Flags the heaviest of browsers, unless one of them is already
+        being recycled. Its spare takes a while to load and then the old
+        driver's memory is given back.
+        """
+        if any(browser.over_budget or
+               getattr(browser, 'spare_thread', None) is not None
+               for browser in browsers):
+            return
+        candidates = [browser for browser in browsers
+                      if browser.age() > self.cooldown]
+        if not candidates:
+            return
+        heaviest = max(candidates, key=lambda browser: usage[browser][0])
+        logger.error("Browser for %s at %d MB is %s. Recycling it.",
+                     heaviest.cfg.dataname, usage[heaviest][0] // 2 ** 20,
+                     reason)
+        metrics.count('budget_recycles', feed=heaviest.cfg.dataname)
+        heaviest.over_budget = True
+
+    def export(self, usage):
+        totals = {}  # dataname: [rss bytes, cpu percent, processes]
+        for browser, entry in usage.items():
+            for name in set(['']).union(cfg.dataname for cfg
+                                        in browser_configs(browser)):
+                total = totals.setdefault(name, [0, 0.0, 0])
+                for n in range(3):
+                    total[n] += entry[n]
+        totals.setdefault('', [0, 0.0, 0])
+        for name, (rss, cpu_percent, count) in totals.items():
+            metrics.gauge('browser_rss_mb', round(rss / 2.0 ** 20, 1), name)
+            metrics.gauge('browser_cpu_percent', round(cpu_percent, 1),
+                          name)
+            metrics.gauge('browser_processes', count, name)
+
+
+def browser_configs(browser):
+    """
+    The configs of every feed a Browser is serving.
+    """
+    configs = [browser.cfg]
+    for window in browser.windows:
+        if window.cfg not in configs:
+            configs.append(window.cfg)
+    return configs
+
+
+supervisor = ProcessSupervisor()
+
+###############################################################################
+
+
+class Row(object):
+    """
+    A data_row: the table name and its values in bootstrap_list column
+    order. columns is the table's tuple of column names, shared by every
+    Row for that table, so a row is one small object and one list.
+
+    CellPlan keeps one Row per table and fill_table() overwrites its
+    values every cycle rather than building new lists. Anything that has
+    to outlive the cycle takes a copy of values.
+    """
+    __slots__ = ('table', 'columns', 'values')
+
+    def __init__(self, table, columns, values=None):
+        self.table = table
+        self.columns = columns
+        if values is None:
+            values = [None] * len(columns)
+        self.values = values
+
+    def as_dict(self):
+        return dict(zip(self.columns, self.values))
+
+    def __eq__(self, other):
+        return (isinstance(other, Row) and self.table == other.table and
+                self.values == other.values)
+
+    __hash__ = None
+
+    def __repr__(self):
+        # Only runs when a handler emits the record, so log rows as
+        # logger.debug("...: %s", row) and never str(row).
+        return "Row(%r, %r)" % (self.table,
+                                list(zip(self.columns, self.values)))
+
+
+def setup_tables(bootstrap_list, metadata, time_col, layout='wide'):
+    """
+    Creates needed tables in the database using bootstrap_list as guide.
 
     TODO:
     Autoincrement isn't being set on the integer column.
@@ -550,33 +2600,354 @@ def setup_tables(bootstrap_list, metadata):
     There are ways around this but they seem like hacks that will not
     be portable to another database.
     Update: Now have two primary keys. Problem? Not sure.
+
+    Returns a dict of the Table objects by name so nobody has to make
+    (or reflect) them again.
+
+    SQLite can only autoincrement a lone INTEGER PRIMARY KEY, so there
+    id is the whole primary key. (SQLite is for replays and testing.)
+
+    With layout 'ticks' there are no per-instrument tables and a TickStore
+    is returned instead of the dict.
     """
+    if layout == 'ticks':
+        return TickStore(bootstrap_list, metadata, time_col)
     logger.info("Setting up database tables.")
+    time_in_key = metadata.bind.dialect.name != 'sqlite'
+    tables = {}
+    new_tables = []
     for entry in bootstrap_list:
+        if entry[0] in metadata.tables:  # Set up already on this database.
+            tables[entry[0]] = metadata.tables[entry[0]]
+            continue
         column_list = [row[0] for row in entry[1]]
-        Table(entry[0], metadata,
+        tables[entry[0]] = Table(entry[0], metadata,
               Column('id', Integer(),
                      nullable=False,
                      autoincrement=True,
                      primary_key=True),
               *((Column(time_col, DateTime(),
-                        primary_key=True,
+                        primary_key=time_in_key,
                         autoincrement=False,
                         nullable=False))
                 if colname == time_col
                 else (Column(colname, Float(), nullable=False))
                 for colname in column_list))
-    metadata.create_all()
+        new_tables.append(tables[entry[0]])
+    if new_tables:  # A restarted feed skips asking after every table.
+        metadata.create_all(tables=new_tables)
+    return tables
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MS = datetime.timedelta(milliseconds=1)
+
+
+def ticks_tables(metadata):
+    """
+    The instruments, fields and ticks tables of the narrow layout. Feeds
+    on the same database share metadata, so they are only defined once.
+    """
+    if 'ticks' in metadata.tables:
+        return (metadata.tables['instruments'], metadata.tables['fields'],
+                metadata.tables['ticks'])
+    instruments = Table('instruments', metadata,
+                        Column('id', Integer(), primary_key=True),
+                        Column('name', String(64), nullable=False,
+                               unique=True))
+    fields = Table('fields', metadata,
+                   Column('id', Integer(), primary_key=True),
+                   Column('name', String(64), nullable=False, unique=True))
+    ticks = Table('ticks', metadata,
+                  Column('instrument_id', Integer(), primary_key=True,
+                         autoincrement=False),
+                  Column('ts', BigInteger(), primary_key=True,
+                         autoincrement=False),
+                  Column('seq', SmallInteger(), primary_key=True,
+                         autoincrement=False),
+                  Column('field_id', SmallInteger(), primary_key=True,
+                         autoincrement=False),
+                  Column('value', Float(), nullable=False))
+    return instruments, fields, ticks
+
+
+class TickStore(object):
+    """
+    The narrow layout: every instrument's ticks in one table as
+    (instrument_id, ts, seq, field_id, value), ts being epoch milliseconds.
+    The primary key (instrument_id, ts, seq, field_id) is the clustered
+    index on MySQL, so an instrument's history is stored in time order.
+    One executemany writes a cycle for every instrument.
+
+    Page times only have seconds, so an instrument can change more than
+    once within one ts. seq numbers those rows 0, 1, 2... in the order
+    they came. The store remembers each instrument's newest (ts, seq);
+    last_rows() reads it back at startup.
+
+    Instrument and field ids come from the instruments and fields tables,
+    filled from bootstrap_list (table names and non-time columns) the
+    first time they are seen.
+
+    Stands in for setup_tables' dict of Tables. write2db, fill_from_db and
+    the spool drainer check for it.
+    """
+    def __init__(self, bootstrap_list, metadata, time_col):
+        logger.info("Setting up ticks table.")
+        self.time_col = time_col
+        self.last_tick = {}  # instrument_id: (ts, seq) of its newest row.
+        self.lock = threading.Lock()  # The spool drainer writes too.
+        self.instruments, self.fields, self.ticks = ticks_tables(metadata)
+        metadata.create_all(tables=[self.instruments, self.fields,
+                                    self.ticks])
+        conn = metadata.bind.connect()
+        try:
+            self.instrument_ids = self.dictionary(
+                conn, self.instruments, [entry[0] for entry in bootstrap_list])
+            field_names = []
+            for entry in bootstrap_list:
+                for column in entry[1]:
+                    if (column[0] != time_col and
+                            column[0] not in field_names):
+                        field_names.append(column[0])
+            self.field_ids = self.dictionary(conn, self.fields, field_names)
+        finally:
+            conn.close()
+        self.instrument_names = dict((number, name) for name, number
+                                     in self.instrument_ids.items())
+        self.field_names = dict((number, name) for name, number
+                                in self.field_ids.items())
+
+    def dictionary(self, conn, table, names):
+        """
+        Returns {name: id} for names, adding the ones table doesn't have.
+        Another process may add the same names at the same time; the
+        unique name makes one of them lose, and it just reads them back.
+        """
+        query = select([table.c.name, table.c.id])
+        known = dict(conn.execute(query).fetchall())
+        missing = [{'name': name} for name in names if name not in known]
+        if missing:
+            try:
+                conn.execute(table.insert(), missing)
+            except IntegrityError:
+                logger.error("%s added by someone else. Rereading.",
+                             table.name)
+            known = dict(conn.execute(query).fetchall())
+        return dict((name, known[name]) for name in names)
+
+    def next_seq(self, instrument_id, ts):
+        """
+        seq for a new row of instrument_id at ts, from its newest row.
+        """
+        last = self.last_tick.get(instrument_id)
+        seq = last[1] + 1 if last is not None and last[0] == ts else 0
+        if last is None or ts >= last[0]:
+            self.last_tick[instrument_id] = (ts, seq)
+        return seq
+
+    def tick_rows(self, table_name, rows, seqs):
+        """
+        Turns row dicts of one instrument into ticks table rows, each row
+        with its seq.
+        """
+        instrument_id = self.instrument_ids[table_name]
+        field_ids = self.field_ids
+        time_col = self.time_col
+        tick_rows = []
+        for row, seq in zip(rows, seqs):
+            ts = (row[time_col] - EPOCH) // ONE_MS
+            for name, value in row.items():
+                if name != time_col:
+                    tick_rows.append({'instrument_id': instrument_id,
+                                      'ts': ts, 'seq': seq,
+                                      'field_id': field_ids[name],
+                                      'value': value})
+        return tick_rows
+
+    def values_key(self, values):
+        """
+        What makes two rows at one ts the same: their {field_id: value},
+        values to 6 digits (MySQL's FLOAT doesn't keep more).
+        """
+        return frozenset((field_id, '%.6g' % value)
+                         for field_id, value in values.items()
+                         if value is not None)
+
+    def existing(self, conn, table_name, stamps):
+        """
+        {ts: {seq: values key}} of the rows instrument already has at the
+        ts (epoch ms) in stamps.
+        """
+        instrument_id = self.instrument_ids[table_name]
+        ticks = self.ticks
+        query = (select([ticks.c.ts, ticks.c.seq, ticks.c.field_id,
+                         ticks.c.value])
+                 .where(and_(ticks.c.instrument_id == instrument_id,
+                             ticks.c.ts.in_(stamps))))
+        rows = {}
+        for ts, seq, field_id, value in conn.execute(query):
+            rows.setdefault(ts, {}).setdefault(seq, {})[field_id] = value
+        return dict((ts, dict((seq, self.values_key(values))
+                              for seq, values in seqs.items()))
+                    for ts, seqs in rows.items())
+
+    def insert(self, conn, batches, skip_existing=False):
+        """
+        Writes {table_name: [row dict, ...]} with one executemany.
+        Returns the number of rows (not ticks) written.
+
+        With skip_existing, rows the instrument already has (same ts and
+        same values) are left out, and a row that differs from those at
+        its ts goes after them. For replays (spool, migration) where the
+        rows may be older than the newest one written.
+        """
+        tick_rows = []
+        written = 0
+        with self.lock:
+            for table_name, rows in batches.items():
+                if skip_existing:
+                    rows, seqs = self.new_rows(conn, table_name, rows)
+                else:
+                    seqs = self.live_seqs(conn, table_name, rows)
+                tick_rows.extend(self.tick_rows(table_name, rows, seqs))
+                written += len(rows)
+        if tick_rows:
+            conn.execute(self.ticks.insert(), tick_rows)
+        return written
 
+    def live_seqs(self, conn, table_name, rows):
+        """
+        seqs for rows as they are scraped: after the instrument's newest
+        row, from memory. Rows older than that, or an instrument whose
+        newest row isn't known yet, are looked up like a replay.
+        """
+        instrument_id = self.instrument_ids[table_name]
+        last = self.last_tick.get(instrument_id)
+        stamps = [(row[self.time_col] - EPOCH) // ONE_MS for row in rows]
+        if last is None or min(stamps) < last[0]:
+            kept, seqs = self.new_rows(conn, table_name, rows, False)
+            return seqs
+        return [self.next_seq(instrument_id, ts) for ts in stamps]
 
-def get_last_row_dict(table_title):
+    def new_rows(self, conn, table_name, rows, skip_existing=True):
+        """
+        The rows that aren't in ticks yet (all of them without
+        skip_existing), and the seq each one gets.
+        """
+        instrument_id = self.instrument_ids[table_name]
+        field_ids = self.field_ids
+        stamps = [(row[self.time_col] - EPOCH) // ONE_MS for row in rows]
+        seen = self.existing(conn, table_name, list(set(stamps)))
+        kept = []
+        seqs = []
+        for row, ts in zip(rows, stamps):
+            key = self.values_key(dict(
+                (field_ids[name], value) for name, value in row.items()
+                if name != self.time_col))
+            at_ts = seen.setdefault(ts, {})
+            if skip_existing and key in at_ts.values():
+                continue
+            seq = max(at_ts) + 1 if at_ts else 0
+            at_ts[seq] = key
+            kept.append(row)
+            seqs.append(seq)
+            last = self.last_tick.get(instrument_id)
+            if last is None or (ts, seq) > last:
+                self.last_tick[instrument_id] = (ts, seq)
+        if len(kept) < len(rows):
+            logger.info("%s: skipped %d rows already in ticks.",
+                        table_name, len(rows) - len(kept))
+        return kept, seqs
+
+    def last_rows(self, conn):
+        """
+        Like get_last_rows(): {table name: row dict} of each instrument's
+        latest ticks, in one query. Returns (dict, number of queries).
+        """
+        ticks = self.ticks
+        latest = (select([ticks.c.instrument_id,
+                          func.max(ticks.c.ts).label('ts')])
+                  .where(ticks.c.instrument_id.in_(
+                      list(self.instrument_ids.values())))
+                  .group_by(ticks.c.instrument_id)
+                  .alias('latest'))
+        query = (select([ticks.c.instrument_id, ticks.c.ts, ticks.c.seq,
+                         ticks.c.field_id, ticks.c.value])
+                 .select_from(ticks.join(latest, and_(
+                     ticks.c.instrument_id == latest.c.instrument_id,
+                     ticks.c.ts == latest.c.ts)))
+                 .order_by(ticks.c.seq))  # The last seq's values win.
+        last_rows = {}
+        with self.lock:
+            for instrument_id, ts, seq, field_id, value in conn.execute(
+                    query):
+                name = self.instrument_names[instrument_id]
+                row = last_rows.get(name)
+                if row is None:
+                    row = last_rows[name] = {
+                        self.time_col: EPOCH + ts * ONE_MS}
+                row[self.field_names[field_id]] = value
+                last = self.last_tick.get(instrument_id)
+                if last is None or (ts, seq) > last:
+                    self.last_tick[instrument_id] = (ts, seq)
+        return last_rows, 1
+
+
+def migrate_to_ticks(cfg, batch_size=10000):
+    """
+    Copies cfg's per-instrument tables into the ticks table, paging on
+    the wide tables' id. Rows the ticks table already has (same time and
+    values, from an earlier run or from the feed itself with db_layout
+    'ticks') are skipped, so it can be stopped and run again at any
+    point. Wide rows sharing a time get their own seq. The wide tables
+    are left alone.
+    """
+    engine, metadata, conn = db_setup(cfg)
+    wide = setup_tables(cfg.bootstrap_list, metadata, cfg.time_col)
+    store = TickStore(cfg.bootstrap_list, metadata, cfg.time_col)
+    for entry in cfg.bootstrap_list:
+        sql_table = wide[entry[0]]
+        id_column = sql_table.c.id
+        columns = [sql_table.c[column[0]] for column in entry[1]]
+        copied = read = 0
+        last_id = None
+        while True:
+            query = (select([id_column] + columns).order_by(id_column)
+                     .limit(batch_size))
+            if last_id is not None:
+                query = query.where(id_column > last_id)
+            rows = [dict(row) for row in conn.execute(query)]
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            for row in rows:
+                del row['id']
+            trans = conn.begin()
+            try:
+                copied += store.insert(conn, {entry[0]: rows},
+                                       skip_existing=True)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+            read += len(rows)
+            if len(rows) < batch_size:
+                break  # Last page. Saves a query.
+        logger.critical("%s: copied %d of %d rows to ticks.", entry[0],
+                        copied, read)
+
+
+warm_start_batch = 50  # Tables per UNION ALL statement in get_last_rows.
+
+
+def get_last_row_dict(sql_table, conn):
     """
-    Gets the last entry in the table for to see if the web entry is
-    new enough to update.
+    Gets the last entry in one table for to see if the web entry is
+    new enough to update. One query per table. Startup uses
+    get_last_rows() instead; this is kept for CFDbench.py to compare with.
     """
-    sql_table = Table(table_title, metadata, autoload=True)
-    query = sql_table.select().order_by('-id').limit(1)
-    result_set = query.execute()
+    query = select([sql_table]).order_by(sql_table.c.id.desc()).limit(1)
+    result_set = conn.execute(query)
     keys = result_set.keys()
     values = result_set.fetchone()
     if values is None:
@@ -585,174 +2956,684 @@ def get_last_row_dict(table_title):
     return data_dict
 
 
-def fill_from_db(bootstrap_list, conn):
+def get_last_rows(bootstrap_list, tables, conn):
     """
-    Using bootstrap_list as guide, creates list_of_rows and fills from last
-    entry in the db.
+    Gets the last entry of every table in a few statements instead of one
+    per table. Tables with the same columns are stacked with UNION ALL of
+    per-table "ORDER BY id DESC LIMIT 1" subqueries, warm_start_batch at a
+    time. Uses the Table objects from setup_tables, so no reflection.
+
+    Returns (dict of table name -> row dict, number of queries run).
+    Tables with no rows are missing from the dict.
+    """
+    layouts = {}  # Column names -> table names that have them.
+    for entry in bootstrap_list:
+        column_names = tuple(column[0] for column in entry[1])
+        layouts.setdefault(column_names, []).append(entry[0])
+
+    last_rows = {}
+    queries = 0
+    for column_names, table_names in layouts.items():
+        for n in range(0, len(table_names), warm_start_batch):
+            subqueries = []
+            for table_name in table_names[n:n + warm_start_batch]:
+                sql_table = tables[table_name]
+                last = (select([literal(table_name).label('_table')] +
+                               [sql_table.c[name] for name in column_names])
+                        .order_by(sql_table.c.id.desc())
+                        .limit(1)
+                        .alias())
+                subqueries.append(select([last]))
+            if len(subqueries) == 1:
+                query = subqueries[0]
+            else:
+                query = union_all(*subqueries)
+            for values in conn.execute(query):
+                last_rows[values[0]] = dict(zip(column_names, values[1:]))
+            queries += 1
+    return last_rows, queries
+
+
+def fill_from_db(bootstrap_list, tables, conn):
+    """
+    Using bootstrap_list as guide, creates list_of_rows (of Row) and fills
+    from last entry in the db.
     """
     logger.info("Loading last database rows.")
+    start = time()
+    if isinstance(tables, TickStore):
+        last_rows, queries = tables.last_rows(conn)
+    else:
+        last_rows, queries = get_last_rows(bootstrap_list, tables, conn)
     list_of_rows = []
     for entry in bootstrap_list:
-        # print("bootstrap row: ", entry[0])
-        row_dict = get_last_row_dict(entry[0])
-        # print("row dict: ", row_dict)
-        col_list = []
-        for column in entry[1]:
-            # print (column[0])
-            col = [column[0], row_dict[column[0]]]
-            col_list.append(col)
-        # print("col_list: ", col_list)
-        row = [entry[0], col_list]
-        logger.debug("Load db: %s", str(row))
+        row_dict = last_rows.get(entry[0], {})
+        columns = tuple(column[0] for column in entry[1])
+        row = Row(entry[0], columns, [row_dict.get(name) for name in columns])
+        logger.debug("Load db: %s", row)
         list_of_rows.append(row)
+    logger.info("Loaded last rows of %d tables with %d queries in %.3fs "
+                "(was %d reflections and %d selects).",
+                len(bootstrap_list), queries, time() - start,
+                len(bootstrap_list), len(bootstrap_list))
+    return list_of_rows
+
+
+# Injected by Browser.table_cells(). Finds the table with the CSS selector
+# in arguments[0] and returns [header, body] as a JSON string, body rows
+# being lists of td texts with empty rows left out. Same cells as
+# extract_table(), a few KB over the wire instead of the whole page.
+TABLE_CELLS_JS = """
+var table = document.querySelector(arguments[0]);
+if (!table || !table.tHead) { return null; }
+var header = [];
+var ths = table.tHead.querySelectorAll('th');
+for (var i = 0; i < ths.length; i++) { header.push(ths[i].textContent); }
+var body = [];
+var trs = table.querySelectorAll('tr');
+for (var j = 0; j < trs.length; j++) {
+    var tds = trs[j].querySelectorAll('td');
+    if (tds.length === 0) { continue; }
+    var cells = [];
+    for (var k = 0; k < tds.length; k++) { cells.push(tds[k].textContent); }
+    body.push(cells);
+}
+return JSON.stringify([header, body]);
+"""
+
+
+# Injected by Browser.watch_table(). Watches the table given by the CSS
+# selector in arguments[0] and pushes [browser time in ms, td texts] onto
+# window.__cfdTicks for every row that changes. Rows that get replaced
+# wholesale are caught through addedNodes. The buffer is capped so a feed
+# that stops draining can't eat the browser's memory.
+OBSERVER_JS = """
+var table = document.querySelector(arguments[0]);
+var Observer = window.MutationObserver || window.WebKitMutationObserver;
+if (!table || !Observer) { return false; }
+if (window.__cfdObserver) { window.__cfdObserver.disconnect(); }
+window.__cfdTicks = [];
+function rowOf(node) {
+    while (node && node !== table) {
+        if (node.nodeName === 'TR') { return node; }
+        node = node.parentNode;
+    }
+    return null;
+}
+window.__cfdObserver = new Observer(function (mutations) {
+    var now = Date.now();
+    var rows = [];
+    for (var i = 0; i < mutations.length; i++) {
+        var nodes = [mutations[i].target];
+        var added = mutations[i].addedNodes || [];
+        for (var a = 0; a < added.length; a++) { nodes.push(added[a]); }
+        for (var n = 0; n < nodes.length; n++) {
+            var tr = rowOf(nodes[n]);
+            if (tr && rows.indexOf(tr) < 0) { rows.push(tr); }
+        }
+    }
+    for (var r = 0; r < rows.length; r++) {
+        var tds = rows[r].querySelectorAll('td');
+        if (tds.length === 0) { continue; }
+        var cells = [];
+        for (var k = 0; k < tds.length; k++) {
+            cells.push(tds[k].textContent);
+        }
+        window.__cfdTicks.push([now, cells]);
+    }
+    if (window.__cfdTicks.length > 10000) {
+        window.__cfdTicks.splice(0, window.__cfdTicks.length - 10000);
+    }
+});
+window.__cfdObserver.observe(table, {childList: true, characterData: true,
+                                     subtree: true});
+return true;
+"""
+
+# Hands back everything the observer buffered and empties the buffer.
+# null means the page has no observer (new page, reload, new driver).
+DRAIN_JS = """
+var ticks = window.__cfdTicks;
+if (!ticks) { return null; }
+window.__cfdTicks = [];
+return JSON.stringify(ticks);
+"""
+
+
+def table_selector(attribute):
+    """
+    Turns a BeautifulSoup style attribute dict into a CSS selector for
+    the table, e.g. {'id': 'bonds'} -> 'table[id="bonds"]'.
+    """
+    selector = 'table'
+    for key, value in sorted(attribute.items()):
+        if key == 'class':
+            selector += '[class~="%s"]' % value
+        else:
+            selector += '[%s="%s"]' % (key, value)
+    return selector
+
+
+def table_xpath(attribute):
+    """
+    Turns a BeautifulSoup style attribute dict like {'id': 'bonds'} into
+    an XPath expression for the table. Class is matched per token the way
+    BeautifulSoup does it.
+    """
+    tests = []
+    for key, value in sorted(attribute.items()):
+        if key == 'class':
+            tests.append('contains(concat(" ", normalize-space(@class), " "),'
+                         ' " %s ")' % value)
+        else:
+            tests.append('@%s="%s"' % (key, value))
+    if not tests:
+        return '//table'
+    return '//table[%s]' % ' and '.join(tests)
+
+
+def import_lxml():
+    """
+    Imports lxml.html the first time. Returns False if it isn't installed.
+    """
+    global lxml
+    if lxml is None:
+        try:
+            import lxml.html
+        except ImportError:
+            lxml = False
+    return lxml is not False
+
+
+def extract_table_lxml(html_source, attribute):
+    """
+    Pulls the header and body cells of the one table we want using lxml
+    and XPath. Nothing outside the table is walked. Returns None if the
+    table or its head can't be found.
+    """
+    document = lxml.html.fromstring(html_source)
+    tables = document.xpath(table_xpath(attribute))
+    if not tables:
+        return None
+    table = tables[0]
+    header = [th.text_content() for th in table.xpath('./thead//th')]
+    if not header:
+        return None
+    body = [[td.text_content() for td in row.xpath('.//td')]
+            for row in table.xpath('.//tr')]
+    return header, [x for x in body if x != []]  # Must remove empty rows.
+
+
+def extract_table_html5lib(html_source, attribute):
+    """
+    The original extractor. Slow (~330 ms a page) but it copes with
+    anything a browser does.
+    """
+    from bs4 import BeautifulSoup  # Only loaded if html5lib is ever used.
+    soup = BeautifulSoup(html_source, "html5lib")  # Parser important.
+    table = soup.find('table', attribute)
+    if table is None:
+        return None
+    try:
+        header = [th.text for th in table.find('thead').select('th')]
+    except AttributeError:
+        return None
+    body = [[td.text for td in row.select('td')]
+            for row in table.findAll('tr')]
+    return header, [x for x in body if x != []]  # Must remove empty rows.
+
+
+table_extractors = {'lxml': extract_table_lxml,
+                    'html5lib': extract_table_html5lib}
+
+
+def extract_table(html_source, attribute, extractor='lxml'):
+    """
+    Returns (header, body) for the table matching attribute, or None.
+    Anything other than html5lib falls back to html5lib if it is missing,
+    blows up or can't find the table.
+    """
+    if extractor != 'html5lib':
+        if extractor == 'lxml' and not import_lxml():
+            logger.error("lxml not installed. Using html5lib.")
+        else:
+            try:
+                result = table_extractors[extractor](html_source, attribute)
+                if result is not None:
+                    return result
+                logger.error("%s found no table. Trying html5lib.",
+                             extractor)
+            except Exception:
+                logger.error("%s extractor failed. Trying html5lib.",
+                             extractor, exc_info=1)
+    return extract_table_html5lib(html_source, attribute)
+
+
+def script2table(browser, attribute):
+    """
+    Gets (header, body) by running TABLE_CELLS_JS in the browser.
+    Returns None if the table isn't there.
+    """
+    cells = browser.table_cells(attribute)
+    if cells is None:
+        return None
+    header, body = json.loads(cells)
+    return header, body
+
+
+def browser2table(browser, attribute, extractor='lxml', mode='source'):
+    """
+    Gets the header and body cells of the table given by attribute:
+    {'id':'bonds'} from a webdriver instance.
+    TODO:
+    Exhibits a strange bug where after 15-30 calls the time for execution
+    grows from ~ 0.290s to 8 seconds and then to 20. Why?
+    The culprit is browser.page_source()
+    Fixed! Moved from Firefox to phantomjs. Works much, much faster and
+    with much less memory.
+
+    Stupid lxml is causing me stress. ["lxml", "xml"] is best for
+    Firefox but phantomjs and Chrome work only with html5lib.
+    Now there is an lxml.html/XPath extractor that only looks at the one
+    table. html5lib is still there as the fallback. Pick with
+    table_extractor in the config and compare with CFDbench.py.
+
+    With mode 'script' the table is read inside the browser and only its
+    cells come back. If that finds nothing, page_source is used as before.
+    """
+    start = time()
+    if mode == 'script':
+        logger.debug("Reading table in browser in browser2table.")
+        extracted = script2table(browser, attribute)
+        script_time = time() - start
+        metrics.observe('script', script_time)
+        if extracted is not None:
+            if script_time > 3:
+                logger.error("Table script time exceeded! %s", script_time)
+                metrics.count('slow_polls')
+                browser.renew(force=True)
+            return extracted
+        logger.error("Table script found no table. Using page_source.")
+        start = time()
+
+    logger.debug("Getting source in browser2table.")
+    html_source = browser.source()
+    source_time = time() - start
+    metrics.observe('source', source_time)
+    metrics.gauge('page_source_kb', len(html_source) // 1024)
+
+    parse_start = time()
+    logger.debug("Extracting table in browser2table.")
+    served = getattr(browser, 'served_table', None)
+    if served is not None and served[:2] == (html_source, attribute):
+        extracted = served[2]  # A BrowserGroup parsed it while polling.
+    else:
+        extracted = extract_table(html_source, attribute, extractor)
+    if extracted is None:
+        raise FeedError("Can't find the table or its head. "
+                        "Is the attribute correct?")
+    parse_time = time() - parse_start
+    metrics.observe('parse', parse_time)
+
+    if source_time + parse_time > 3:
+        logger.error("Page source time exceeded! source: %.3fs, "
+                     "parse: %.3fs", source_time, parse_time)
+        metrics.count('slow_polls')
+        browser.renew(force=True)
+    return extracted
+
+
+def browser2dframe(browser, attribute, extractor='lxml'):
+    """
+    Makes a pandas dataframe of the table. The scraping loop no longer
+    needs one, so pandas is only imported here.
+    """
+    import pandas as pd
+    header, body = browser2table(browser, attribute, extractor)
+    cols = zip(*body)  # Turn it into tuples.
+    tbl_d = {name: col for name, col in zip(header, cols)}
+    return pd.DataFrame(tbl_d, columns=header)
+
+
+class CellPlan(object):
+    """
+    bootstrap_list compiled once into a flat list of cells to read:
+    (table, column, web row label, web column label, is time column).
+
+    The labels are resolved to (row, column) positions in the extracted
+    table the first time it is seen. After that a cycle only checks that
+    the row titles are still where they were and reads the cells
+    directly. No DataFrame and no index lookups. If the page moves rows
+    around or changes its header the positions are resolved again.
+
+    rows holds the Row each table is filled into, reused every cycle.
+    """
+    def __init__(self, bootstrap_list, time_col, row_title_column):
+        self.row_title_column = row_title_column
+        self.tables = []  # (table name, first cell, last cell + 1, columns)
+        self.cells = []
+        self.rows = {}
+        for entry in bootstrap_list:
+            first = len(self.cells)
+            for column in entry[1]:
+                self.cells.append((entry[0], column[0], column[1], column[2],
+                                   column[0] == time_col))
+            columns = tuple(column[0] for column in entry[1])
+            self.tables.append((entry[0], first, len(self.cells), columns))
+            self.rows[entry[0]] = Row(entry[0], columns)
+        self.header = None
+        self.addresses = None  # (row index, col index) for each cell.
+        self.title_index = None
+        self.row_tables = None  # Row index -> tables with cells in it.
+        self.title_rows = None  # Row title -> row index, for those rows.
+
+    def resolve(self, header, body):
+        """
+        Finds the position of every cell in the plan. Returns False if any
+        label is missing from the table.
+        """
+        logger.info("Resolving cell addresses.")
+        col_index = dict((label, n) for n, label in enumerate(header))
+        if self.row_title_column not in col_index:
+            logger.critical("Row title column %s not in table header.",
+                            self.row_title_column)
+            return False
+        title_index = col_index[self.row_title_column]
+        row_index = {}
+        for n, row in enumerate(body):
+            if len(row) > title_index:
+                row_index.setdefault(row[title_index], n)
+        addresses = []
+        for table, column, row_label, col_label, is_time in self.cells:
+            if row_label not in row_index or col_label not in col_index:
+                logger.critical("Can't find cell %s, %s for %s.%s",
+                                row_label, col_label, table, column)
+                return False
+            addresses.append((row_index[row_label], col_index[col_label]))
+        self.header = header
+        self.title_index = title_index
+        self.addresses = addresses
+        self.row_tables = {}
+        for table in self.tables:
+            for n in range(table[1], table[2]):
+                tables = self.row_tables.setdefault(addresses[n][0], [])
+                if table not in tables:
+                    tables.append(table)
+        self.title_rows = dict((body[row][title_index], row)
+                               for row in self.row_tables)
+        return True
+
+    def still_valid(self, header, body):
+        if self.addresses is None or header != self.header:
+            return False
+        title_index = self.title_index
+        try:
+            for cell, (row, col) in zip(self.cells, self.addresses):
+                if body[row][title_index] != cell[2]:
+                    return False
+        except IndexError:
+            return False
+        return True
+
+
+def fill_from_web(browser, cfg, plan):
+    """
+    Reads the table of interest straight into a list_of_rows using the
+    precompiled CellPlan.
+    """
+    logger.debug("Calling browser2table in fill_from_web.")
+    header, body = browser2table(browser, cfg.attribute, cfg.table_extractor,
+                                 cfg.extraction_mode)
+    return fill_from_table(header, body, browser, cfg, plan)
+
+
+def fill_from_table(header, body, browser, cfg, plan):
+    """
+    The part of fill_from_web after the table has been read.
+    """
+    start = time()
+    if not plan.still_valid(header, body):
+        if not plan.resolve(header, body):
+            raise FeedError("Can't find the cells in the table.")
+    logger.debug("Filling cells in fill_from_web.")
+    anchor = day_anchor(cfg.web_tz)
+    list_of_rows = [fill_table(plan, table, body, browser, anchor)
+                    for table in plan.tables]
+    metrics.observe('extract', time() - start)
     return list_of_rows
 
 
-def browser2dframe(browser, attribute):
+def fill_table(plan, table, body, browser, anchor, row=None):
+    """
+    Fills the Row for one of plan.tables out of body and returns it.
+    anchor is this cycle's DayAnchor for the time cells. Unless another
+    row is given, it is the plan's Row for the table, overwritten in
+    place every cycle.
+    """
+    table_name, first, last, columns = table
+    if row is None:
+        row = plan.rows[table_name]
+    values = row.values
+    cells = plan.cells
+    addresses = plan.addresses
+    for n in range(first, last):
+        web_row, web_col = addresses[n]
+        table_value = body[web_row][web_col]
+        if cells[n][4]:
+            table_value = custom_date_parser(table_value, browser,
+                                             anchor=anchor)
+        else:
+            try:
+                table_value = float(table_value)
+            except ValueError:  # Only strip commas when there are some.
+                table_value = float(table_value.replace(',', ''))
+        values[n - first] = table_value
+
+    logger.debug("Load web: %s", row)
+    return row
+
+
+class TickStream(object):
+    """
+    Stream mode for a feed. The first call reads the whole table, puts a
+    MutationObserver on it and keeps the body. After that each call only
+    drains the rows the observer saw change, patches them into the kept
+    body and fills the tables that have cells in those rows. Every tick
+    comes out, in order, not just the one on screen when we happen to look.
+
+    The whole table is read again every stream_resync seconds, or when the
+    observer goes missing (reload or new driver).
+    """
+    def __init__(self, cfg, plan):
+        self.cfg = cfg
+        self.plan = plan
+        self.body = None
+        self.last_resync = 0
+
+    def resync(self, browser):
+        cfg = self.cfg
+        header, body = browser2table(browser, cfg.attribute,
+                                     cfg.table_extractor, 'script')
+        if not self.plan.still_valid(header, body):
+            if not self.plan.resolve(header, body):
+                raise FeedError("Can't find the cells in the table.")
+        if not browser.watch_table(cfg.attribute):
+            raise FeedError("Can't install table observer. Is "
+                            "MutationObserver supported by this browser?")
+        self.body = body
+        self.last_resync = time()
+        anchor = day_anchor(cfg.web_tz)
+        return [fill_table(self.plan, table, body, browser, anchor)
+                for table in self.plan.tables]
+
+    def fill(self, browser):
+        if (self.body is None or
+                time() - self.last_resync > self.cfg.stream_resync):
+            return self.resync(browser)
+        start = time()
+        ticks = browser.drain_ticks()
+        metrics.observe('drain', time() - start)
+        if ticks is None:
+            logger.error("Table observer is gone. Reading whole table.")
+            return self.resync(browser)
+
+        start = time()
+        anchor = day_anchor(self.cfg.web_tz)
+        plan = self.plan
+        title_index = plan.title_index
+        list_of_rows = []
+        now = time() * 1000
+        for browser_time, cells in json.loads(ticks):
+            logger.debug("Tick %.0f ms old: %s", now - browser_time, cells)
+            if len(cells) <= title_index:
+                continue
+            row = plan.title_rows.get(cells[title_index])
+            if row is None:
+                continue  # Not a row we scrape.
+            if len(cells) != len(self.body[row]):
+                # The page changed under the observer. Keep the ticks
+                # drained so far and follow them with the whole table.
+                list_of_rows.extend(self.resync(browser))
+                break
+            self.body[row] = cells
+            for table in plan.row_tables[row]:
+                # A row can tick more than once per drain, so every tick
+                # gets its own Row instead of the plan's.
+                list_of_rows.append(fill_table(plan, table, self.body,
+                                               browser, anchor,
+                                               Row(table[0], table[3])))
+        metrics.observe('extract', time() - start)
+        return list_of_rows
+
+
+class DayAnchor(object):
     """
-    Makes a dataframe from a webdriver instance given a table
-    attribute: {'id':'bonds'}.
-    TODO:
-    Exhibits a strange bug where after 15-30 calls the time for execution
-    grows from ~ 0.290s to 8 seconds and then to 20. Why?
-    The culprit is browser.page_source()
-    Fixed! Moved from Firefox to phantomjs. Works much, much faster and
-    with much less memory.
+    The page's current date, looked up once per cycle so that each time
+    cell is only a few slices and a datetime(). dateutil's parse() was
+    over ten times slower on this format. (CFDbench.py dates)
 
-    Stupid lxml is causing me stress. ["lxml", "xml"] is best for
-    Firefox but phantomjs and Chrome work only with html5lib so that
-    is what I'm going with. The difference is only 330 milliseconds
-    so that's fine for now. Write an lxml-based custom parser later.
-    (a lot later.)
-    (I gained around that much when I switched to phantomjs so that
-    is also fine.)
-    """
-    profiler = []
-    start1 = time()
-    logger.debug("Getting source in browser2dframe.")
-    html_source = browser.source()
+    Keeps the midnight fix: if the page's clock says 23:xx just after
+    midnight, the tick is from yesterday. Times on a page that isn't
+    GMT/UTC are moved to UTC, which is what goes in the database.
+    """
+    one_day = datetime.timedelta(days=1)
 
-    end_time1 = time() - start1
-    profiler.append("html_source = browser.page_source: " + str(end_time1))
+    def __init__(self, web_tz='GMT'):
+        self.web_tz = web_tz
+        if web_tz in ('GMT', 'UTC'):
+            self.tzinfo = None
+        else:
+            self.tzinfo = gettz(web_tz)
+            if self.tzinfo is None:
+                logger.critical("Unknown web_tz: %s", web_tz)
+                raise ValueError("Unknown web_tz: " + web_tz)
+        self.utc = tzutc()
+        self.update()
 
-    start2 = time()
-    logger.debug("Parsing source in browser2dframe.")
-    soup = BeautifulSoup(html_source, "html5lib")  # Parser important.
-    end_time2 = time() - start2
-    profiler.append("BeautifulSoup(html_source, ...): " + str(end_time2))
+    def update(self):
+        if self.tzinfo is None:
+            now = datetime.datetime.utcnow()
+        else:
+            now = datetime.datetime.now(self.tzinfo)
+        today = now.date()
+        yesterday = today - self.one_day
+        self.today = (today.year, today.month, today.day)
+        self.yesterday = (yesterday.year, yesterday.month, yesterday.day)
+        self.after_midnight = now.hour == 0
 
-    start3 = time()
-    table = soup.find('table', attribute)
-    if table is None:
-        logger.critical("Can't find the table. Is the attribute correct?")
-        clean_up(browser)
-    try:
-        header = [th.text for th in table.find('thead').select('th')]
-    except AttributeError:
-        logger.critical("Can't find the table head!")
-        clean_up(browser)
+    def datetime(self, hour, minute, second):
+        if self.after_midnight and hour == 23:
+            year, month, day = self.yesterday
+        else:
+            year, month, day = self.today
+        stamp = datetime.datetime(year, month, day, hour, minute, second)
+        if self.tzinfo is None:
+            return stamp
+        stamp = stamp.replace(tzinfo=self.tzinfo).astimezone(self.utc)
+        return stamp.replace(tzinfo=None)
 
-    body = [[td.text for td in row.select('td')]
-            for row in table.findAll('tr')]
-    body2 = [x for x in body if x != []]  # Must remove empty rows.
-    cols = zip(*body2)  # Turn it into tuples.
-    tbl_d = {name: col for name, col in zip(header, cols)}
-    end_time3 = time() - start3
-    profiler.append("Body of function: " + str(end_time3))
-    start4 = time()
-    logger.debug("Creating Dataframe in browser2dframe.")
-    result = pd.DataFrame(tbl_d, columns=header)
-    end_time4 = time() - start4
-    profiler.append("pd.DataFrame(tbl_d, columns=header): " + str(end_time4))
-    total_time = time() - start1
-    if total_time > 3:
-        logger.error("Page source time exceeded!")
-        logger.error(profiler[0])
-        logger.error(profiler[1])
-        logger.error(profiler[2])
-        logger.error(profiler[3])
-        browser.refresh()
-    return result
-
-
-def fill_from_web(browser, attribute):
-    """
-    Loads the table of interest into a pandas Dataframe for easy lookup
-    by row and column.
-    """
-    logger.debug("Calling browser2dframe in fill_from_web.")
-    table_df = browser2dframe(browser, attribute)
-    logger.debug("Setting index in fill_from_web.")
-    table_df = table_df.set_index(row_title_column)
-    logger.debug("Iterating bootstrap_list in fill_from_web.")
-    list_of_rows = []
-    for entry in bootstrap_list:
-        # logger.debug("tablename: %s", entry[0])
-        col_list = []
-        for column in entry[1]:
-            table_value = table_df.loc[column[1], column[2]]
-            # logger.debug(table_value)
-            if column[0] == time_col:
-                table_value = custom_date_parser(table_value, browser)
-            else:
-                table_value = table_value.replace(',', '')
-                table_value = float(table_value)
-            col = [column[0], table_value]
-            col_list.append(col)
 
-        row = [entry[0], col_list]
-        logger.debug("Load web: %s", str(row))
-        list_of_rows.append(row)
-    return list_of_rows
+day_anchors = {}  # One DayAnchor per web_tz, updated once per cycle.
+
+
+def day_anchor(web_tz):
+    """
+    Returns the DayAnchor for web_tz with today's date brought up to date.
+    """
+    anchor = day_anchors.get(web_tz)
+    if anchor is None:
+        anchor = day_anchors[web_tz] = DayAnchor(web_tz)
+    else:
+        anchor.update()
+    return anchor
 
 
-def custom_date_parser(date_string, browser):
+def custom_date_parser(date_string, browser, web_tz='GMT', anchor=None):
     """
     Date parser for the oddball date format. Also atempts to handle
     the difference between the page date time and the system datetime.
     This is especially an issue around midnight when the two times might
     be in different days.
+
+    The format is fixed (H:MM:SS or HH:MM:SS) so the string is sliced
+    rather than handed to dateutil. Pass this cycle's DayAnchor as
+    anchor; without one the date is looked up for this call alone.
     """
-    good_time = ':' in date_string
-    if good_time is False:
+    if ':' not in date_string:
         return None
-    good_len = (len(date_string) == 7) or (len(date_string) == 8)
-    if good_len is False:
-        logger.critical("Unrecognized web source date format.%s", date_string)
-        clean_up()
-    if (len(date_string) == 7):
-        date_string = '0' + date_string
-    if ((web_tz == 'GMT') or (web_tz == 'UTC')):
-        # Fancy stuff for when the web and utc date are not synced @ midnight.
-        current_utc = datetime.datetime.utcnow()
-        web_hour = int(date_string[0:2])
-        if current_utc.hour == 0:
-            if web_hour == 23:
-                one_day = datetime.timedelta(days=1)
-                current_utc = current_utc - one_day
-        return parse(date_string, default=(current_utc))
-    else:
-        logger.critical("Non GMT web dates not yet supported.")
-        clean_up(browser)
+    length = len(date_string)
+    if length != 7 and length != 8:
+        raise FeedError("Unrecognized web source date format: " +
+                        date_string)
+    try:
+        hour = int(date_string[:length - 6])
+        minute = int(date_string[length - 5:length - 3])
+        second = int(date_string[length - 2:])
+        if anchor is None:
+            anchor = DayAnchor(web_tz)
+        return anchor.datetime(hour, minute, second)
+    except ValueError:
+        raise FeedError("Unrecognized web source date format: " +
+                        date_string)
+
+
+def keyed_state(list_of_rows):
+    """
+    Turns a list_of_rows into the last known state compare_lists keeps:
+    {table_name: [value1, value2, ...]}. The value lists are copies.
+    """
+    return dict((row.table, row.values[:]) for row in list_of_rows)
 
 
-def compare_lists(old_list, new_list):
+def compare_lists(last_state, new_list):
     """
-    Compare list_of_rows data structure row by row to determine what has
-    changed and must be written to the database.
+    Compares new_list against the last known state to determine what has
+    changed and must be written to the database. last_state is a dict
+    from keyed_state() and is updated in place, so this is one dict lookup
+    and one list compare per row rather than a scan of the old list.
+    Nothing is built for unchanged rows.
+    The changed Rows are returned for write2db. They may be the plan's
+    reused Rows, so they are only good until the next cycle.
     """
     logger.debug("Comparing lists.")
     differences = []
-    for entry in new_list:
-        if entry not in old_list:
-            differences.append(entry)
+    for row in new_list:
+        values = row.values
+        if last_state.get(row.table) == values:
+            continue
+        last_state[row.table] = values[:]
+        differences.append(row)
     return differences
 
 
-def write2db(changed_list):
+def write2db(changed_list, tables, conn):
     """
     Writes rows to the database. Only does an update if the datetime
-    is not None.
+    is not None. Returns the number of rows written.
+
+    Rows are grouped by table and each table gets one executemany. All of
+    it happens in one transaction on conn, so a cycle is a handful of
+    round trips and a failure leaves nothing half written.
 
     I'm using pymysql as my underlying DBAPI and there is a bug that
     allows a hang if the session is interupted.
@@ -762,42 +3643,1116 @@ def write2db(changed_list):
     ref: https://github.com/PyMySQL/PyMySQL/issues/136
     pip install --upgrade https://github.com/PyMySQL/PyMySQL/tarball/master
     Hopefully this will not be needed after 0.6.1
+    """
+    batches = {}
+    order = []
+    for row in changed_list:
+        null_date = (row.values[0] is None)
+        if null_date:
+            continue
+        logger.debug("Write db: %s", row)
+        if row.table not in batches:
+            batches[row.table] = []
+            order.append(row.table)
+        batches[row.table].append(row.as_dict())  # keep this.
+    if not order:
+        return 0
+
+    rows_written = 0
+    trans = conn.begin()
+    try:
+        if isinstance(tables, TickStore):
+            rows_written = tables.insert(conn, batches)
+        else:
+            for table_name in order:
+                conn.execute(tables[table_name].insert(), batches[table_name])
+                rows_written += len(batches[table_name])
+        trans.commit()
+    except:
+        logger.error("Database write failed. Rolling back.", exc_info=1)
+        trans.rollback()
+        raise
+    logger.debug("Finished db insert.")
+    return rows_written
 
-    TODO:
-    Using connectionless execution. Fix this.
-    Make the update happen en masse rather than one
-    table at a time. This could be faster.
-    Not sure if possible when updates are in diferent tables.
 
-    Put some error handling when you get back some errors.
+############ Local spool for when the database goes away #####################
+class Spool(object):
     """
-    global total_rows_scraped
-    global last_write_time
-    for entry in changed_list:
-        null_date = (entry[1][0][1] is None)
-        if null_date:
+    Append-only store of rows waiting to go to the database, kept in a
+    local SQLite file so they survive a crash or a restart. Rows are only
+    removed once the database has committed them.
+
+    Rows are keyed by seq alone. Two changes of a table within the same
+    time (stream mode, sub-second ticks) are both kept.
+    SQLite connections can't be shared between threads, so each thread
+    gets its own.
+    """
+    schema = ("CREATE TABLE IF NOT EXISTS spool ("
+              "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+              "table_name TEXT NOT NULL, "
+              "time TEXT NOT NULL, "
+              "row TEXT NOT NULL)")
+
+    def __init__(self, path, time_col):
+        self.path = path
+        self.time_col = time_col
+        self.local = threading.local()
+        self.connection()  # Create the file and schema up front.
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(self.schema)
+            db.commit()
+            self.local.db = db
+        return db
+
+    def append(self, changed_list):
+        """
+        Spools every row with a time. Returns how many there were.
+        """
+        records = []
+        for entry in changed_list:
+            row = entry.as_dict()
+            utc_time = row.pop(self.time_col)
+            if utc_time is None:
+                continue
+            logger.debug("Spool: %s", entry)
+            records.append((entry.table,
+                            utc_time.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                            json.dumps(row)))
+        if not records:
+            return 0
+        db = self.connection()
+        before = db.total_changes
+        db.executemany("INSERT INTO spool (table_name, time, row) "
+                       "VALUES (?, ?, ?)", records)
+        db.commit()
+        return db.total_changes - before
+
+    def take(self, limit):
+        """
+        Oldest rows first as (seq, table_name, row dict).
+        """
+        db = self.connection()
+        cursor = db.execute("SELECT seq, table_name, time, row FROM spool "
+                            "ORDER BY seq LIMIT ?", (limit,))
+        rows = []
+        for seq, table_name, utc_time, row in cursor:
+            row = json.loads(row)
+            row[self.time_col] = datetime.datetime.strptime(
+                utc_time, '%Y-%m-%d %H:%M:%S.%f')
+            rows.append((seq, table_name, row))
+        return rows
+
+    def remove(self, seqs):
+        db = self.connection()
+        db.executemany("DELETE FROM spool WHERE seq = ?",
+                       [(seq,) for seq in seqs])
+        db.commit()
+
+    def backlog(self):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM spool").fetchone()[0]
+
+
+class SpoolDrainer(threading.Thread):
+    """
+    Background thread that replays the spool into the database in big
+    batches. While the database is down it backs off and retries; nothing
+    it does ever waits on the scraping loop or the other way round.
+
+    Rows already in their table (same time and same values) are skipped,
+    so replaying a batch that was committed just before a crash does no
+    harm. rows_written counts what the database committed.
+    """
+    def __init__(self, spool, tables, engine, time_col, batch_size=500,
+                 max_retry_wait=60, feed='', write_timeout=30, grace=5):
+        threading.Thread.__init__(self, name="SpoolDrainer")
+        self.feed = feed  # Name the drainer's metrics go under.
+        self.write_timeout = write_timeout
+        self.grace = grace
+        self.daemon = True
+        self.spool = spool
+        self.tables = tables
+        self.engine = engine
+        self.time_col = time_col
+        self.batch_size = batch_size
+        self.max_retry_wait = max_retry_wait
+        self.wakeup = threading.Event()
+        self.rows_written = 0
+        self.last_write_time = time()
+        self.db_ok = True
+
+    def wake(self):
+        self.wakeup.set()
+
+    def run(self):
+        retry_wait = 1
+        while True:
+            try:
+                written = self.drain_once()
+            except Exception:
+                metrics.count('db_errors', feed=self.feed)
+                if self.db_ok:
+                    logger.error("Database write failed. Rows stay in the "
+                                 "spool until it is back.", exc_info=1)
+                self.db_ok = False
+                sleep(retry_wait)
+                retry_wait = min(retry_wait * 2, self.max_retry_wait)
+                continue
+            if not self.db_ok:
+                logger.error("Database is back. Draining spool.")
+            self.db_ok = True
+            retry_wait = 1
+            if written < self.batch_size:
+                self.wakeup.wait(5)
+                self.wakeup.clear()
+
+    def write_batches(self, conn, batches):
+        """
+        Inserts {table_name: [row dict, ...]} in one transaction, leaving
+        out rows already there. Returns how many were inserted.
+        """
+        trans = conn.begin()
+        try:
+            if isinstance(self.tables, TickStore):
+                written = self.tables.insert(conn, batches,
+                                             skip_existing=True)
+            else:
+                written = self.write_wide(conn, batches)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        return written
+
+    def write_wide(self, conn, batches):
+        written = 0
+        for table_name, rows in batches.items():
+            sql_table = self.tables[table_name]
+            time_column = sql_table.c[self.time_col]
+            names = list(rows[0])
+            times = [row[self.time_col] for row in rows]
+            query = (select([sql_table.c[name] for name in names])
+                     .where(time_column.in_(times)))
+            existing = set(self.row_key(names, values)
+                           for values in conn.execute(query))
+            rows = [row for row in rows if self.row_key(
+                names, [row[name] for name in names]) not in existing]
+            if rows:
+                conn.execute(sql_table.insert(), rows)
+                written += len(rows)
+        return written
+
+    def row_key(self, names, values):
+        """
+        What makes a row the same as one in the database: its time and
+        its values to 6 digits (MySQL's FLOAT doesn't keep more).
+        """
+        return tuple(value if name == self.time_col or value is None
+                     else '%.6g' % value
+                     for name, value in zip(names, values))
+
+    def drain_once(self):
+        """
+        Writes one batch from the spool. Returns how many rows it took.
+        """
+        records = self.spool.take(self.batch_size)
+        if not records:
+            return 0
+        start = time()
+        batches = {}
+        for seq, table_name, row in records:
+            batches.setdefault(table_name, []).append(row)
+
+        conn = self.engine.connect()
+        try:
+            written = watchdog.call(self.write_timeout, self.write_batches,
+                                    (conn, batches), kill=conn.invalidate,
+                                    grace=self.grace,
+                                    message="Spool drain timed out.")
+        finally:
+            conn.close()
+
+        self.spool.remove([record[0] for record in records])
+        metrics.observe('db_drain', time() - start, self.feed)
+        if written:
+            self.rows_written += written
+            self.last_write_time = time()
+            metrics.count('rows_written', written, self.feed)
+        logger.debug("Drained %d spooled rows.", len(records))
+        return len(records)
+
+
+############ Local read API ##################################################
+def json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat() + 'Z'  # Times are all UTC.
+    return value
+
+
+class QuoteCache(object):
+    """
+    The latest row of every table from every feed, for the local read
+    API. Readers used to ask MySQL for the last row of a table
+    (ORDER BY id DESC LIMIT 1) while the scrapers were inserting into it.
+
+    Each table's entry is (config, columns, values, updated). updated is
+    when a feed saw the row change, or None for rows loaded from the
+    database at startup. Entries are replaced, never changed, so readers
+    only hold the lock long enough to copy the dict.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.quotes = {}
+        self.checked = {}  # Config: when its feed last read the page.
+
+    def seed(self, config, list_of_rows):
+        with self.lock:
+            for row in list_of_rows:
+                self.quotes[row.table] = (config, row.columns,
+                                          row.values[:], None)
+
+    def update(self, config, changed_list):
+        """
+        Called every cycle, changed or not, so checked stays current.
+        """
+        now = time()
+        with self.lock:
+            for row in changed_list:
+                self.quotes[row.table] = (config, row.columns,
+                                          row.values[:], now)
+            self.checked[config] = now
+
+    def entry_dict(self, table, entry, now):
+        config, columns, values, updated = entry
+        checked = self.checked.get(config)
+        return {'table': table, 'config': config,
+                'values': dict((name, json_value(value))
+                               for name, value in zip(columns, values)),
+                'updated': updated,
+                'age': None if updated is None else now - updated,
+                'checked_age': None if checked is None else now - checked}
+
+    def quote(self, table):
+        entry = self.quotes.get(table)
+        if entry is None:
+            return None
+        return self.entry_dict(table, entry, time())
+
+    def snapshot(self, config=None):
+        """
+        Every table, or only config's, as a dict ready for json.dumps().
+        """
+        with self.lock:
+            quotes = list(self.quotes.items())
+        now = time()
+        return {'time': now,
+                'quotes': dict((table, self.entry_dict(table, entry, now))
+                               for table, entry in quotes
+                               if config is None or entry[0] == config)}
+
+
+quotes = QuoteCache()
+
+
+class QuoteHandler(BaseHTTPRequestHandler):
+    """
+    GET /quotes                 every table
+    GET /quotes/<table>         one table
+    GET /configs/<dataname>     one config's tables
+    """
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so a read is one round trip.
+    disable_nagle_algorithm = True  # Or headers and body wait on an ACK.
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['quotes']:
+            result = quotes.snapshot()
+        elif len(parts) == 2 and parts[0] == 'quotes':
+            result = quotes.quote(parts[1])
+        elif len(parts) == 2 and parts[0] == 'configs':
+            result = quotes.snapshot(parts[1])
+            if not result['quotes']:
+                result = None
+        else:
+            result = None
+        if result is None:
+            self.send_error(404)
+            return
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_quotes(port):
+    """
+    Serves the QuoteCache at http://127.0.0.1:port/ from a background
+    thread. Each request gets its own thread.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), QuoteHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name="QuoteServer")
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving quotes on port %d.", port)
+    return server
+
+
+class Subscriber(object):
+    """
+    One connection to the tick stream. It asked for some tables and
+    configs (none means all) and gets each changed row as a line of JSON.
+
+    Its queue is bounded. Past max_queue lines the oldest are dropped,
+    or with coalesce only the newest line of each table is kept. Either
+    way the reader is told how many it missed with a {"dropped": n} line.
+    Each subscriber has its own writer thread, so a slow reader only ever
+    holds up itself, never the scraping loop.
+    """
+    def __init__(self, connection, tables=None, configs=None,
+                 coalesce=False, max_queue=10000):
+        self.connection = connection
+        self.tables = set(tables or ())
+        self.configs = set(configs or ())
+        self.coalesce = coalesce
+        self.max_queue = max_queue
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.latest = {}  # Table: line, when coalescing.
+        self.dropped = 0
+        self.closed = False
+
+    def wants(self, table, config):
+        return ((not self.tables or table in self.tables) and
+                (not self.configs or config in self.configs))
+
+    def offer(self, table, line):
+        with self.cond:
+            if self.coalesce:
+                if self.latest.pop(table, None) is not None:
+                    self.dropped += 1
+                self.latest[table] = line
+            else:
+                if len(self.queue) >= self.max_queue:
+                    self.queue.popleft()
+                    self.dropped += 1
+                self.queue.append(line)
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not (self.queue or self.latest or self.closed):
+                    self.cond.wait()
+                if self.closed:
+                    break
+                lines = list(self.queue) + list(self.latest.values())
+                self.queue.clear()
+                self.latest.clear()
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                metrics.count('ticks_dropped', dropped, feed='')
+                lines.insert(0, ('{"dropped": %d}\n' % dropped).encode())
+            try:
+                self.connection.sendall(b''.join(lines))
+            except OSError:
+                break
+        self.close()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.connection.close()
+        except OSError:
             pass
+
+
+class TickPublisher(object):
+    """
+    Pushes every changed row to subscribers as NDJSON over a Unix socket,
+    so consumers hear about a tick right after the scrape instead of on
+    their next database poll.
+
+    A subscriber connects and sends one line of JSON, for example
+    {"tables": ["EUR_USD_fx_CFD"], "configs": [], "coalesce": false}
+    or an empty line for everything. Then it reads lines like
+    {"table": ..., "config": ..., "values": {...}, "published": epoch}.
+    """
+    def __init__(self, max_queue=10000):
+        self.max_queue = max_queue
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.path = None
+
+    def listen(self, path):
+        if os.path.exists(path):
+            os.unlink(path)  # Left by a process that didn't shut down.
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(16)
+        self.path = path
+        thread = threading.Thread(target=self.accept_loop,
+                                  name="TickPublisher")
+        thread.daemon = True
+        thread.start()
+        logger.info("Streaming ticks on %s.", path)
+
+    def accept_loop(self):
+        while True:
+            try:
+                connection, address = self.server.accept()
+            except OSError:
+                return  # Closed.
+            worker = threading.Thread(target=self.subscribe,
+                                      args=(connection,),
+                                      name="TickSubscriber")
+            worker.daemon = True
+            worker.start()
+
+    def subscribe(self, connection):
+        try:
+            connection.settimeout(10)
+            request = connection.makefile('rb').readline().strip()
+            request = json.loads(request.decode('utf-8')) if request else {}
+            connection.settimeout(None)
+        except (OSError, ValueError):
+            logger.error("Bad tick subscription.", exc_info=1)
+            connection.close()
+            return
+        subscriber = Subscriber(connection, request.get('tables'),
+                                request.get('configs'),
+                                request.get('coalesce', False),
+                                self.max_queue)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        try:
+            subscriber.run()
+        finally:
+            with self.lock:
+                self.subscribers.remove(subscriber)
+
+    def publish(self, config, changed_list):
+        """
+        Hands the rows to every subscriber that wants them. Each row is
+        turned into JSON once, whoever it goes to.
+        """
+        if not self.subscribers:
+            return
+        with self.lock:
+            subscribers = list(self.subscribers)
+        now = time()
+        for row in changed_list:
+            takers = [subscriber for subscriber in subscribers
+                      if subscriber.wants(row.table, config)]
+            if not takers:
+                continue
+            line = (json.dumps({
+                'table': row.table, 'config': config,
+                'values': dict((name, json_value(value)) for name, value
+                               in zip(row.columns, row.values)),
+                'published': now}) + '\n').encode('utf-8')
+            for subscriber in takers:
+                subscriber.offer(row.table, line)
+
+    def close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        os.unlink(self.path)
+        self.server = None
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.close()
+
+
+publisher = TickPublisher()
+
+
+############ Columnar archive #################################################
+def import_pyarrow():
+    global pyarrow
+    if pyarrow is None:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+        import pyarrow.compute
+    return pyarrow
+
+
+class ArchiveSink(object):
+    """
+    A second sink next to write2db. Changed rows are buffered in memory per
+    table and written out as immutable segments:
+    path/<table>/<YYYY-MM-DD>/<first ms>-<last ms>.parquet (or .arrow)
+    Each segment is written to a .tmp file and renamed into place, so a
+    reader never sees half of one. The time column comes first, as a
+    millisecond timestamp, then the float columns.
+
+    Segments are written by a thread of the sink's own, so a slow disk
+    never holds up the scraping loop. Buffers that are due are handed to
+    it in pending.
+    """
+    def __init__(self, path, bootstrap_list, time_col, file_format='parquet',
+                 compression='zstd', flush_rows=10000, flush_seconds=300,
+                 max_rows=100000, feed=''):
+        pa = import_pyarrow()
+        if file_format not in ('parquet', 'arrow'):
+            raise ValueError("archive_format must be parquet or arrow.")
+        self.path = path
+        self.file_format = file_format
+        self.compression = None if compression == 'none' else compression
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.max_rows = max_rows
+        self.feed = feed  # Name the writer's metrics go under.
+        self.buffers = {}  # Table name: list of values lists.
+        self.first_buffered = {}  # Table name: when its buffer started.
+        self.cond = threading.Condition()
+        self.pending = {}  # Table name: rows handed to the writer.
+        self.due = set()  # Tables in pending to write now.
+        self.closing = False
+        self.dropped = 0
+        self.schemas = {}
+        self.time_index = {}
+        for entry in bootstrap_list:
+            columns = [column[0] for column in entry[1]]
+            self.time_index[entry[0]] = columns.index(time_col)
+            self.schemas[entry[0]] = pa.schema(
+                [(name, pa.timestamp('ms') if name == time_col
+                  else pa.float64()) for name in columns])
+        self.writer = threading.Thread(target=self.run, name="ArchiveWriter")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def append(self, changed_list):
+        """
+        Buffers the rows that have a time and flushes whatever is due.
+        """
+        now = time()
+        for row in changed_list:
+            values = row.values
+            if values[self.time_index[row.table]] is None:
+                continue
+            buffer = self.buffers.setdefault(row.table, [])
+            if not buffer:
+                self.first_buffered[row.table] = now
+            buffer.append(values[:])  # Rows are reused; keep a copy.
+        self.flush()
+
+    def flush(self, force=False):
+        """
+        Hands the buffers that are due to the writer.
+        """
+        now = time()
+        for table_name, buffer in self.buffers.items():
+            if buffer and (force or len(buffer) >= self.flush_rows or
+                           now - self.first_buffered[table_name] >=
+                           self.flush_seconds):
+                with self.cond:
+                    self.pending.setdefault(table_name, []).extend(buffer)
+                    self.trim(table_name)
+                    self.due.add(table_name)
+                    self.cond.notify()
+                self.buffers[table_name] = []
+
+    def trim(self, table_name):
+        """
+        Drops the oldest of a table's pending rows past max_rows. Called
+        with cond held.
+        """
+        rows = self.pending[table_name]
+        excess = len(rows) - self.max_rows
+        if excess > 0:
+            del rows[:excess]
+            self.dropped += excess
+            metrics.count('archive_dropped', excess, self.feed)
+            logger.error("Archive of %s is %d rows behind. Dropped the "
+                         "oldest %d.", table_name, self.max_rows, excess)
+
+    def run(self):
+        """
+        The writer thread. Rows that can't be written stay pending, less
+        any days that were, and are tried again flush_seconds later along
+        with whatever came in for their table meanwhile.
+        """
+        while True:
+            with self.cond:
+                if not (self.due or self.closing):
+                    self.cond.wait(self.flush_seconds if self.pending
+                                   else None)
+                if self.closing or not self.due:  # Time to retry.
+                    self.due.update(self.pending)
+                closing = self.closing
+                batches = [(table_name, self.pending.pop(table_name))
+                           for table_name in self.due]
+                self.due.clear()
+            for table_name, rows in batches:
+                try:
+                    self.write(table_name, rows)
+                except:
+                    logger.error("Can't archive %d rows of %s.%s",
+                                 len(rows), table_name,
+                                 "" if closing else " Will retry.",
+                                 exc_info=1)
+                    with self.cond:  # Newer rows go after these.
+                        rows.extend(self.pending.pop(table_name, []))
+                        self.pending[table_name] = rows
+                        self.trim(table_name)
+            if closing:
+                return
+
+    def close(self):
+        """
+        Hands over everything still buffered and waits for the writer to
+        have one last go at it.
+        """
+        self.flush(force=True)
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.writer.join()
+
+    def write(self, table_name, rows):
+        """
+        Writes rows as one segment per UTC day they fall in. Each day's
+        rows are taken out of rows once its segment is in place.
+        """
+        pa = pyarrow
+        schema = self.schemas[table_name]
+        time_index = self.time_index[table_name]
+        days = {}
+        for values in rows:
+            days.setdefault(values[time_index].date(), []).append(values)
+        for day, day_rows in days.items():
+            table = pa.Table.from_arrays(
+                [pa.array(column, type=field.type)
+                 for column, field in zip(zip(*day_rows), schema)],
+                schema=schema)
+            times = [values[time_index] for values in day_rows]
+            directory = os.path.join(self.path, table_name, day.isoformat())
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            first = (min(times) - EPOCH) // ONE_MS
+            last = (max(times) - EPOCH) // ONE_MS
+            stem = os.path.join(directory, '%d-%d' % (first, last))
+            final = stem + '.' + self.file_format
+            n = 0
+            while os.path.exists(final):  # Same span flushed twice.
+                n += 1
+                final = '%s-%d.%s' % (stem, n, self.file_format)
+            temp = final + '.tmp'
+            try:
+                if self.file_format == 'parquet':
+                    pa.parquet.write_table(table, temp,
+                                           compression=self.compression)
+                else:
+                    options = pa.ipc.IpcWriteOptions(
+                        compression=self.compression)
+                    with pa.OSFile(temp, 'wb') as sink:
+                        with pa.ipc.new_file(sink, schema,
+                                             options=options) as writer:
+                            writer.write_table(table)
+                os.replace(temp, final)
+            except:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+            rows[:] = [values for values in rows
+                       if values[time_index].date() != day]
+            logger.debug("Archived %d rows to %s", len(day_rows), final)
+
+
+def read_archive(path, table_name, start=None, end=None, columns=None):
+    """
+    Reads a table's archived rows with start <= time < end (naive UTC
+    datetimes, None for no limit) into one pyarrow Table sorted by time.
+    Segments are memory-mapped, and ones whose day or span in the file
+    name is outside the range are never opened. Returns None if there
+    is nothing.
+    """
+    pa = import_pyarrow()
+    start_ms = None if start is None else (start - EPOCH) // ONE_MS
+    end_ms = None if end is None else (end - EPOCH) // ONE_MS
+    base = os.path.join(path, table_name)
+    if not os.path.isdir(base):
+        return None
+    pieces = []
+    for day in sorted(os.listdir(base)):
+        if start is not None and day < start.date().isoformat():
+            continue
+        if end is not None and day > end.date().isoformat():
+            continue
+        for name in sorted(os.listdir(os.path.join(base, day))):
+            stem, extension = os.path.splitext(name)
+            if extension not in ('.parquet', '.arrow'):
+                continue  # .tmp files are still being written.
+            first, last = [int(ms) for ms in stem.split('-')[:2]]
+            if start_ms is not None and last < start_ms:
+                continue
+            if end_ms is not None and first >= end_ms:
+                continue
+            source = os.path.join(base, day, name)
+            if extension == '.parquet':
+                pieces.append(pa.parquet.read_table(source, memory_map=True))
+            else:
+                reader = pa.ipc.open_file(pa.memory_map(source))
+                pieces.append(reader.read_all())
+    if not pieces:
+        return None
+    table = pa.concat_tables(pieces)
+    time_name = table.schema.names[0]
+    if start is not None:
+        table = table.filter(pa.compute.greater_equal(
+            table[time_name], pa.scalar(start, pa.timestamp('ms'))))
+    if end is not None:
+        table = table.filter(pa.compute.less(
+            table[time_name], pa.scalar(end, pa.timestamp('ms'))))
+    table = table.sort_by(time_name)
+    if columns is not None:
+        table = table.select([time_name] + [name for name in columns
+                                            if name != time_name])
+    return table
+
+
+############ Scheduling #######################################################
+class MarketCalendar(object):
+    """
+    A config's market_hours as minute-of-the-week ranges in market_tz.
+    Checked by main() before every cycle.
+    """
+    week = 7 * 24 * 60
+
+    def __init__(self, market_hours, market_tz='UTC'):
+        self.tzinfo = gettz(market_tz)
+        if self.tzinfo is None:
+            raise ValueError("Unknown market_tz: " + market_tz)
+        self.sessions = []  # (first minute, last minute + 1) of the week.
+        for days, open_time, close_time in market_hours:
+            start = self.minutes(open_time)
+            end = self.minutes(close_time)
+            if end <= start:
+                end += 24 * 60
+            for day in days:
+                first = day * 24 * 60 + start
+                last = day * 24 * 60 + end
+                if last > self.week:  # Saturday into Monday.
+                    self.sessions.append((0, last - self.week))
+                    last = self.week
+                self.sessions.append((first, last))
+
+    @staticmethod
+    def minutes(hh_mm):
+        hours, minutes = hh_mm.split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def minute_of_week(self, now=None):
+        if now is None:
+            now = datetime.datetime.now(self.tzinfo)
+        return (now.weekday() * 24 * 60 + now.hour * 60 + now.minute +
+                now.second / 60.0)
+
+    def is_open(self, now=None):
+        if not self.sessions:
+            return True
+        minute = self.minute_of_week(now)
+        for first, last in self.sessions:
+            if first <= minute < last:
+                return True
+        return False
+
+    def seconds_until_open(self, now=None):
+        if self.is_open(now):
+            return 0
+        minute = self.minute_of_week(now)
+        return min((first - minute) % self.week
+                   for first, last in self.sessions) * 60
+
+
+class PollRate(object):
+    """
+    Works out a feed's next poll interval from how often its table has
+    been changing. change_rate is a moving average of the fraction of
+    polls that found something new. Most polls finding a change means
+    ticks are probably being missed, so the interval shrinks toward
+    floor. Few finding one means polls are being wasted, so it grows
+    toward ceiling.
+    """
+    def __init__(self, interval, floor, ceiling, smoothing=0.2):
+        self.interval = interval
+        self.floor = floor
+        self.ceiling = ceiling
+        self.smoothing = smoothing
+        self.change_rate = 0.5
+
+    def update(self, changed):
+        self.change_rate += self.smoothing * (changed - self.change_rate)
+        if self.change_rate > 0.8:
+            self.interval = max(self.floor, self.interval * 0.75)
+        elif self.change_rate < 0.2:
+            self.interval = min(self.ceiling, self.interval * 1.25)
+        return self.interval
+
+
+############ Feeds ############################################################
+class Feed(object):
+    """
+    One config's scraping state: its browser, its last known rows and its
+    counters. main() used to keep all of this in globals, which is what
+    limited us to one config per process.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.browser = None
+        self.plan = cfg.plan
+        self.spool = None
+        self.drainer = None
+        self.stream = None
+        if cfg.extraction_mode == 'stream':
+            self.stream = TickStream(cfg, self.plan)
+        self.calendar = cfg.calendar
+        self.poll_rate = None
+        if cfg.adaptive_refresh:
+            self.poll_rate = PollRate(cfg.refresh_rate, cfg.refresh_floor,
+                                      cfg.refresh_ceiling)
+        self.pool_browser = None  # What the pool handed out, unwrapped.
+        self.archive = None
+        if cfg.archive_path:
+            self.archive = ArchiveSink(cfg.archive_path, cfg.bootstrap_list,
+                                       cfg.time_col, cfg.archive_format,
+                                       cfg.archive_compression,
+                                       cfg.archive_flush_rows,
+                                       cfg.archive_flush_seconds,
+                                       cfg.archive_max_rows, cfg.dataname)
+        self.last_state = {}
+        self.started = False
+        self.failures = 0  # In a row.
+        self.total_rows_scraped = 0
+        self.last_write_time = time()
+        self.cycle_start = time()
+
+    def written(self):
+        """
+        (rows committed to the database, when the last ones were). Rows
+        that went through the spool count once the drainer wrote them,
+        not when they were spooled.
+        """
+        if self.drainer is None:
+            return self.total_rows_scraped, self.last_write_time
+        return (self.total_rows_scraped + self.drainer.rows_written,
+                max(self.last_write_time, self.drainer.last_write_time))
+
+    def start(self, browser):
+        """
+        Connects to the database, creates the tables and loads the last
+        rows. browser is anything with the Browser interface, or None if
+        the market is closed.
+        """
+        self.engine, self.metadata, self.conn = db_setup(self.cfg)
+        self.tables = setup_tables(self.cfg.bootstrap_list, self.metadata,
+                                   self.cfg.time_col, self.cfg.db_layout)
+        if browser is not None:
+            self.resume(browser)
+        self.last_write_time = time()
+        last_rows = fill_from_db(self.cfg.bootstrap_list, self.tables,
+                                 self.conn)
+        self.last_state = keyed_state(last_rows)
+        quotes.seed(self.cfg.dataname, last_rows)
+        if self.cfg.db_spool:
+            self.open_spool()
+        self.started = True
+
+    def open_spool(self):
+        """
+        Opens the spool and starts its drainer. With db_spool that's at
+        start. Without it, the first time a direct write fails.
+        """
+        cfg = self.cfg
+        path = cfg.spool_path or cfg.dataname + '_spool.db'
+        self.spool = Spool(path, cfg.time_col)
+        backlog = self.spool.backlog()
+        if backlog:
+            logger.error("%d rows left in %s. Draining.", backlog, path)
+        self.drainer = SpoolDrainer(self.spool, self.tables, self.engine,
+                                    cfg.time_col, cfg.spool_batch,
+                                    feed=cfg.dataname,
+                                    write_timeout=cfg.db_write_timeout,
+                                    grace=cfg.watchdog_grace)
+        self.drainer.start()
+
+    def resume(self, browser):
+        """
+        Takes a browser from the pool to scrape with.
+        """
+        self.pool_browser = browser
+        if self.cfg.record_path:
+            browser = RecordingBrowser(browser, self.cfg.record_path)
+        self.browser = browser
+
+    def suspend(self, pool):
+        """
+        Hands the browser back to the pool while the market is closed.
+        """
+        if self.cfg.record_path:
+            self.browser.close()
+        if self.stream is not None:
+            self.stream.body = None  # New browser, new observer.
+        pool.release(self.pool_browser)
+        self.browser = None
+        self.pool_browser = None
+
+    def fail(self, pool, error):
+        """
+        Takes the feed out of the loop after an error of its own: logs it,
+        gives the browser back to the pool and returns how long to wait
+        before trying again. Called from the except clause.
+        """
+        self.failures += 1
+        wait = min(feed_retry * 2 ** (self.failures - 1), 3600)
+        metrics.count('feed_failures', feed=self.cfg.dataname)
+        if isinstance(error, FeedError):
+            logger.critical("%s stopped: %s Trying again in %ds.",
+                            self.cfg.dataname, error, wait)
         else:
-            logger.debug("Write db: %s", str(entry))
-            total_rows_scraped += 1
+            logger.critical("%s failed. Trying again in %ds.",
+                            self.cfg.dataname, wait, exc_info=1)
+        if self.browser is not None:
+            try:
+                self.suspend(pool)
+            except:
+                logger.error("Can't give the browser back.", exc_info=1)
+        return wait
+
+    def close(self):
+        """
+        Writes out whatever the archive still has buffered.
+        """
+        if self.archive is not None:
+            self.archive.close()
+
+    def write(self, changed_list):
+        """
+        Writes the changed rows to the database, or to the spool with
+        db_spool on. Without it, a write that fails or times out puts the
+        rows in the spool instead, and so does every cycle after it until
+        the drainer has written them all. Then writes are direct again.
+        """
+        spooling = self.spool is not None and (
+            self.cfg.db_spool or not self.drainer.db_ok or
+            self.spool.backlog())
+        if not spooling:
+            try:
+                rows_written = watchdog.call(
+                    self.cfg.db_write_timeout, write2db,
+                    (changed_list, self.tables, self.conn),
+                    kill=self.conn.invalidate, grace=self.cfg.watchdog_grace,
+                    message="Database write timed out.")
+            except Exception:
+                metrics.count('db_errors')
+                logger.error("%s: database write failed. Spooling rows "
+                             "until it is back.", self.cfg.dataname)
+                if self.spool is None:
+                    self.open_spool()
+            else:
+                if rows_written:
+                    self.total_rows_scraped += rows_written
+                    self.last_write_time = time()
+                    metrics.count('rows_written', rows_written)
+                return
+        spooled = self.spool.append(changed_list)
+        self.drainer.wake()
+        if spooled:  # Counted as written once the drainer commits.
+            metrics.count('rows_spooled', spooled)
 
-            current_table = Table(entry[0], metadata)
-            inserter = current_table.insert()
-            insert_dict = dict(entry[1])  # keep this.
-            inserter.execute(insert_dict)
+    def cycle(self):
+        """
+        One pass of the scraping loop. Returns the time to sleep before
+        this feed is due again.
+        """
+        self.cycle_start = time()
+        metrics.feed = self.cfg.dataname
+        if self.stream is not None:
+            new_list = self.stream.fill(self.browser)
+        else:
+            new_list = fill_from_web(self.browser, self.cfg, self.plan)
+        start = time()
+        changed_list = compare_lists(self.last_state, new_list)
+        metrics.observe('diff', time() - start)
+        quotes.update(self.cfg.dataname, changed_list)
+        publisher.publish(self.cfg.dataname, changed_list)
+        start = time()
+        self.write(changed_list)
+        metrics.observe('db_write', time() - start)
+        if self.archive is not None:
+            start = time()
+            self.archive.append(changed_list)
+            metrics.observe('archive', time() - start)
 
-            last_write_time = time()
-            logger.debug("Finished db insert.")
+        self.browser.renew()  # Swaps in a fresh browser near lifetime.
 
-    return
+        cycle_length = time() - self.cycle_start
+        metrics.observe('cycle', cycle_length)
+        if self.stream is not None:
+            sleep_time = self.cfg.stream_interval - cycle_length
+        elif self.poll_rate is not None:
+            sleep_time = (self.poll_rate.update(len(changed_list) > 0) -
+                          cycle_length)
+        else:
+            sleep_time = self.cfg.refresh_rate - cycle_length
+        if sleep_time < 0:
+            sleep_time = 0
+        return sleep_time
 
 
 ############ Shut down ########################################################
+def quit_driver(driver):
+    try:
+        watchdog.call(30, driver.quit, kill=lambda: kill_driver(driver),
+                      message="Browser quit timed out.")
+    except:
+        logger.error("ERROR: Browser process won't die.", exc_info=1)
+    supervisor.forget(driver)
+
+
+def driver_process(driver):
+    """
+    The Popen of the driver's service process, or None.
+    """
+    return getattr(getattr(driver, 'service', None), 'process', None)
+
+
+def kill_driver(driver):
+    """
+    Kills the driver's process outright, for one that won't answer. The
+    supervisor cleans up whatever it leaves behind.
+    """
+    process = driver_process(driver)
+    if process is None:
+        logger.error("No driver process to kill.")
+        return
+    process.kill()
+
+
 def clean_up(browser):
     """
-    Closes any webdriver instances and ends program.
+    Closes any webdriver instances and ends program. Only for the whole
+    process (^C). A feed that can't go on raises FeedError instead.
+    Raises SystemExit, so main() still gets to quit the rest of the pool.
     """
-    global metadata
     logger.critical("Closing webdriver.")
 
     try:
@@ -806,18 +4761,28 @@ def clean_up(browser):
     except:
         logger.critical("Browser process won't terminate.")
     logger.critical("Exiting program.")
-    conn.close()  # Close connection.
-    engine.dispose()  # Actively close out connections.
-    metadata = None
+    for engine, metadata, conn in engines.values():
+        conn.close()  # Close connection.
+        engine.dispose()  # Actively close out connections.
+    engines.clear()
 
     sys.exit()
 
-#  Now: move db set up stuff inside of main() or at least inside of a function.
 ######### Main Function #######################################################
 
 
-def main():
+def main(configs, max_browsers=max_browsers, metrics_port=metrics_port,
+         metrics_path=metrics_path, metrics_interval=metrics_interval,
+         quotes_port=quotes_port, ticks_socket=ticks_socket,
+         max_browser_rss=max_browser_rss,
+         supervise_interval=supervise_interval):
     """
+    Runs every config's scraping loop from one scheduler. Each feed is due
+    refresh_rate seconds after its last cycle started (or whatever its
+    PollRate says); the scheduler just sleeps until the next one is due.
+    Outside its market_hours a feed gives its browser back to the pool and
+    isn't due again until the market opens.
+
     TODO:
     Not happy with the try...except capture of ^C as method to end while
     loop.
@@ -830,51 +4795,149 @@ def main():
     Or, look into one of the solutions that uses threads. Though, if I use
     threads here, I cannot use them for doing timeouts on page loads because
     the signals might get crossed.
+    (No signals anymore. Timeouts go through the watchdog, which works
+    from any thread.)
+
+    Stage timings and counters are kept in metrics. Serve them with
+    metrics_port or dump them to metrics_path to watch the feeds.
+    quotes_port serves the latest row of every table and ticks_socket
+    streams the changed rows. Every supervise_interval seconds the
+    browser processes are checked against max_browser_rss and each feed's
+    browser_rss_budget, and orphans and zombies are cleaned up.
+
+    A feed that fails (FeedError, or anything else out of its cycle) has
+    its browser taken back and is tried again feed_retry seconds later,
+    doubling each time. The other feeds don't notice.
     """
-    global last_write_time  # need to keep it global so I can reach it.
     logger.info("CFDscraper by Jonathan Morris Copyright 2014")
-    global metadata
-    global engine
-    global conn
-    engine, metadata, conn = db_setup()
-    setup_tables(bootstrap_list, metadata)
-    browser = Browser(browser_choice)
+    pool = BrowserPool(max_browsers)
+    feeds = [Feed(cfg) for cfg in configs]
     module_start_time = time()
-    last_write_time = time()
-    old_list = fill_from_db(bootstrap_list, conn)
-    logger.info("Starting scraping loop.")
+    schedule = []  # Heap of (due time, tie breaker, feed).
+    if metrics_port:
+        serve_metrics(metrics_port)
+    if metrics_path:
+        dump_metrics(metrics_path, metrics_interval)
+    if quotes_port:
+        serve_quotes(quotes_port)
+    if ticks_socket:
+        publisher.listen(ticks_socket)
+    if supervise_interval:
+        supervisor.start(supervise_interval, max_browser_rss)
 
     try:
-        while True:
-            cycle_start = time()
-            new_list = fill_from_web(browser, attribute)
-            changed_list = compare_lists(old_list, new_list)
-            write2db(changed_list)
-            old_list = new_list
-
-            if browser.age() > browser_lifetime:
-                logger.info("Lifetime exceeded. Refreshing.")
-                browser.refresh()
+        for number, feed in enumerate(feeds):
+            heapq.heappush(schedule, (time(), number, feed))
+        logger.info("Starting scraping loop.")
 
-            cycle_length = time() - cycle_start
-            sleep_time = refresh_rate - cycle_length
+        while True:
+            due, number, feed = heapq.heappop(schedule)
+            sleep_time = due - time()
+            if sleep_time > 0:
+                sleep(sleep_time)
+                metrics.observe('sleep', sleep_time, feed.cfg.dataname)
+            try:
+                if not feed.started:
+                    feed.start(None)
+                if not feed.calendar.is_open():
+                    if feed.browser is not None:
+                        logger.info("%s: market closed. Suspending browser.",
+                                    feed.cfg.dataname)
+                        feed.suspend(pool)
+                        metrics.count('suspensions', feed=feed.cfg.dataname)
+                    wait = min(feed.calendar.seconds_until_open(), 3600)
+                    heapq.heappush(schedule, (time() + wait, number, feed))
+                    continue
+                if feed.browser is None:
+                    logger.info("%s: market open. Starting browser.",
+                                feed.cfg.dataname)
+                    feed.resume(pool.acquire(feed.cfg))
+                sleep_time = feed.cycle()
+                feed.failures = 0
+            except Exception as error:
+                sleep_time = feed.fail(pool, error)
+            heapq.heappush(schedule, (time() + sleep_time, number, feed))
 
-            if sleep_time < 0:
-                sleep_time = 0
             # Write some stuff to stdout so I know it is alive.
             uptime = int(time() - module_start_time)
-            since_write = int(time() - last_write_time)
-            sys.stdout.write("\rRows: %d" % (total_rows_scraped))
+            written = [f.written() for f in feeds]
+            since_write = int(time() - max(at for rows, at in written))
+            sys.stdout.write("\rRows: %d" % sum(rows for rows, at in written))
+            sys.stdout.write(", Feeds: %d" % len(feeds))
+            failed = sum(1 for f in feeds if f.failures)
+            if failed:
+                sys.stdout.write(", Failed: %d" % failed)
+            closed = sum(1 for f in feeds
+                         if f.browser is None and not f.failures)
+            if closed:
+                sys.stdout.write(", Closed: %d" % closed)
             sys.stdout.write(", Uptime: %ss" % str(uptime))
             sys.stdout.write(", Since write: %ss" % str(since_write))
-            sys.stdout.write(", Sleeping: %.2fs" % sleep_time)
+            spooled = sum(f.spool.backlog() for f in feeds
+                          if f.spool is not None)
+            if spooled:
+                sys.stdout.write(", Spooled: %d" % spooled)
+            sys.stdout.write(", Sleeping: %.2fs" %
+                             max(schedule[0][0] - time(), 0))
             sys.stdout.flush()
-            sleep(sleep_time)
 
     except KeyboardInterrupt:
         logger.critical("^C from main loop.")
-        clean_up(browser)
+        clean_up(pool)
+    finally:
+        for feed in feeds:
+            feed.close()
+        publisher.close()
+        pool.quit()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Scrape financial web tables into a database.")
+    parser.add_argument('configs', nargs='*', default=[default_config_path],
+                        help="config files. One feed is run per file.")
+    parser.add_argument('--max-browsers', type=int, default=max_browsers,
+                        help="browser processes shared by all feeds.")
+    parser.add_argument('--metrics-port', type=int, default=metrics_port,
+                        help="serve stage timings and counters as JSON "
+                        "on this localhost port.")
+    parser.add_argument('--metrics-path', default=metrics_path,
+                        help="dump stage timings and counters as JSON to "
+                        "this file.")
+    parser.add_argument('--quotes-port', type=int, default=quotes_port,
+                        help="serve the latest row of every table as JSON "
+                        "on this localhost port.")
+    parser.add_argument('--ticks-socket', default=ticks_socket,
+                        help="stream changed rows as NDJSON on this Unix "
+                        "socket.")
+    parser.add_argument('--max-browser-rss', type=int,
+                        default=max_browser_rss,
+                        help="MB all browser processes may use before the "
+                        "heaviest is recycled. 0 is no limit.")
+    parser.add_argument('--supervise-interval', type=float,
+                        default=supervise_interval,
+                        help="seconds between checks on the browser "
+                        "processes. 0 turns the supervisor off.")
+    parser.add_argument('--migrate-ticks', action='store_true',
+                        help="copy the configs' per-instrument tables into "
+                        "the ticks table and exit.")
+    parser.add_argument('--metrics-interval', type=float,
+                        default=metrics_interval,
+                        help="seconds between metrics dumps.")
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
-    main()
+    args = parse_args(sys.argv[1:])
+    for filename in args.configs:
+        print("loading config file:" + filename)
+    configs = [import_config(filename) for filename in args.configs]
+    setup_logging(configs[0].logpath)  # First config's log is shared.
+    if args.migrate_ticks:
+        for cfg in configs:
+            migrate_to_ticks(cfg)
+        sys.exit()
+    main(configs, args.max_browsers, args.metrics_port, args.metrics_path,
+         args.metrics_interval, args.quotes_port, args.ticks_socket,
+         args.max_browser_rss, args.supervise_interval)
     sys.exit()
@@ -0,0 +1,52 @@
+import datetime
+from time import sleep
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from CFDscraper import ArchiveSink, Row, read_archive
+
+BOOTSTRAP = [("EUR_USD_fx_CFD", (("UTCTime", "EUR/USD", "Time"),
+                                 ("Value", "EUR/USD", "Bid")))]
+COLUMNS = ("UTCTime", "Value")
+TICK_TIME = datetime.datetime(2014, 1, 2, 10, 0, 0)
+
+
+def ticks(values):
+    return [Row("EUR_USD_fx_CFD", COLUMNS,
+                [TICK_TIME + datetime.timedelta(seconds=n), value])
+            for n, value in enumerate(values)]
+
+
+def archived(path):
+    table = read_archive(path, "EUR_USD_fx_CFD")
+    return [] if table is None else table.column("Value").to_pylist()
+
+
+def test_rows_are_written_by_close(tmp_path):
+    path = str(tmp_path / 'archive')
+    sink = ArchiveSink(path, BOOTSTRAP, "UTCTime")
+    sink.append(ticks([1.3751, 1.3752]))
+    assert archived(path) == []  # Not due yet.
+    sink.close()
+    assert archived(path) == [1.3751, 1.3752]
+
+
+def test_unwritable_archive_keeps_newest_rows(tmp_path):
+    path = tmp_path / 'archive'
+    path.write_text('')  # A file where the directory should be.
+    sink = ArchiveSink(str(path), BOOTSTRAP, "UTCTime", flush_rows=2,
+                       flush_seconds=3600, max_rows=3)
+    values = [1.3751, 1.3752, 1.3753, 1.3754, 1.3755, 1.3756]
+    for row in ticks(values):
+        sink.append([row])
+    for _ in range(100):  # Let the writer fail on the last of them.
+        if sink.dropped == 3:
+            break
+        sleep(0.05)
+    sleep(0.2)
+    path.unlink()  # Writable again.
+    sink.close()
+    assert sink.dropped == 3
+    assert archived(str(path)) == values[3:]
@@ -0,0 +1,62 @@
+import datetime
+
+import pytest
+
+from CFDscraper import MarketCalendar, PollRate
+
+FX = [((6, 0, 1, 2, 3), '22:00', '22:00')]  # Sunday 22:00 to Friday 22:00.
+SUNDAY = datetime.datetime(2014, 1, 5)
+
+
+def at(days, hours, minutes=0):
+    return SUNDAY + datetime.timedelta(days=days, hours=hours,
+                                       minutes=minutes)
+
+
+@pytest.mark.parametrize('now, is_open', [
+    (at(0, 21, 59), False),
+    (at(0, 22), True),
+    (at(1, 10), True),  # Monday, from Sunday's session.
+    (at(5, 21, 59), True),  # Friday.
+    (at(5, 22), False),
+    (at(6, 12), False)])  # Saturday.
+def test_fx_week(now, is_open):
+    assert MarketCalendar(FX, 'Europe/London').is_open(now) == is_open
+
+
+def test_session_past_the_end_of_the_week_wraps_to_monday():
+    calendar = MarketCalendar([((6,), '22:00', '06:00')])
+    assert calendar.is_open(at(0, 23))
+    assert calendar.is_open(at(1, 5, 59))
+    assert not calendar.is_open(at(1, 6))
+
+
+def test_seconds_until_open():
+    calendar = MarketCalendar(FX)
+    assert calendar.seconds_until_open(at(1, 10)) == 0
+    assert calendar.seconds_until_open(at(6, 22)) == 24 * 3600
+    assert calendar.seconds_until_open(at(5, 23)) == 47 * 3600
+
+
+def test_seconds_until_open_wraps_the_week():
+    calendar = MarketCalendar([((6,), '22:00', '06:00')])
+    assert calendar.seconds_until_open(at(1, 7)) == (6 * 24 + 15) * 3600
+
+
+def test_no_hours_is_always_open():
+    assert MarketCalendar([]).is_open(at(6, 12))
+
+
+def test_unknown_zone_is_refused():
+    with pytest.raises(ValueError):
+        MarketCalendar(FX, 'Nowhere/Special')
+
+
+def test_poll_rate_follows_the_table():
+    rate = PollRate(10, 2, 60)
+    for _ in range(50):
+        rate.update(True)
+    assert rate.interval == 2
+    for _ in range(50):
+        rate.update(False)
+    assert rate.interval == 60
@@ -0,0 +1,33 @@
+import datetime
+
+from CFDscraper import Row, compare_lists, keyed_state
+
+COLUMNS = ("UTCTime", "Value")
+TICK_TIME = datetime.datetime(2014, 1, 2, 10, 0, 0)
+
+
+def row(table, value, utc_time=TICK_TIME):
+    return Row(table, COLUMNS, [utc_time, value])
+
+
+def test_only_changed_rows_come_back():
+    state = keyed_state([row("EUR", 1.3751), row("JPY", 80.5)])
+    changed = compare_lists(state, [row("EUR", 1.3751), row("JPY", 80.6)])
+    assert [(r.table, r.values[1]) for r in changed] == [("JPY", 80.6)]
+    assert state["JPY"] == [TICK_TIME, 80.6]
+    assert compare_lists(state, [row("EUR", 1.3751), row("JPY", 80.6)]) == []
+
+
+def test_empty_table_and_new_table_count_as_changed():
+    state = keyed_state([row("EUR", None, None)])
+    new_list = [row("EUR", 1.3751), row("CHF", 0.9)]
+    assert compare_lists(state, new_list) == new_list
+
+
+def test_state_keeps_copies_of_reused_rows():
+    state = {}
+    reused = row("EUR", 1.3751)
+    compare_lists(state, [reused])
+    reused.values[1] = 1.3752  # The plan refills its Rows in place.
+    assert state["EUR"] == [TICK_TIME, 1.3751]
+    assert compare_lists(state, [reused]) == [reused]
@@ -0,0 +1,22 @@
+import pytest
+
+import CFDscraper
+from CFDscraper import Config
+
+
+def config(**settings):
+    namespace = dict(vars(CFDscraper))
+    namespace.update(settings)
+    return Config(namespace)
+
+
+def test_defaults_are_good():
+    assert config().check() == []
+
+
+@pytest.mark.parametrize('mode', ['script', 'stream'])
+def test_http_needs_source_mode(mode):
+    with pytest.raises(ValueError, match="extraction_mode '%s'" % mode):
+        config(browser_choice='HTTP', extraction_mode=mode)
+    config(browser_choice='chrome', extraction_mode=mode)
+    config(browser_choice='http', extraction_mode='source')
@@ -0,0 +1,65 @@
+import datetime
+
+import pytest
+
+from CFDscraper import DayAnchor, FeedError, custom_date_parser
+
+
+def anchor_on(web_tz, today, after_midnight=False):
+    anchor = DayAnchor(web_tz)
+    day = datetime.date(*today)
+    yesterday = day - datetime.timedelta(days=1)
+    anchor.today = (day.year, day.month, day.day)
+    anchor.yesterday = (yesterday.year, yesterday.month, yesterday.day)
+    anchor.after_midnight = after_midnight
+    return anchor
+
+
+def test_late_time_just_after_midnight_is_yesterday():
+    anchor = anchor_on('GMT', (2014, 1, 1), after_midnight=True)
+    assert anchor.datetime(23, 59, 58) == datetime.datetime(2013, 12, 31,
+                                                            23, 59, 58)
+    assert anchor.datetime(0, 0, 1) == datetime.datetime(2014, 1, 1, 0, 0, 1)
+
+
+def test_late_time_later_in_the_day_is_today():
+    anchor = anchor_on('GMT', (2014, 1, 1))
+    assert anchor.datetime(23, 59, 58) == datetime.datetime(2014, 1, 1,
+                                                            23, 59, 58)
+
+
+@pytest.mark.parametrize('today, utc_hour', [((2014, 1, 2), 15),
+                                             ((2014, 7, 1), 14)])
+def test_page_time_is_moved_to_utc(today, utc_hour):
+    anchor = anchor_on('America/New_York', today)
+    assert anchor.datetime(10, 0, 0) == datetime.datetime(
+        *today + (utc_hour, 0, 0))
+
+
+def test_yesterday_in_another_zone_is_moved_to_utc():
+    anchor = anchor_on('Asia/Tokyo', (2014, 1, 1), after_midnight=True)
+    assert anchor.datetime(23, 30, 0) == datetime.datetime(2013, 12, 31,
+                                                           14, 30, 0)
+
+
+def test_today_follows_the_page_zone():
+    anchor = DayAnchor('Pacific/Kiritimati')  # UTC+14.
+    now = datetime.datetime.utcnow() + datetime.timedelta(hours=14)
+    assert anchor.today == (now.year, now.month, now.day)
+
+
+def test_unknown_zone_is_refused():
+    with pytest.raises(ValueError):
+        DayAnchor('Nowhere/Special')
+
+
+def test_date_parser_formats():
+    anchor = anchor_on('GMT', (2014, 1, 2))
+    assert custom_date_parser('9:59:58', None, anchor=anchor) == (
+        datetime.datetime(2014, 1, 2, 9, 59, 58))
+    assert custom_date_parser('10:00:01', None, anchor=anchor) == (
+        datetime.datetime(2014, 1, 2, 10, 0, 1))
+    assert custom_date_parser('Jan 02', None, anchor=anchor) is None
+    for bad in ('1:2:3', '10:00:0x'):
+        with pytest.raises(FeedError):
+            custom_date_parser(bad, None, anchor=anchor)
@@ -0,0 +1,112 @@
+from time import sleep
+
+import pytest
+
+import CFDscraper
+from CFDscraper import BrowserGroup, FeedError
+
+
+class Config(object):
+    browser_choice = 'chrome'
+    attribute = {'id': 'rates'}
+    stale_after = 2
+    browser_lifetime = 3600
+
+
+class Clock(object):
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeBrowser(object):
+    """
+    A group member whose table is whatever cells is set to. An exception
+    in cells is raised instead.
+    """
+    made = 0
+
+    def __init__(self, cfg, background=False):
+        FakeBrowser.made += 1
+        self.name = FakeBrowser.made
+        self.cells = '[]'
+        self.over_budget = False
+        self.start_time = 0
+        self.refreshes = 0
+        self.quit_called = False
+
+    def timed_script(self, script, selector):
+        if isinstance(self.cells, Exception):
+            raise self.cells
+        return self.cells
+
+    def refresh(self):
+        self.refreshes += 1
+
+    def quit(self):
+        self.quit_called = True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(CFDscraper, 'time', clock)
+    monkeypatch.setattr(CFDscraper, 'Browser', FakeBrowser)
+    return clock
+
+
+def poll(group, clock, now, *cells):
+    clock.now = now
+    for member, member_cells in zip(group.members, cells):
+        member.cells = member_cells
+    return group.table_cells(Config.attribute)
+
+
+def replacements(group):
+    for _ in range(100):
+        if not group.pending:
+            break
+        sleep(0.01)
+        group.adopt_replacements()
+    return group.members
+
+
+def test_stale_member_is_replaced(clock):
+    group = BrowserGroup(Config(), 2)
+    first, second = group.members
+    poll(group, clock, 1, 'a1', 'b1')
+    poll(group, clock, 2, 'a2', 'b1')
+    assert second in group.members  # 1s behind.
+    assert poll(group, clock, 5, 'a3', 'b1') == 'a3'
+    assert group.members == [first]
+    assert group.serving is first
+    members = replacements(group)
+    assert len(members) == 2 and second not in members
+    assert second.quit_called
+
+
+def test_freshest_member_is_served(clock):
+    group = BrowserGroup(Config(), 2)
+    assert poll(group, clock, 1, 'a1', 'b1') == 'a1'
+    assert poll(group, clock, 2, 'a1', 'b2') == 'b2'
+    assert poll(group, clock, 3, 'a1', 'b2') == 'b2'
+    assert poll(group, clock, 4, 'a2', 'b3') == 'b3'  # Kept on a tie.
+    assert poll(group, clock, 5, 'a3', 'b3') == 'a3'
+
+
+def test_failing_member_is_replaced(clock):
+    group = BrowserGroup(Config(), 2)
+    first, second = group.members
+    assert poll(group, clock, 1, RuntimeError("gone"), 'b1') == 'b1'
+    assert group.members == [second]
+    assert len(replacements(group)) == 2
+
+
+def test_last_member_is_refreshed_not_dropped(clock):
+    group = BrowserGroup(Config(), 1)
+    only = group.members[0]
+    with pytest.raises(FeedError):
+        poll(group, clock, 1, None)  # No table.
+    assert group.members == [only]
+    assert only.refreshes == 1
@@ -0,0 +1,85 @@
+import threading
+from http.server import HTTPServer
+from time import sleep
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from CFDbench import PageHandler
+from CFDscraper import FeedError, HttpBrowser, HttpFetcher
+
+PAGE = b'<table id="rates"><tr><td>EUR/USD</td><td>1.3751</td></tr></table>'
+
+
+class Config(object):
+    refresh_rate = 0.1
+    page_source_timeout = 5
+
+    def __init__(self, url_string):
+        self.url_string = url_string
+
+
+@pytest.fixture
+def pages(tmp_path):
+    (tmp_path / 'rates.html').write_bytes(PAGE)
+    handler = type('Handler', (PageHandler,), {'page_dir': str(tmp_path)})
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield tmp_path, 'http://127.0.0.1:%d/' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = HttpFetcher()
+    yield fetcher
+    fetcher.close()
+
+
+def test_unchanged_page_is_not_modified(pages, fetcher):
+    page_dir, url = pages
+    browser = HttpBrowser(fetcher, Config(url + 'rates'))
+    assert browser.source() == PAGE.decode()
+    sleep(0.5)
+    page = fetcher.pages[url + 'rates']
+    assert page['fetches'] > 1
+    assert page['not_modified'] == page['fetches'] - 1
+    assert browser.source() == PAGE.decode()
+    browser.quit()
+
+
+def test_changed_page_is_fetched(pages, fetcher):
+    page_dir, url = pages
+    browser = HttpBrowser(fetcher, Config(url + 'rates'))
+    browser.source()
+    new_page = PAGE.replace(b'1.3751', b'1.3752')
+    (page_dir / 'rates.html').write_bytes(new_page)
+    sleep(0.5)
+    assert browser.source() == new_page.decode()
+    browser.quit()
+
+
+def test_url_is_fetched_until_last_watcher_quits(pages, fetcher):
+    page_dir, url = pages
+    first = HttpBrowser(fetcher, Config(url + 'rates'))
+    second = HttpBrowser(fetcher, Config(url + 'rates'))
+    first.source()
+    first.quit()
+    first.quit()  # Twice is once.
+    assert url + 'rates' in fetcher.tasks
+    second.quit()
+    assert url + 'rates' not in fetcher.tasks
+
+
+def test_missing_page_stops_feed(pages, fetcher):
+    page_dir, url = pages
+    cfg = Config(url + 'gone')
+    cfg.page_source_timeout = 0.5
+    browser = HttpBrowser(fetcher, cfg)
+    with pytest.raises(FeedError):
+        browser.source()
+    browser.quit()
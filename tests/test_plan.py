@@ -0,0 +1,64 @@
+import datetime
+
+import pytest
+
+from CFDscraper import CellPlan, FeedError, fill_from_table
+
+BOOTSTRAP = [("EUR_USD_fx_CFD", (("UTCTime", "EUR/USD", "Time"),
+                                 ("Value", "EUR/USD", "Bid"))),
+             ("US_30_CFD", (("UTCTime", "US 30", "Time"),
+                            ("Value", "US 30", "Bid")))]
+HEADER = ["Name", "Bid", "Time"]
+BODY = [["EUR/USD", "1.3751", "10:00:01"], ["US 30", "16,441.5", "9:59:58"]]
+
+
+class Config(object):
+    web_tz = 'GMT'
+
+
+def fill(plan, header, body):
+    return [(row.table, row.values[0].time(), row.values[1])
+            for row in fill_from_table(header, body, None, Config(), plan)]
+
+
+@pytest.fixture
+def plan():
+    return CellPlan(BOOTSTRAP, "UTCTime", "Name")
+
+
+def test_cells_are_read_where_resolved(plan):
+    assert fill(plan, HEADER, BODY) == [
+        ("EUR_USD_fx_CFD", datetime.time(10, 0, 1), 1.3751),
+        ("US_30_CFD", datetime.time(9, 59, 58), 16441.5)]
+    assert plan.addresses == [(0, 2), (0, 1), (1, 2), (1, 1)]
+    assert plan.still_valid(HEADER, BODY)
+
+
+def test_rows_moved_are_resolved_again(plan):
+    fill(plan, HEADER, BODY)
+    body = [["GBP/USD", "1.6", "10:00:02"]] + BODY[::-1]
+    assert not plan.still_valid(HEADER, body)
+    assert fill(plan, HEADER, body) == [
+        ("EUR_USD_fx_CFD", datetime.time(10, 0, 1), 1.3751),
+        ("US_30_CFD", datetime.time(9, 59, 58), 16441.5)]
+    assert plan.addresses == [(2, 2), (2, 1), (1, 2), (1, 1)]
+
+
+def test_header_changed_is_resolved_again(plan):
+    fill(plan, HEADER, BODY)
+    header = ["Time", "Name", "Bid"]
+    body = [[row[2], row[0], row[1]] for row in BODY]
+    assert not plan.still_valid(header, body)
+    assert fill(plan, header, body)[0] == (
+        "EUR_USD_fx_CFD", datetime.time(10, 0, 1), 1.3751)
+
+
+def test_missing_row_stops_feed(plan):
+    with pytest.raises(FeedError):
+        fill(plan, HEADER, BODY[:1])
+
+
+def test_rows_are_reused(plan):
+    first = fill_from_table(HEADER, BODY, None, Config(), plan)
+    second = fill_from_table(HEADER, BODY, None, Config(), plan)
+    assert [id(row) for row in first] == [id(row) for row in second]
@@ -0,0 +1,128 @@
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from CFDscraper import FilterProxy, ResourcePolicy
+
+
+class Upstream(BaseHTTPRequestHandler):
+    """
+    Answers every GET with a short page, or an image under /img.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/img'):
+            content_type, body = 'image/png', b'\x89PNG'
+        else:
+            content_type, body = 'text/html', b'<table></table>'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = HTTPServer(('127.0.0.1', 0), Upstream)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def proxy():
+    policy = ResourcePolicy(hosts=['ads.example'], urls=['*/track/*'],
+                            types=['image'])
+    proxy = FilterProxy(policy, 'test')
+    yield proxy
+    proxy.shutdown()
+    proxy.server_close()
+
+
+def responses(proxy, requests):
+    """
+    Sends the requests back to back on one connection and returns each
+    response's status line, or what came back after the connection
+    closed.
+    """
+    connection = socket.create_connection(('127.0.0.1', proxy.port), 5)
+    connection.sendall(b''.join(requests))
+    reader = connection.makefile('rb')
+    statuses = []
+    for _ in requests:
+        status = reader.readline().decode('latin-1').strip()
+        statuses.append(status)
+        length = 0
+        while True:
+            line = reader.readline().decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        reader.read(length)
+    connection.close()
+    return statuses
+
+
+def request(method, url, body=b''):
+    head = '%s %s HTTP/1.1\r\nHost: x\r\n' % (method, url)
+    if body:
+        head += 'Content-Length: %d\r\n' % len(body)
+    return (head + '\r\n').encode('latin-1') + body
+
+
+@pytest.mark.parametrize('url, blocked', [
+    ('http://ads.example/x.js', True),
+    ('http://cdn.ads.example/x.js', True),
+    ('http://notads.example/x.js', False),
+    ('http://site.example/track/pixel', True),
+    ('http://site.example/logo.PNG', True),
+    ('http://site.example/quotes', False)])
+def test_policy_blocks(url, blocked):
+    policy = ResourcePolicy(hosts=['ads.example'], urls=['*/track/*'],
+                            types=['image'])
+    assert policy.blocks(url) == blocked
+
+
+def test_policy_blocks_type():
+    policy = ResourcePolicy(types=['font', 'stylesheet'])
+    assert policy.blocks_type('text/css; charset=utf-8')
+    assert policy.blocks_type('font/woff2')
+    assert not policy.blocks_type('text/html')
+    assert not policy.blocks_type(None)
+
+
+def test_passed_and_blocked_on_one_connection(proxy, upstream):
+    assert responses(proxy, [request('GET', upstream + '/quotes'),
+                             request('GET', 'http://ads.example/a.js'),
+                             request('GET', upstream + '/quotes')]) == [
+        'HTTP/1.1 200 OK', 'HTTP/1.1 403 Forbidden', 'HTTP/1.1 200 OK']
+
+
+def test_blocked_body_is_not_taken_for_next_request(proxy, upstream):
+    body = b'x' * 20
+    assert responses(proxy, [request('POST', upstream + '/track/a', body),
+                             request('GET', upstream + '/quotes')]) == [
+        'HTTP/1.1 403 Forbidden', 'HTTP/1.1 200 OK']
+
+
+def test_blocked_content_type_keeps_connection(proxy, upstream):
+    body = b'x' * 20
+    assert responses(proxy, [request('POST', upstream + '/img/a', body),
+                             request('GET', upstream + '/quotes')]) == [
+        'HTTP/1.1 403 Forbidden', 'HTTP/1.1 200 OK']
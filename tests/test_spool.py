@@ -0,0 +1,101 @@
+import datetime
+from time import sleep
+
+import pytest
+from sqlalchemy import MetaData, create_engine
+
+import CFDscraper
+from CFDscraper import Config, Feed, Row, Spool, SpoolDrainer, setup_tables
+
+BOOTSTRAP = [("EUR_USD_fx_CFD", (("UTCTime", "EUR/USD", "Time"),
+                                 ("Value", "EUR/USD", "Bid")))]
+COLUMNS = ("UTCTime", "Value")
+TICK_TIME = datetime.datetime(2014, 1, 2, 10, 0, 0)
+
+
+@pytest.fixture
+def drainer(tmp_path):
+    engine = create_engine('sqlite:///' + str(tmp_path / 'db.sqlite'))
+    tables = setup_tables(BOOTSTRAP, MetaData(bind=engine), "UTCTime")
+    spool = Spool(str(tmp_path / 'spool.db'), "UTCTime")
+    return SpoolDrainer(spool, tables, engine, "UTCTime")
+
+
+def stored(drainer):
+    table = drainer.tables["EUR_USD_fx_CFD"]
+    return sorted(tuple(row) for row in drainer.engine.execute(
+        table.select().with_only_columns([table.c.UTCTime, table.c.Value])))
+
+
+def tick(value, utc_time=TICK_TIME):
+    return Row("EUR_USD_fx_CFD", COLUMNS, [utc_time, value])
+
+
+def test_same_second_rows_are_all_drained(drainer):
+    assert drainer.spool.append([tick(1.3751), tick(1.3752)]) == 2
+    assert drainer.spool.backlog() == 2
+    assert drainer.drain_once() == 2
+    assert drainer.spool.backlog() == 0
+    assert drainer.rows_written == 2
+    assert stored(drainer) == [(TICK_TIME, 1.3751), (TICK_TIME, 1.3752)]
+
+
+def test_replayed_rows_are_skipped(drainer):
+    drainer.spool.append([tick(1.3751)])
+    drainer.drain_once()
+    # Committed, then a crash before the spool was trimmed: replay it,
+    # along with a change that shares its time.
+    drainer.spool.append([tick(1.3751), tick(1.3753)])
+    assert drainer.drain_once() == 2
+    assert drainer.rows_written == 2
+    assert stored(drainer) == [(TICK_TIME, 1.3751), (TICK_TIME, 1.3753)]
+
+
+def test_rows_without_time_are_not_spooled(drainer):
+    assert drainer.spool.append([tick(None, None)]) == 0
+    assert drainer.drain_once() == 0
+
+
+def test_spool_keeps_rows_through_restart(tmp_path):
+    path = str(tmp_path / 'spool.db')
+    Spool(path, "UTCTime").append([tick(1.3751), tick(1.3752)])
+    rows = Spool(path, "UTCTime").take(10)
+    assert [(name, row) for seq, name, row in rows] == [
+        ("EUR_USD_fx_CFD", {"UTCTime": TICK_TIME, "Value": 1.3751}),
+        ("EUR_USD_fx_CFD", {"UTCTime": TICK_TIME, "Value": 1.3752})]
+
+
+
+@pytest.fixture
+def feed(tmp_path):
+    namespace = dict(vars(CFDscraper))
+    namespace.update(dataname='test', bootstrap_list=BOOTSTRAP,
+                     time_col="UTCTime",
+                     spool_path=str(tmp_path / 'spool.db'))
+    feed = Feed(Config(namespace))
+    feed.engine = create_engine('sqlite:///' + str(tmp_path / 'db.sqlite'))
+    feed.metadata = MetaData(bind=feed.engine)
+    feed.tables = setup_tables(BOOTSTRAP, feed.metadata, "UTCTime")
+    feed.conn = feed.engine.connect()
+    return feed
+
+
+def test_failed_direct_write_is_spooled(feed):
+    table = feed.tables["EUR_USD_fx_CFD"]
+    feed.write([tick(1.3751)])
+    assert feed.spool is None
+    table.drop()  # The database goes away.
+    feed.write([tick(1.3752)])
+    feed.write([tick(1.3753)])  # Still spooled, behind the first.
+    assert feed.spool.backlog() == 2
+    table.create()  # And comes back.
+    feed.drainer.wake()
+    for _ in range(100):
+        if not feed.spool.backlog() and feed.drainer.db_ok:
+            break
+        sleep(0.1)
+    feed.write([tick(1.3754)])  # Caught up: direct again.
+    assert feed.written()[0] == 4
+    assert feed.spool.backlog() == 0
+    assert [row[2] for row in feed.engine.execute(
+        table.select().order_by(table.c.id))] == [1.3752, 1.3753, 1.3754]
@@ -0,0 +1,66 @@
+import json
+
+from CFDscraper import CellPlan, TickStream
+
+BOOTSTRAP = [("EUR_USD_fx_CFD", (("Value", "EUR/USD", "Bid"),)),
+             ("USD_JPY_fx_CFD", (("Value", "USD/JPY", "Bid"),))]
+HEADER = ["Name", "Bid"]
+
+
+class Config(object):
+    attribute = {'id': 'rates'}
+    table_extractor = 'lxml'
+    web_tz = 'GMT'
+    stream_resync = 3600
+
+
+class StreamBrowser(object):
+    """
+    What TickStream uses of a Browser: the table read by script, the
+    observer and the ticks it saw.
+    """
+    def __init__(self, body):
+        self.body = body
+        self.ticks = []
+
+    def table_cells(self, attribute):
+        return json.dumps([HEADER, self.body])
+
+    def watch_table(self, attribute):
+        return True
+
+    def drain_ticks(self):
+        ticks, self.ticks = self.ticks, []
+        return json.dumps(ticks)
+
+
+def values(list_of_rows):
+    return [(row.table, row.values[0]) for row in list_of_rows]
+
+
+def stream(body):
+    plan = CellPlan(BOOTSTRAP, "UTCTime", "Name")
+    browser = StreamBrowser(body)
+    return TickStream(Config(), plan), browser
+
+
+def test_every_tick_comes_out_in_order():
+    ticks, browser = stream([["EUR/USD", "1.3751"], ["USD/JPY", "80.5"]])
+    assert values(ticks.fill(browser)) == [("EUR_USD_fx_CFD", 1.3751),
+                                           ("USD_JPY_fx_CFD", 80.5)]
+    browser.ticks = [[0, ["EUR/USD", "1.3752"]], [0, ["GBP/USD", "1.6"]],
+                     [0, ["EUR/USD", "1.3753"]]]
+    assert values(ticks.fill(browser)) == [("EUR_USD_fx_CFD", 1.3752),
+                                           ("EUR_USD_fx_CFD", 1.3753)]
+
+
+def test_resync_keeps_ticks_drained_before_it():
+    ticks, browser = stream([["EUR/USD", "1.3751"], ["USD/JPY", "80.5"]])
+    ticks.fill(browser)
+    # A cell was added to the row: the rest comes from the whole table.
+    browser.body = [["EUR/USD", "1.3753", ""], ["USD/JPY", "80.6", ""]]
+    browser.ticks = [[0, ["EUR/USD", "1.3752"]],
+                     [0, ["EUR/USD", "1.3753", ""]]]
+    assert values(ticks.fill(browser)) == [("EUR_USD_fx_CFD", 1.3752),
+                                           ("EUR_USD_fx_CFD", 1.3753),
+                                           ("USD_JPY_fx_CFD", 80.6)]
@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+from time import sleep
+
+import pytest
+
+from CFDscraper import ProcessSupervisor
+
+pytestmark = pytest.mark.skipif(not os.path.isdir('/proc/self/task'),
+                                reason="The supervisor reads /proc.")
+
+
+class FakeDriver(object):
+    """
+    What register() looks at in a selenium driver: service.process.
+    """
+    def __init__(self, process):
+        self.service = self
+        self.process = process
+
+
+@pytest.fixture
+def supervisor():
+    supervisor = ProcessSupervisor()
+    supervisor.pid = os.getpid()
+    supervisor.clock_ticks = os.sysconf('SC_CLK_TCK')
+    supervisor.page_size = os.sysconf('SC_PAGE_SIZE')
+    supervisor.orphan_grace = 0
+    return supervisor
+
+
+@pytest.fixture
+def child():
+    """
+    A child of ours that no Browser has registered: a starting driver,
+    or an orphan.
+    """
+    process = subprocess.Popen([sys.executable, '-c',
+                                'import time; time.sleep(60)'])
+    sleep(0.2)  # Older than orphan_grace.
+    yield process
+    process.kill()
+    process.wait()
+
+
+def clean_up(supervisor, pid, drivers=None, starting=0):
+    table = supervisor.processes()
+    children = {}
+    for member, stat in table.items():
+        children.setdefault(stat[1], []).append(member)
+    with open('/proc/uptime') as uptime_file:
+        uptime = float(uptime_file.read().split()[0])
+    supervisor.clean_up([pid], table, drivers or {}, children, uptime,
+                        starting)
+    sleep(0.1)
+
+
+def test_starting_driver_is_left_alone(supervisor, child):
+    clean_up(supervisor, child.pid, starting=1)
+    assert child.poll() is None
+
+
+def test_registered_driver_is_left_alone(supervisor, child):
+    supervisor.register(object(), FakeDriver(child))
+    clean_up(supervisor, child.pid, drivers=dict(supervisor.drivers))
+    assert child.poll() is None
+
+
+def test_orphan_is_killed(supervisor, child):
+    clean_up(supervisor, child.pid)
+    assert child.wait(5) == -9
+
+
+def test_opening_counts_starting_drivers(supervisor):
+    supervisor.opening(1)
+    supervisor.opening(1)
+    supervisor.opening(-1)
+    assert supervisor.starting == 1
+
+
+def test_sample_waits_for_starting_driver(supervisor, child):
+    supervisor.opening(1)  # As new_driver() does before the constructor.
+    supervisor.sample()
+    sleep(0.1)
+    assert child.poll() is None
+    supervisor.opening(-1)  # Constructor failed: nobody registered it.
+    supervisor.sample()
+    assert child.wait(5) == -9
@@ -0,0 +1,84 @@
+import datetime
+
+import pytest
+from sqlalchemy import MetaData, create_engine
+
+from CFDscraper import Row, TickStore, fill_from_db, write2db
+
+BOOTSTRAP = [("EUR_USD_fx_CFD", (("UTCTime", "EUR/USD", "Time"),
+                                 ("Value", "EUR/USD", "Bid"))),
+             ("USD_JPY_fx_CFD", (("UTCTime", "USD/JPY", "Time"),
+                                 ("Value", "USD/JPY", "Bid")))]
+COLUMNS = ("UTCTime", "Value")
+TICK_TIME = datetime.datetime(2014, 1, 2, 10, 0, 0)
+
+
+@pytest.fixture
+def url(tmp_path):
+    return 'sqlite:///' + str(tmp_path / 'ticks.sqlite')
+
+
+def open_store(url):
+    engine = create_engine(url)
+    return TickStore(BOOTSTRAP, MetaData(bind=engine), "UTCTime"), engine
+
+
+def tick(value, table="EUR_USD_fx_CFD", utc_time=TICK_TIME):
+    return Row(table, COLUMNS, [utc_time, value])
+
+
+def stored(engine):
+    return engine.execute("SELECT instrument_id, ts, seq, value FROM ticks "
+                          "ORDER BY instrument_id, ts, seq").fetchall()
+
+
+def test_same_second_ticks_are_all_written(url):
+    store, engine = open_store(url)
+    conn = engine.connect()
+    assert write2db([tick(1.3751), tick(80.5, "USD_JPY_fx_CFD")],
+                    store, conn) == 2
+    assert write2db([tick(1.3752)], store, conn) == 1
+    ts = (TICK_TIME - datetime.datetime(1970, 1, 1)).total_seconds() * 1000
+    assert stored(engine) == [(1, ts, 0, 1.3751), (1, ts, 1, 1.3752),
+                              (2, ts, 0, 80.5)]
+
+
+def test_last_rows_are_the_latest_seq(url):
+    store, engine = open_store(url)
+    write2db([tick(1.3751), tick(1.3752)], store, engine.connect())
+    store, engine = open_store(url)  # Restart.
+    last = fill_from_db(BOOTSTRAP, store, engine.connect())
+    assert last[0].values == [TICK_TIME, 1.3752]
+    assert last[1].values == [None, None]
+    # Carries on after the seq it read back.
+    assert write2db([tick(1.3753)], store, engine.connect()) == 1
+    assert [row[2] for row in stored(engine)] == [0, 1, 2]
+
+
+def test_replay_skips_rows_already_there(url):
+    store, engine = open_store(url)
+    conn = engine.connect()
+    write2db([tick(1.3751)], store, conn)
+    rows = [{"UTCTime": TICK_TIME, "Value": 1.3751},
+            {"UTCTime": TICK_TIME, "Value": 1.3753},
+            {"UTCTime": TICK_TIME, "Value": 1.3753}]
+    assert store.insert(conn, {"EUR_USD_fx_CFD": rows},
+                        skip_existing=True) == 1
+    assert store.insert(conn, {"EUR_USD_fx_CFD": rows},
+                        skip_existing=True) == 0
+    assert [(row[2], row[3]) for row in stored(engine)] == [(0, 1.3751),
+                                                            (1, 1.3753)]
+    # Live writes go after the replayed row.
+    assert write2db([tick(1.3754)], store, conn) == 1
+    assert [row[2] for row in stored(engine)] == [0, 1, 2]
+
+
+def test_older_tick_goes_after_those_at_its_ts(url):
+    store, engine = open_store(url)
+    conn = engine.connect()
+    later = TICK_TIME + datetime.timedelta(seconds=1)
+    write2db([tick(1.3751), tick(1.3752, utc_time=later)], store, conn)
+    # Another page still showing the earlier time, with a new value.
+    assert write2db([tick(1.3753)], store, conn) == 1
+    assert [(row[2], row[3]) for row in stored(engine)] == [
+        (0, 1.3751), (1, 1.3753), (0, 1.3752)]
@@ -0,0 +1,75 @@
+import socket
+from time import sleep, time
+
+import pytest
+
+import CFDscraper
+from CFDscraper import DriverKilled, TimeoutError, Watchdog
+
+
+def busy(seconds):
+    """
+    Runs Python code (so an async exception can land) for seconds.
+    """
+    end = time() + seconds
+    while time() < end:
+        pass
+    return 'done'
+
+
+def test_timeout_interrupts_python_code():
+    watchdog = Watchdog()
+    start = time()
+    with pytest.raises(TimeoutError) as error:
+        watchdog.call(0.1, busy, (5,), message="Busy timed out.")
+    assert time() - start < 1
+    assert str(error.value) == "Busy timed out."
+
+
+def test_timeout_at_call_boundary_stays_in_call():
+    """
+    Deadlines that go off just as func returns either come out of call()
+    or not at all. None may go off after call() has returned.
+    """
+    watchdog = Watchdog()
+    timeouts = 0
+    for n in range(200):
+        try:  # 0 to 20ms against a 10ms deadline.
+            assert watchdog.call(0.01, busy, (n % 21 * 0.001,)) == 'done'
+        except TimeoutError:
+            timeouts += 1
+        busy(0.01)  # A stray TimeoutError would fail the test here.
+    assert 0 < timeouts < 200
+
+
+def test_hung_call_is_killed():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    watchdog = Watchdog()
+    try:
+        with pytest.raises(DriverKilled):
+            # recv() in C doesn't see the TimeoutError; closing it does.
+            watchdog.call(0.1, client.recv, (1,),
+                          kill=lambda: client.shutdown(socket.SHUT_RDWR),
+                          grace=0.1)
+    finally:
+        client.close()
+        server.close()
+
+
+def test_finished_call_is_not_killed():
+    killed = []
+    watchdog = Watchdog()
+    assert watchdog.call(0.05, busy, (0.01,), kill=lambda: killed.append(1),
+                         grace=0.05) == 'done'
+    sleep(0.2)
+    assert killed == []
+
+
+def test_timeout_decorator_goes_through_watchdog():
+    timed = CFDscraper.timeout(0.1, "Decorated timed out.")(busy)
+    with pytest.raises(TimeoutError):
+        timed(5)
+    assert timed(0) == 'done'